@@ -0,0 +1,8 @@
+"""
+Package: benchmarks
+
+Stand-alone load scripts for the Promotions service. They run against the
+database configured through DATABASE_URI, for example:
+
+    python -m benchmarks.sharded_counters --threads 32
+"""
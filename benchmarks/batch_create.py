@@ -0,0 +1,65 @@
+"""
+Benchmark: creating a campaign of promotions, one POST each versus batches
+
+Usage:
+    python -m benchmarks.batch_create [--promotions 5000] [--batch 1000]
+"""
+import argparse
+import time
+
+from service import app
+from tests.factories import PromotionFactory
+from benchmarks.common import quiet, reset_tables
+
+
+def campaign(promotions, prefix):
+    """Returns the bodies of new promotions with distinct codes"""
+    bodies = [promotion.serialize() for promotion in PromotionFactory.build_batch(promotions)]
+    for number, body in enumerate(bodies):
+        body["code"] = f"{prefix}-{number}"
+    return bodies
+
+
+def one_at_a_time(client, bodies):
+    """Creates the promotions with one POST each"""
+    for body in bodies:
+        response = client.post("/api/promotions", json=body)
+        assert response.status_code == 201, response.status_code
+
+
+def in_batches(client, bodies, size):
+    """Creates the promotions with one POST per batch"""
+    for start in range(0, len(bodies), size):
+        response = client.post("/api/promotions:batch", json=bodies[start:start + size])
+        assert response.status_code == 201, response.get_json()
+
+
+def main():
+    """Times both ways of creating the same number of promotions"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--promotions", type=int, default=5000)
+    parser.add_argument("--batch", type=int, default=1000)
+    args = parser.parse_args()
+
+    quiet()
+    client = app.test_client()
+    results = {}
+    for name, create in (
+        ("one_at_a_time", lambda bodies: one_at_a_time(client, bodies)),
+        ("in_batches", lambda bodies: in_batches(client, bodies, args.batch)),
+    ):
+        reset_tables()
+        bodies = campaign(args.promotions, name)
+        started = time.perf_counter()
+        create(bodies)
+        results[name] = time.perf_counter() - started
+    reset_tables()
+
+    print(f"{args.promotions} promotions, batches of {args.batch}")
+    print(f"{'operation':>14} {'seconds':>10} {'per second':>12}")
+    for name, seconds in results.items():
+        print(f"{name:>14} {seconds:>10.2f} {args.promotions / seconds:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Benchmark: bind, unbind and membership checks on a promotion with a million products
+
+Usage:
+    python -m benchmarks.bind_membership [--bindings 1000000] [--iterations 200]
+"""
+import argparse
+import time
+from datetime import date, timedelta
+
+from service.models import db, Promotion
+from benchmarks.common import quiet, reset_tables, percentile
+
+
+def seed(bindings):
+    """Creates one promotion bound to `bindings` products, generated by the database"""
+    promotion = Promotion(
+        code="BENCH-BIND",
+        name="Bind membership benchmark",
+        start=date.today(),
+        expired=date.today() + timedelta(days=1),
+        available=1,
+        promo_type=1,
+        value=10.0,
+    )
+    promotion.create()
+    db.session.execute(
+        db.text(
+            "INSERT INTO product (id, created_at, updated_at) "
+            "SELECT n, now(), now() FROM generate_series(1, :bindings) AS n"
+        ),
+        {"bindings": bindings},
+    )
+    db.session.execute(
+        db.text(
+            "INSERT INTO promotion_product (promotion_id, product_id, created_at, updated_at) "
+            "SELECT :promotion_id, n, now(), now() FROM generate_series(1, :bindings) AS n"
+        ),
+        {"promotion_id": promotion.id, "bindings": bindings},
+    )
+    db.session.commit()
+    db.session.execute(db.text("ANALYZE product"))
+    db.session.execute(db.text("ANALYZE promotion_product"))
+    return promotion
+
+
+def timed(action, iterations):
+    """Returns the latencies of `iterations` calls to action(i) in milliseconds"""
+    samples = []
+    for i in range(iterations):
+        started = time.perf_counter()
+        action(i)
+        samples.append((time.perf_counter() - started) * 1000)
+    return samples
+
+
+def main():
+    """Seeds the bindings and times each operation"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--bindings", type=int, default=1_000_000)
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    quiet()
+    reset_tables()
+    started = time.perf_counter()
+    promotion = seed(args.bindings)
+    print(f"seeded {args.bindings} bindings in {time.perf_counter() - started:.1f}s")
+
+    new_ids = range(args.bindings + 1, args.bindings + 1 + args.iterations)
+    results = {
+        "has_product": timed(lambda i: promotion.has_product(i * 997 % args.bindings + 1), args.iterations),
+        "bind_product": timed(lambda i: promotion.bind_product(new_ids[i]), args.iterations),
+        "unbind_product": timed(lambda i: promotion.unbind_product(new_ids[i]), args.iterations),
+    }
+    print(f"{'operation':>16} {'p50 ms':>10} {'p99 ms':>10}")
+    for name, samples in results.items():
+        print(f"{name:>16} {percentile(samples, 0.5):>10.2f} {percentile(samples, 0.99):>10.2f}")
+    reset_tables()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Benchmark: changing the products of a promotion in bulk versus one call per product
+
+Times each set-based request on 100k products through the API, and the
+one-product bind route on a sample to extrapolate to the same number.
+
+Usage:
+    python -m benchmarks.bulk_bind [--products 100000] [--sample 500]
+"""
+import argparse
+import time
+from datetime import date, timedelta
+
+from service import app
+from service.models import Promotion
+from benchmarks.common import quiet, reset_tables
+
+
+def timed(call):
+    """Returns the seconds a request took, checking that it succeeded"""
+    started = time.perf_counter()
+    response = call()
+    assert response.status_code == 200, response.get_json()
+    return time.perf_counter() - started
+
+
+def main():
+    """Times the bulk requests, then a sample of one product calls"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--products", type=int, default=100_000)
+    parser.add_argument("--sample", type=int, default=500)
+    args = parser.parse_args()
+
+    quiet()
+    reset_tables()
+    client = app.test_client()
+    promotion = Promotion(
+        code="BENCH-BULK-BIND",
+        name="Bulk bind benchmark",
+        start=date.today(),
+        expired=date.today() + timedelta(days=1),
+        available=1,
+        promo_type=1,
+        value=10.0,
+    )
+    promotion.create()
+    url = f"/api/promotions/{promotion.id}/products"
+    products = list(range(1, args.products + 1))
+    # half of the products replaced, the other half kept
+    shifted = list(range(args.products // 2 + 1, args.products // 2 + args.products + 1))
+
+    results = [
+        ("POST, new products", timed(lambda: client.post(url, json={"product_ids": products}))),
+        ("POST, all bound", timed(lambda: client.post(url, json={"product_ids": products}))),
+        ("PUT, half replaced", timed(lambda: client.put(url, json={"product_ids": shifted}))),
+        ("PUT, unchanged", timed(lambda: client.put(url, json={"product_ids": shifted}))),
+        ("DELETE, all", timed(lambda: client.delete(url, json={"product_ids": shifted}))),
+        ("POST, existing products", timed(lambda: client.post(url, json={"product_ids": products}))),
+    ]
+    client.put(url, json={"product_ids": []})
+    sample = products[: args.sample]
+    started = time.perf_counter()
+    for product_id in sample:
+        assert client.put(f"/api/promotions/{promotion.id}/bind/{product_id}").status_code == 200
+    per_call = (time.perf_counter() - started) / len(sample)
+    results.append((f"PUT /bind x{args.products}, estimated", per_call * args.products))
+    reset_tables()
+
+    print(f"{args.products} products")
+    print(f"{'request':>32} {'seconds':>10}")
+    for name, seconds in results:
+        print(f"{name:>32} {seconds:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
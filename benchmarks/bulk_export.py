@@ -0,0 +1,96 @@
+"""
+Benchmark: throughput and memory of flask promotions-export
+
+Exports the same generated table as NDJSON and gzipped NDJSON, the gzip
+run once with the compression on the writer thread and once inline, so
+the overlap of encoding and compression shows in the times.
+
+Usage:
+    python -m benchmarks.bulk_export [--promotions 1000000] [--batch-size 10000]
+"""
+import argparse
+import gzip
+import os
+import resource
+import tempfile
+import time
+
+from service.bulk import BackgroundWriter, export_promotions
+from service.common.cli_commands import SEED_PROMOTIONS
+from service.models import db
+from benchmarks.common import quiet, reset_tables
+
+
+class InlineWriter:
+    """Compresses and writes on the calling thread, like a plain gzip file"""
+
+    def __init__(self, path):
+        self._file = gzip.open(path, "wb", compresslevel=6)
+
+    def write(self, data):
+        """Compresses and writes bytes before returning"""
+        self._file.write(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._file.close()
+
+
+def seed(promotions):
+    """Generates `promotions` promotions bound to 0 to 3 products each"""
+    db.session.execute(db.text(SEED_PROMOTIONS), {"rows": promotions})
+    db.session.execute(
+        db.text(
+            "INSERT INTO product (id, created_at, updated_at) "
+            "SELECT n, now(), now() FROM generate_series(1, 100000) AS n"
+        )
+    )
+    db.session.execute(
+        db.text(
+            "INSERT INTO promotion_product (promotion_id, product_id, created_at, updated_at) "
+            "SELECT id, 1 + (id * 7 + k) % 100000, now(), now() "
+            "FROM promotion, generate_series(0, 2) AS k WHERE k < id % 4"
+        )
+    )
+    db.session.commit()
+    db.session.execute(db.text("ANALYZE"))
+
+
+def peak_rss_mb():
+    """Returns the peak resident set size of this process in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    """Seeds the table and times each way of writing it"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--promotions", type=int, default=1_000_000)
+    parser.add_argument("--batch-size", type=int, default=10_000)
+    args = parser.parse_args()
+
+    quiet()
+    reset_tables()
+    seed(args.promotions)
+    print(f"{'file':>22} {'seconds':>10} {'promotions/s':>14} {'MB':>8} {'peak MB':>10}")
+    with tempfile.TemporaryDirectory() as directory:
+        for label, name, writer in (
+            ("ndjson", "plain.ndjson", BackgroundWriter),
+            ("ndjson.gz", "thread.ndjson.gz", lambda path: BackgroundWriter(path, compress=True)),
+            ("ndjson.gz, inline gzip", "inline.ndjson.gz", InlineWriter),
+        ):
+            path = os.path.join(directory, name)
+            started, totals = time.perf_counter(), {}
+            with writer(path) as output:
+                for totals in export_promotions(output, "ndjson", args.batch_size):
+                    pass
+            seconds = time.perf_counter() - started
+            assert totals["promotions"] == args.promotions, totals
+            print(f"{label:>22} {seconds:>10.1f} {args.promotions / seconds:>14.0f} "
+                  f"{os.path.getsize(path) / 2**20:>8.0f} {peak_rss_mb():>10.0f}")
+    reset_tables()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Benchmark: throughput and memory of flask promotions-import
+
+Imports generated files of growing sizes in one process, smallest first,
+so a peak RSS that stays flat shows that memory does not grow with the
+file.
+
+Usage:
+    python -m benchmarks.bulk_import [--rows 100000 1000000] [--chunk-size 10000] [--no-copy]
+"""
+import argparse
+import gzip
+import json
+import os
+import resource
+import tempfile
+import time
+
+from service.bulk import import_promotions, open_records
+from benchmarks.common import quiet, reset_tables
+
+
+def generate(path, rows):
+    """Writes `rows` promotions bound to up to 3 products each as gzipped NDJSON"""
+    with gzip.open(path, "wt", encoding="utf-8", compresslevel=1) as file:
+        for number in range(rows):
+            file.write(json.dumps({
+                "code": f"import-{number}",
+                "name": f"Promotion {number % 1000}",
+                "start": "2024-01-01",
+                "expired": "2030-01-01",
+                "whole_store": number % 50 == 0,
+                "promo_type": 1 + number % 5,
+                "value": number % 90,
+                "available": number % 101,
+                "counter_shards": 4 if number % 100 == 0 else 0,
+                "products": [1 + (number * 7 + k) % 100_000 for k in range(number % 4)],
+            }) + "\n")
+
+
+def peak_rss_mb():
+    """Returns the peak resident set size of this process in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    """Generates and imports each file size"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, nargs="+", default=[100_000, 1_000_000])
+    parser.add_argument("--chunk-size", type=int, default=10_000)
+    parser.add_argument("--no-copy", action="store_true")
+    args = parser.parse_args()
+
+    quiet()
+    print(f"{'rows':>10} {'seconds':>10} {'rows/s':>10} {'10M rows':>10} {'peak MB':>10}")
+    with tempfile.TemporaryDirectory() as directory:
+        for rows in sorted(args.rows):
+            reset_tables()
+            path = os.path.join(directory, f"promotions-{rows}.ndjson.gz")
+            generate(path, rows)
+            stream, fmt = open_records(path)
+            started, totals = time.perf_counter(), {}
+            with stream:
+                for totals in import_promotions(stream, fmt, args.chunk_size, use_copy=not args.no_copy):
+                    pass
+            seconds = time.perf_counter() - started
+            assert totals["created"] == rows, totals
+            print(f"{rows:>10} {seconds:>10.1f} {rows / seconds:>10.0f} "
+                  f"{10_000_000 / rows * seconds / 60:>9.1f}m {peak_rss_mb():>10.0f}")
+    reset_tables()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+Benchmark: pricing 500 line carts against 1,000 candidate promotions
+
+Times the vectorized rules of service.pricing against the same rules in
+plain Python loops over promotions and lines, and the full evaluation that
+picks the combination. Needs no database.
+
+Usage:
+    python -m benchmarks.cart_pricing [--lines 500] [--promotions 1000] [--iterations 20]
+"""
+import argparse
+import time
+
+import numpy as np
+
+from service.pricing import (
+    BUY_ONE_GET_ONE_OFF,
+    BUY_X_GET_ONE_FREE,
+    FIXED_AMOUNT,
+    PERCENTAGE,
+    EVALUATORS,
+    SAME_PRODUCT_SECOND_OFF,
+    compile_evaluator,
+    evaluate,
+    line_discounts,
+)
+from benchmarks.common import percentile
+
+
+def make_cart(rng, lines, promotions):
+    """Returns random kinds, values, eligibility, prices and quantities"""
+    kinds = rng.integers(1, len(EVALUATORS) + 1, promotions)
+    values = np.where(kinds == BUY_X_GET_ONE_FREE, rng.integers(1, 4, promotions), rng.uniform(1, 50, promotions))
+    # each promotion is bound to about 2% of the lines, and one in fifty is whole store
+    eligible = rng.random((promotions, lines)) < 0.02
+    eligible[rng.random(promotions) < 0.02] = True
+    # sorted, as line_discounts() takes them; evaluate() sorts them itself
+    prices = np.sort(rng.uniform(0.5, 200, lines).round(2))
+    quantities = rng.integers(1, 6, lines)
+    return kinds, values, eligible, prices, quantities
+
+
+def python_line_discounts(kinds, values, eligible, prices, quantities):  # pylint: disable=too-many-arguments,too-many-locals
+    """The same discounts as service.pricing.line_discounts, one promotion and line at a time"""
+    order = sorted(range(len(prices)), key=lambda line: prices[line])
+    discounts = []
+    for kind, value, applies in zip(kinds, values, eligible):
+        row = [0.0] * len(prices)
+        rate = min(max(value, 0), 100) / 100
+        subtotal = (
+            sum(prices[line] * quantities[line] for line in range(len(prices)) if applies[line])
+            if kind == FIXED_AMOUNT else 0
+        )
+        share = min(max(value, 0), subtotal) / subtotal if subtotal > 0 else 0.0
+        left = (
+            sum(quantities[line] for line in range(len(prices)) if applies[line]) // 2
+            if kind == BUY_ONE_GET_ONE_OFF else 0
+        )
+        for line in order:
+            if not applies[line]:
+                continue
+            if kind == PERCENTAGE:
+                row[line] = prices[line] * quantities[line] * rate
+            elif kind == FIXED_AMOUNT:
+                row[line] = prices[line] * quantities[line] * share
+            elif kind == BUY_X_GET_ONE_FREE:
+                row[line] = quantities[line] // (max(int(value), 1) + 1) * prices[line]
+            elif kind == BUY_ONE_GET_ONE_OFF:
+                units = min(left, quantities[line])
+                left -= units
+                row[line] = units * prices[line] * rate
+            elif kind == SAME_PRODUCT_SECOND_OFF:
+                row[line] = quantities[line] // 2 * prices[line] * rate
+        discounts.append(row)
+    return discounts
+
+
+def timed(action, carts):
+    """Returns the latencies of action(*cart) for every cart in milliseconds"""
+    samples = []
+    for cart in carts:
+        started = time.perf_counter()
+        action(*cart)
+        samples.append((time.perf_counter() - started) * 1000)
+    return samples
+
+
+def main():
+    """Times both ways of computing the discounts, then the full evaluation"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--lines", type=int, default=500)
+    parser.add_argument("--promotions", type=int, default=1000)
+    parser.add_argument("--iterations", type=int, default=20)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    generated = [make_cart(rng, args.lines, args.promotions) for _ in range(args.iterations)]
+    python_carts = [tuple(array.tolist() for array in cart) for cart in generated]
+    carts = [
+        (
+            [
+                compile_evaluator(number, "", 1, kind, value)
+                for number, (kind, value) in enumerate(zip(kinds.tolist(), values.tolist()))
+            ],
+            eligible,
+            prices,
+            quantities,
+        )
+        for kinds, values, eligible, prices, quantities in generated
+    ]
+
+    # both ways must agree before their speed is compared
+    np.testing.assert_allclose(line_discounts(*carts[0]), python_line_discounts(*python_carts[0]))
+
+    results = {
+        "numpy_discounts": timed(line_discounts, carts),
+        "python_discounts": timed(python_line_discounts, python_carts),
+        "numpy_evaluate": timed(evaluate, carts),
+    }
+    rounds = [len(evaluate(*cart)[0]) for cart in carts]
+    print(f"{args.lines} lines x {args.promotions} promotions, {np.mean(rounds):.1f} promotions picked per cart")
+    print(f"{'operation':>18} {'p50 ms':>10} {'p99 ms':>10}")
+    for name, samples in results.items():
+        print(f"{name:>18} {percentile(samples, 0.5):>10.2f} {percentile(samples, 0.99):>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
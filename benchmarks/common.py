@@ -0,0 +1,51 @@
+"""
+Helpers shared by the benchmark scripts
+"""
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from service import app
+from service.models import db
+
+
+def quiet():
+    """Silences the per-request logging so it does not skew the numbers"""
+    app.logger.setLevel(logging.WARNING)
+
+
+def reset_tables():
+    """Empties the promotion tables"""
+    db.session.execute(db.text("TRUNCATE promotion_product, product, promotion CASCADE"))
+    db.session.commit()
+
+
+def run_threads(work, threads, iterations):
+    """Calls work() `iterations` times on each of `threads` threads
+
+    Every thread gets its own application context, and therefore its own
+    database session, like a gunicorn worker thread would.
+
+    Returns:
+        tuple: (seconds elapsed, list of every call's result)
+    """
+
+    def worker(_):
+        with app.app_context():
+            try:
+                return [work() for _ in range(iterations)]
+            finally:
+                db.session.remove()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        results = [result for chunk in executor.map(worker, range(threads)) for result in chunk]
+    return time.perf_counter() - started, results
+
+
+def percentile(samples, fraction):
+    """Returns the given percentile (0.0 - 1.0) of a list of numbers"""
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
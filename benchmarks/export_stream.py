@@ -0,0 +1,90 @@
+"""
+Benchmark: peak memory of the streaming export versus building the full list
+
+Each measurement runs in a fresh process, so its peak RSS only covers
+that one export.
+
+Usage:
+    python -m benchmarks.export_stream [--rows 10000 100000]
+"""
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+
+from service import app
+from service.models import db, Promotion
+from service.common.cli_commands import SEED_PROMOTIONS
+from benchmarks.common import quiet, reset_tables
+
+
+def seed(rows):
+    """Generates `rows` promotions in the database"""
+    db.session.execute(db.text(SEED_PROMOTIONS), {"rows": rows})
+    db.session.commit()
+    db.session.execute(db.text("ANALYZE promotion"))
+
+
+def peak_rss_mb():
+    """Returns the peak resident set size of this process in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(mode):
+    """Exports every promotion once and prints bytes, seconds and peak RSS as JSON"""
+    quiet()
+    baseline = peak_rss_mb()
+    started = time.perf_counter()
+    if mode == "stream":
+        response = app.test_client().get("/api/promotions/export")
+        size = sum(len(chunk) for chunk in response.response)
+    else:
+        # what the list endpoint did before paging: serialize everything, then dump
+        size = len(json.dumps([promotion.serialize() for promotion in Promotion.all()]))
+    print(json.dumps({
+        "bytes": size,
+        "seconds": time.perf_counter() - started,
+        "baseline_mb": baseline,
+        "peak_mb": peak_rss_mb(),
+    }))
+
+
+def run(mode):
+    """Runs one measurement in a child process and returns its results"""
+    output = subprocess.run(
+        [sys.executable, "-m", "benchmarks.export_stream", "--measure", mode],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    """Seeds each table size and measures both ways of exporting it"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--measure", choices=("stream", "list"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.measure:
+        measure(args.measure)
+        return
+
+    quiet()
+    print(f"{'rows':>10} {'mode':>7} {'MB out':>8} {'seconds':>8} {'peak RSS MB':>12} {'growth MB':>10}")
+    for rows in args.rows:
+        reset_tables()
+        seed(rows)
+        for mode in ("stream", "list"):
+            result = run(mode)
+            print(
+                f"{rows:>10} {mode:>7} {result['bytes'] / 2**20:>8.1f} {result['seconds']:>8.1f} "
+                f"{result['peak_mb']:>12.1f} {result['peak_mb'] - result['baseline_mb']:>10.1f}"
+            )
+    reset_tables()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Benchmark: checkout waits and saturation of the pool for a number of threads
+
+Runs the same load from `--threads` threads, each request doing a little
+work and then holding a connection for a short query, against pools of
+growing size without overflow. It prints what GET /admin/pool would
+report for each, to show how the telemetry points to the pool size a
+gunicorn worker needs.
+
+Usage:
+    python -m benchmarks.pool_sizing [--threads 8] [--requests 200] [--sizes 2 4 8]
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import create_engine, text
+
+from service import app
+from service.pool import MonitoredQueuePool
+from benchmarks.common import quiet
+
+# a request holding its connection for about 2 ms, after 1 ms of work without it
+QUERY = text("SELECT pg_sleep(0.002)")
+WORK_SECONDS = 0.001
+
+
+def load(engine, threads, requests):
+    """Runs `requests` queries on each of `threads` threads, returning the seconds taken"""
+
+    def worker(_):
+        for _ in range(requests):
+            time.sleep(WORK_SECONDS)
+            with engine.connect() as connection:
+                connection.execute(QUERY)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(worker, range(threads)))
+    return time.perf_counter() - started
+
+
+def main():
+    """Runs the load against each pool size"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[2, 4, 8])
+    args = parser.parse_args()
+
+    quiet()
+    print(f"{args.threads} threads, {args.requests} requests each")
+    print(f"{'pool size':>10} {'req/s':>8} {'saturated':>10} {'<=1ms':>8} {'<=10ms':>8} {'max ms':>8}")
+    for size in args.sizes:
+        engine = create_engine(
+            app.config["SQLALCHEMY_DATABASE_URI"],
+            poolclass=MonitoredQueuePool,
+            pool_size=size,
+            max_overflow=0,
+        )
+        seconds = load(engine, args.threads, args.requests)
+        stats = engine.pool.telemetry()
+        engine.dispose()
+        waits = stats["wait_ms"]
+        print(
+            f"{size:>10} {args.threads * args.requests / seconds:>8.0f} {stats['saturation_ratio']:>10.1%} "
+            f"{waits['buckets']['1'] / waits['count']:>8.1%} {waits['buckets']['10'] / waits['count']:>8.1%} "
+            f"{waits['max']:>8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Benchmark: applicable promotions of a cart, one batch lookup versus one call per product
+
+Usage:
+    python -m benchmarks.promotion_lookup [--promotions 10000] [--products 100000]
+        [--bindings 500000] [--cart 200] [--iterations 50] [--target-p99 50]
+"""
+import argparse
+import random
+import sys
+import time
+
+from service import app
+from service.models import db, Product, Promotion
+from service.common.cli_commands import SEED_PROMOTIONS
+from benchmarks.common import quiet, reset_tables, percentile
+
+
+def seed(promotions, products, bindings):
+    """Generates the promotions, the products and the bindings between them"""
+    db.session.execute(db.text(SEED_PROMOTIONS), {"rows": promotions})
+    db.session.execute(
+        db.text(
+            "INSERT INTO product (id, created_at, updated_at) "
+            "SELECT n, now(), now() FROM generate_series(1, :products) AS n"
+        ),
+        {"products": products},
+    )
+    db.session.execute(
+        db.text(
+            "INSERT INTO promotion_product (promotion_id, product_id, created_at, updated_at) "
+            "SELECT first.id + (n::bigint * 7919) % :promotions, 1 + n % :products, now(), now() "
+            "FROM generate_series(1, :bindings) AS n, "
+            "(SELECT min(id) AS id FROM promotion) AS first "
+            "ON CONFLICT DO NOTHING"
+        ),
+        {"promotions": promotions, "products": products, "bindings": bindings},
+    )
+    db.session.commit()
+    for table in ("promotion", "product", "promotion_product"):
+        db.session.execute(db.text(f"ANALYZE {table}"))
+
+
+def timed(action, carts):
+    """Returns the latencies of action(cart) for every cart in milliseconds"""
+    samples = []
+    for cart in carts:
+        started = time.perf_counter()
+        action(cart)
+        samples.append((time.perf_counter() - started) * 1000)
+    return samples
+
+
+def lookup(client, cart):
+    """Asks for the promotions of the whole cart at once"""
+    response = client.post("/api/products/promotions:lookup", json={"product_ids": cart})
+    assert response.status_code == 200, response.status_code
+
+
+def per_product(cart):
+    """Serializes each product of the cart with its promotions and keeps the valid ones, as checkout did"""
+    applicable = {}
+    for product_id in cart:
+        promotions = Product.find(product_id).serialize()["promotions"]
+        applicable[product_id] = [
+            promotion["id"] for promotion in promotions if Promotion.find(promotion["id"]).is_valid()
+        ]
+        db.session.expunge_all()
+    return applicable
+
+
+def main():
+    """Seeds the tables and times both ways of looking up a cart"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--promotions", type=int, default=10_000)
+    parser.add_argument("--products", type=int, default=100_000)
+    parser.add_argument("--bindings", type=int, default=500_000)
+    parser.add_argument("--cart", type=int, default=200)
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--target-p99", type=float, default=50.0, help="p99 of the batch lookup in ms")
+    args = parser.parse_args()
+
+    quiet()
+    reset_tables()
+    started = time.perf_counter()
+    seed(args.promotions, args.products, args.bindings)
+    print(f"seeded {args.promotions} promotions, {args.products} products "
+          f"and {args.bindings} bindings in {time.perf_counter() - started:.1f}s")
+
+    rng = random.Random(42)
+    carts = [rng.sample(range(1, args.products + 1), args.cart) for _ in range(args.iterations)]
+    client = app.test_client()
+    results = {
+        "lookup": timed(lambda cart: lookup(client, cart), carts),
+        "per_product": timed(per_product, carts),
+    }
+    print(f"{'operation':>12} {'p50 ms':>10} {'p99 ms':>10}")
+    for name, samples in results.items():
+        print(f"{name:>12} {percentile(samples, 0.5):>10.2f} {percentile(samples, 0.99):>10.2f}")
+    reset_tables()
+
+    p99 = percentile(results["lookup"], 0.99)
+    if p99 > args.target_p99:
+        print(f"lookup p99 {p99:.2f} ms is over the {args.target_p99:.0f} ms target")
+        sys.exit(1)
+    print(f"lookup p99 {p99:.2f} ms is within the {args.target_p99:.0f} ms target")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Benchmark: apply throughput on one hot promotion versus its number of counter shards
+
+Usage:
+    python -m benchmarks.sharded_counters [--threads 32] [--iterations 200] [--shards 0,1,4,16]
+"""
+import argparse
+from datetime import date, timedelta
+
+from service.models import Promotion, PromotionNotApplicableError
+from benchmarks.common import quiet, reset_tables, run_threads
+
+
+def apply_throughput(shards, threads, iterations):
+    """Hammers one promotion with `threads` concurrent appliers"""
+    promotion = Promotion(
+        code=f"BENCH-SHARDS-{shards}",
+        name="Sharded counter benchmark",
+        start=date.today(),
+        expired=date.today() + timedelta(days=1),
+        available=threads * iterations,
+        promo_type=1,
+        value=10.0,
+        counter_shards=shards,
+    )
+    promotion.create()
+    promotion_id = promotion.id
+
+    def apply_once():
+        try:
+            Promotion.redeem(promotion_id)
+            return 1
+        except PromotionNotApplicableError:
+            return 0
+
+    elapsed, results = run_threads(apply_once, threads, iterations)
+    return sum(results), elapsed
+
+
+def main():
+    """Runs the benchmark for every requested shard count"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--shards", default="0,1,4,16")
+    args = parser.parse_args()
+
+    quiet()
+    print(f"{'shards':>8} {'applied':>10} {'seconds':>10} {'applies/s':>12}")
+    for shards in [int(value) for value in args.shards.split(",")]:
+        reset_tables()
+        applied, elapsed = apply_throughput(shards, args.threads, args.iterations)
+        print(f"{shards:>8} {applied:>10} {elapsed:>10.2f} {applied / elapsed:>12.0f}")
+    reset_tables()
+
+
+if __name__ == "__main__":
+    main()
@@ -20,17 +20,20 @@ HTTP_404_NOT_FOUND = 404
 def step_impl(context):
     """Delete all Promotions and load new ones"""
 
-    # List all of the promotions and delete them one by one
+    # List all of the promotions page by page and delete them one by one
     rest_endpoint = f"{context.base_url}/api/promotions"
-    context.resp = requests.get(rest_endpoint)
-    assert (
-        context.resp.status_code == HTTP_200_OK
-    ), f"Expected 200 OK, got {context.resp.status_code}"
-    for promotion in context.resp.json():
-        context.resp = requests.delete(f"{rest_endpoint}/{promotion['id']}")
+    page_url = rest_endpoint
+    while page_url:
+        context.resp = requests.get(page_url)
         assert (
-            context.resp.status_code == HTTP_204_NO_CONTENT
-        ), f"Expected 204 No Content, got {context.resp.status_code}"
+            context.resp.status_code == HTTP_200_OK
+        ), f"Expected 200 OK, got {context.resp.status_code}"
+        page_url = context.resp.links.get("next", {}).get("url")
+        for promotion in context.resp.json():
+            context.resp = requests.delete(f"{rest_endpoint}/{promotion['id']}")
+            assert (
+                context.resp.status_code == HTTP_204_NO_CONTENT
+            ), f"Expected 204 No Content, got {context.resp.status_code}"
 
     # load the database with new promotions
     for row in context.table:
@@ -31,7 +31,7 @@ api = Api(
 
 # Dependencies require we import the routes AFTER the Flask app is created
 # pylint: disable=wrong-import-position, wrong-import-order, cyclic-import
-from service import routes, models  # noqa: E402, E261
+from service import routes, models, leases, pool, pricing  # noqa: E402, E261
 # pylint: disable=wrong-import-position
 from service.common import error_handlers, cli_commands  # noqa: F401, E402
 
@@ -43,7 +43,10 @@ app.logger.info("  S E R V I C E   R U N N I N G  ".center(70, "*"))
 app.logger.info(70 * "*")
 
 try:
+    pool.monitor.init_app(app)  # before the engine is created
     models.init_db(app)  # make our SQLAlchemy tables
+    leases.leases.init_app(app)
+    pricing.evaluators.init_app(app)
 except Exception as error:  # pylint: disable=broad-except
     app.logger.critical("%s: Cannot continue", error)
     # gunicorn requires exit code 4 to stop spawning workers when they die
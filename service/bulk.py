@@ -0,0 +1,500 @@
+"""
+Streaming bulk import and export of promotions
+
+Files of any size are read a chunk at a time. Each chunk is checked with
+the rules of Promotion.deserialize() and create(), copied into a staging
+table with PostgreSQL COPY, moved into the tables with one set-based
+statement and committed, so the memory used does not depend on the size of
+the file. Promotions whose code already exists are skipped, which makes an
+interrupted import safe to run again.
+
+Records are promotions in the representation of the API, with their bound
+product ids under `products`: one JSON document per line for ndjson, or a
+CSV file with a header naming the columns, `products` holding the ids
+separated by spaces.
+
+Exports are written in the same formats, so they can be imported again.
+The tables are read through a server-side cursor as plain rows rather than
+models, and the file is compressed and written from another thread while
+the next batch is encoded.
+"""
+import contextlib
+import csv
+import gzip
+import io
+import json
+import os
+import queue
+import threading
+from itertools import groupby, islice
+from operator import itemgetter
+
+from service.models import (
+    db,
+    DataValidationError,
+    Promotion,
+    PromotionCounter,
+    commit_changes,
+    promotion_product,
+    _product_id_list,
+    _shard_rows,
+)
+
+FORMATS = ("csv", "ndjson")
+
+# records read, checked and loaded at a time
+CHUNK_SIZE = 10_000
+
+# the columns of the staging table, in the order of a staging row
+STAGING_COLUMNS = ("line",) + Promotion.CREATE_COLUMNS + ("products",)
+
+CREATE_STAGING = """
+CREATE TEMP TABLE IF NOT EXISTS promotion_import (
+    line bigint,
+    code varchar(36),
+    name varchar(63),
+    start date,
+    expired date,
+    available integer,
+    whole_store boolean,
+    promo_type integer,
+    value double precision,
+    counter_shards integer,
+    products integer[]
+) ON COMMIT DELETE ROWS
+"""
+
+# Moves the staged chunk into the tables: the promotions with a new code,
+# the products they are bound to, their bindings and their counter shards.
+# The foreign keys are checked at the end of the statement, once the
+# products are there.
+MOVE_STAGING = """
+WITH chunk AS (
+    SELECT DISTINCT ON (code) * FROM promotion_import ORDER BY code, line
+), created AS (
+    INSERT INTO promotion (code, name, start, expired, available, whole_store,
+                           promo_type, value, counter_shards, version, revision, created_at, updated_at)
+    SELECT code, name, start, expired, available, whole_store,
+           promo_type, value, counter_shards, 1, 1, CURRENT_DATE, CURRENT_DATE
+    FROM chunk
+    ON CONFLICT (code) DO NOTHING
+    RETURNING id, code, available, counter_shards
+), bound AS (
+    SELECT DISTINCT created.id AS promotion_id, unnest(chunk.products) AS product_id
+    FROM created JOIN chunk USING (code)
+), products AS (
+    INSERT INTO product (id, created_at, updated_at)
+    SELECT DISTINCT product_id, now(), now() FROM bound
+    ON CONFLICT (id) DO NOTHING
+), bindings AS (
+    INSERT INTO promotion_product (promotion_id, product_id, created_at, updated_at)
+    SELECT promotion_id, product_id, CURRENT_DATE, CURRENT_DATE FROM bound
+    RETURNING 1
+), shards AS (
+    INSERT INTO promotion_counter (promotion_id, shard, available)
+    SELECT id, shard,
+           GREATEST(available, 0) / counter_shards
+           + (shard < GREATEST(available, 0) % counter_shards)::int
+    FROM created, generate_series(0, counter_shards - 1) AS shard
+    WHERE counter_shards > 0
+)
+SELECT (SELECT count(*) FROM created), (SELECT count(*) FROM bindings)
+"""
+
+
+# the columns of an exported record, the product ids last
+EXPORT_COLUMNS = ("id",) + Promotion.CREATE_COLUMNS + ("created_at", "updated_at", "products")
+
+# encoded batches waiting for the writer thread
+WRITE_QUEUE_DEPTH = 4
+
+
+def file_format(path, fmt=None):
+    """Returns whether a file is gzipped and its format, from its name when not given"""
+    compressed = path.endswith(".gz")
+    name = path[:-3] if compressed else path
+    if fmt is None:
+        fmt = "csv" if name.endswith(".csv") else "ndjson"
+    return compressed, fmt
+
+
+def open_records(path, fmt=None):
+    """Opens a CSV or NDJSON file, gzipped when its name ends with .gz
+
+    Returns:
+        tuple: (the text stream, its format, from the file name when not given)
+    """
+    compressed, fmt = file_format(path, fmt)
+    opener = gzip.open if compressed else open
+    return opener(path, "rt", encoding="utf-8", newline=""), fmt
+
+
+def read_records(stream, fmt):
+    """Yields the line number and the record of every promotion of a stream
+
+    A line that cannot be parsed is yielded with the error instead of a record.
+    """
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, _from_csv(record)
+        return
+    for number, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield number, json.loads(line)
+        except ValueError as error:
+            yield number, DataValidationError(f"Invalid JSON: {error}")
+
+
+def _from_csv(record):
+    """Converts the text fields of a CSV record to the types of a JSON one"""
+    record = dict(record)
+    if record.get("whole_store") is not None:
+        record["whole_store"] = record["whole_store"].strip().lower() in ("true", "1", "yes")
+    if not record.get("counter_shards"):
+        record.pop("counter_shards", None)
+    if "products" in record:
+        record["products"] = (record["products"] or "").split()
+    return record
+
+
+class _Record:  # pylint: disable=too-few-public-methods
+    """The attributes of a promotion to create, checked with the methods of Promotion
+
+    A plain object avoids the attribute instrumentation of the model, which
+    is most of the cost of checking a record.
+    """
+
+    __slots__ = Promotion.CREATE_COLUMNS
+    MAX_COUNTER_SHARDS = Promotion.MAX_COUNTER_SHARDS
+    deserialize = Promotion.deserialize
+    _check_new = Promotion._check_new  # pylint: disable=protected-access
+    _check_counter_shards = Promotion._check_counter_shards  # pylint: disable=protected-access
+    _check_columns = Promotion._check_columns  # pylint: disable=protected-access
+    INTEGER_COLUMNS = Promotion.INTEGER_COLUMNS
+
+    def __init__(self):
+        for column in self.__slots__:
+            setattr(self, column, None)
+
+
+def staging_row(line, record, promotion):
+    """Returns the staging row of a record, checked like a created promotion
+
+    Args:
+        line (int): the line of the record in the file
+        record (dict): the promotion
+        promotion (_Record): reused to run the checks
+
+    Raises:
+        DataValidationError: the record is not a valid promotion
+    """
+    if isinstance(record, Exception):
+        raise record
+    if not isinstance(record, dict):
+        raise DataValidationError("Invalid PromotionModel: not an object")
+    promotion.counter_shards = None
+    promotion.deserialize(record)
+    if promotion.code is None or promotion.code == "":
+        raise DataValidationError("code attribute is not set")
+    promotion._check_new()  # pylint: disable=protected-access
+    promotion._check_columns()  # pylint: disable=protected-access
+    products = sorted(_product_id_list(record.get("products") or []))
+    return (line,) + tuple(getattr(promotion, column) for column in Promotion.CREATE_COLUMNS) + (products,)
+
+
+def _copy_chunk(rows):
+    """Loads checked rows with COPY into the staging table, then into the tables
+
+    Returns:
+        tuple: (the promotions created, the bindings created)
+    """
+    db.session.execute(db.text(CREATE_STAGING))
+    cursor = db.session.connection().connection.cursor()
+    try:
+        with cursor.copy(f"COPY promotion_import ({', '.join(STAGING_COLUMNS)}) FROM STDIN") as copy:
+            for row in rows:
+                copy.write_row(row)
+    finally:
+        cursor.close()
+    return tuple(db.session.execute(db.text(MOVE_STAGING)).one())
+
+
+def _insert_bindings(bound):
+    """Inserts bindings with executemany, adding the products they name first"""
+    tables = db.metadata.tables
+    wanted = {row["product_id"] for row in bound}
+    existing = set(db.session.scalars(db.select(tables["product"].c.id).where(tables["product"].c.id.in_(wanted))))
+    if wanted - existing:
+        db.session.execute(db.insert(tables["product"]), [{"id": product_id} for product_id in sorted(wanted - existing)])
+    db.session.execute(db.insert(tables["promotion_product"]), bound)
+
+
+def _insert_chunk(rows):
+    """Loads checked rows with executemany, for databases without COPY
+
+    Returns:
+        tuple: (the promotions created, the bindings created)
+    """
+    promotion, counter = db.metadata.tables["promotion"], db.metadata.tables["promotion_counter"]
+    # the first row of each new code
+    records = {}
+    for row in rows:
+        records.setdefault(row[1], dict(zip(STAGING_COLUMNS, row)))
+    for code in set(db.session.scalars(db.select(promotion.c.code).where(promotion.c.code.in_(list(records))))):
+        del records[code]
+    if not records:
+        return 0, 0
+
+    db.session.execute(
+        db.insert(promotion),
+        [{column: record[column] for column in Promotion.CREATE_COLUMNS} for record in records.values()],
+    )
+    ids = dict(
+        db.session.execute(
+            db.select(promotion.c.code, promotion.c.id).where(promotion.c.code.in_(list(records)))
+        ).all()
+    )
+    bound = [
+        {"promotion_id": ids[code], "product_id": product_id}
+        for code, record in records.items()
+        for product_id in record["products"]
+    ]
+    if bound:
+        _insert_bindings(bound)
+    shards = [
+        row
+        for code, record in records.items()
+        if record["counter_shards"]
+        for row in _shard_rows(ids[code], record["counter_shards"], record["available"])
+    ]
+    if shards:
+        db.session.execute(db.insert(counter), shards)
+    return len(records), len(bound)
+
+
+def _check_chunk(chunk, promotion):
+    """Returns the staging rows of the valid records and the (line, error) of the others"""
+    rows, errors = [], []
+    for line, record in chunk:
+        try:
+            rows.append(staging_row(line, record, promotion))
+        except DataValidationError as error:
+            errors.append((line, str(error)))
+    return rows, errors
+
+
+def import_promotions(stream, fmt, chunk_size=CHUNK_SIZE, use_copy=None):
+    """Imports the promotions of a stream, one committed chunk at a time
+
+    Args:
+        stream (file): a text stream of CSV or NDJSON
+        fmt (str): "csv" or "ndjson"
+        chunk_size (int): the records read, checked and loaded at a time
+        use_copy (bool): load with COPY, by default when the database is PostgreSQL
+
+    Yields:
+        dict: after each chunk, the records read, created, skipped because
+        their code exists and rejected so far, the bindings created, and the
+        (line, error) of the records rejected in the chunk
+    """
+    if use_copy is None:
+        use_copy = db.engine.dialect.name == "postgresql"
+    load = _copy_chunk if use_copy else _insert_chunk
+    totals = dict.fromkeys(("read", "created", "skipped", "rejected", "bindings"), 0)
+    promotion = _Record()
+    records = read_records(stream, fmt)
+    chunk = list(islice(records, chunk_size))
+    while chunk:
+        rows, errors = _check_chunk(chunk, promotion)
+        try:
+            created, bindings = load(rows) if rows else (0, 0)
+            commit_changes()
+        except Exception:
+            # the chunks committed before stay, an import run again skips them
+            db.session.rollback()
+            raise
+
+        totals["read"] += len(chunk)
+        totals["created"] += created
+        totals["skipped"] += len(rows) - created
+        totals["rejected"] += len(errors)
+        totals["bindings"] += bindings
+        yield dict(totals, errors=errors)
+        chunk = list(islice(records, chunk_size))
+
+
+class BackgroundWriter:
+    """Writes bytes to a file from a thread, gzipping them when asked
+
+    Writes are queued and return at once, so the caller encodes the next
+    batch while the previous one is compressed and written; zlib releases
+    the GIL while it compresses. At most WRITE_QUEUE_DEPTH batches wait,
+    which bounds the memory used. An error of the thread is raised by the
+    next write() or by close().
+
+    The bytes go to `path` + ".tmp", which replaces `path` only when close()
+    succeeds, so a failed export leaves the previous file as it was.
+    """
+
+    def __init__(self, path, compress=False):
+        self.path = path
+        self._partial = path + ".tmp"
+        # closed by close() or discard(), once the thread has written everything
+        # pylint: disable-next=consider-using-with
+        self._file = gzip.open(self._partial, "wb", compresslevel=6) if compress else open(self._partial, "wb")
+        self._queue = queue.Queue(WRITE_QUEUE_DEPTH)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="promotion-export-writer", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        data = self._queue.get()
+        while data is not None:
+            if self._error is None:
+                try:
+                    self._file.write(data)
+                # any error is the caller's to raise: the thread keeps emptying
+                # the queue, so that write() never waits on it forever
+                except Exception as error:  # pylint: disable=broad-exception-caught
+                    self._error = error
+            data = self._queue.get()
+
+    def _finish(self):
+        """Writes the queued bytes and closes the partial file"""
+        self._queue.put(None)
+        self._thread.join()
+        try:
+            self._file.close()
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            self._error = self._error or error
+
+    def write(self, data):
+        """Queues bytes to be written"""
+        if self._error is not None:
+            raise self._error
+        self._queue.put(data)
+
+    def close(self):
+        """Writes the queued bytes, then moves the file to its path"""
+        self._finish()
+        if self._error is not None:
+            self._remove_partial()
+            raise self._error
+        os.replace(self._partial, self.path)
+
+    def discard(self):
+        """Stops writing and removes the partial file, leaving the path as it was"""
+        self._finish()
+        self._remove_partial()
+
+    def _remove_partial(self):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self._partial)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+def _export_query():
+    """Returns the promotions joined to their product ids, in id then product id order
+
+    Sharded promotions get the uses left in their shards, the value that
+    an import spreads over them again.
+    """
+    table = Promotion.__table__
+    shard_total = (
+        db.select(db.func.coalesce(db.func.sum(PromotionCounter.available), 0))
+        .where(PromotionCounter.promotion_id == table.c.id)
+        .scalar_subquery()
+    )
+    available = db.case((table.c.counter_shards > 0, shard_total), else_=table.c.available)
+    columns = [
+        available.label(column) if column == "available" else table.c[column]
+        for column in EXPORT_COLUMNS[:-1]
+    ]
+    return (
+        db.select(*columns, promotion_product.c.product_id)
+        .select_from(table.outerjoin(promotion_product, promotion_product.c.promotion_id == table.c.id))
+        .order_by(table.c.id, promotion_product.c.product_id)
+    )
+
+
+def read_promotions(batch_size=CHUNK_SIZE):
+    """Yields every promotion with its product ids, in lists of about `batch_size`
+
+    The rows are fetched `batch_size` at a time from a server-side cursor
+    and never become models, so nothing is kept in the session.
+
+    Yields:
+        list: tuples of the values of EXPORT_COLUMNS
+    """
+    result = db.session.execute(_export_query().execution_options(yield_per=batch_size))
+    batch = []
+    for _, rows in groupby(result.tuples(), key=itemgetter(0)):
+        rows = list(rows)
+        products = [row[-1] for row in rows if row[-1] is not None]
+        batch.append(rows[0][:-1] + (products,))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _isoformat(value):
+    """Returns a date as ISO 8601 text, None as None"""
+    return value.isoformat() if value is not None else None
+
+
+def encode_records(records, fmt):
+    """Returns exported records as the bytes of NDJSON lines or CSV rows"""
+    if fmt == "csv":
+        text = io.StringIO()
+        writer = csv.writer(text, lineterminator="\n")
+        for record in records:
+            writer.writerow(record[:-1] + (" ".join(map(str, record[-1])),))
+        return text.getvalue().encode("utf-8")
+    dates = [EXPORT_COLUMNS.index(column) for column in ("start", "expired", "created_at", "updated_at")]
+    lines = []
+    for record in records:
+        record = list(record)
+        for position in dates:
+            record[position] = _isoformat(record[position])
+        lines.append(json.dumps(dict(zip(EXPORT_COLUMNS, record))) + "\n")
+    return "".join(lines).encode("utf-8")
+
+
+def export_promotions(writer, fmt, batch_size=CHUNK_SIZE):
+    """Writes every promotion and its product ids to a writer, in id order
+
+    The promotions are read in one statement, so the export is a consistent
+    snapshot of the tables.
+
+    Args:
+        writer (BackgroundWriter): where the bytes go
+        fmt (str): "csv" or "ndjson"
+        batch_size (int): the promotions read and encoded at a time
+
+    Yields:
+        dict: after each batch, the promotions and bindings written so far
+    """
+    totals = {"promotions": 0, "bindings": 0}
+    if fmt == "csv":
+        writer.write((",".join(EXPORT_COLUMNS) + "\n").encode("utf-8"))
+    try:
+        for batch in read_promotions(batch_size):
+            writer.write(encode_records(batch, fmt))
+            totals["promotions"] += len(batch)
+            totals["bindings"] += sum(len(record[-1]) for record in batch)
+            yield dict(totals)
+    finally:
+        db.session.rollback()
@@ -0,0 +1,246 @@
+"""
+Module: cache
+
+Shared cache of encoded promotion payloads
+
+Every promotion has a version counter in the cache backend, bumped by each
+write to the promotion. Payloads are stored under keys that carry the
+version they were read at, so one bump makes every worker sharing the
+backend miss and read the promotion again; the old entries simply expire.
+
+Versions expire too, once neither read nor bumped for a time to live
+longer than the one of payloads: the payloads stored under an expired
+version have expired before it, so the version can start over from 0.
+
+Backends:
+  * memory://   a bounded dict local to the worker process
+  * redis://... any server speaking the Redis protocol, shared by the workers
+"""
+import logging
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+logger = logging.getLogger("flask.app")
+
+
+class MemoryBackend:
+    """A bounded LRU backend local to the process"""
+
+    # the errors of the backend that are logged instead of failing the request
+    errors = ()
+
+    def __init__(self, size=1024):
+        self.size = size
+        self._entries = OrderedDict()
+        # counters are only dropped once expired, never evicted: losing a
+        # version that payloads are still stored under could bring them back.
+        # Their time to live is the same for all, so they expire in the order
+        # they were last used.
+        self._counters = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, ttl=None):
+        """Returns the value stored under key, or None
+
+        With ttl, the time to live of a counter starts over, like GETEX.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._expire_counters(now)
+            if key in self._counters:
+                if ttl is not None:
+                    self._counters[key] = (now + ttl, self._counters[key][1])
+                    self._counters.move_to_end(key)
+                return self._counters[key][1]
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if now >= expires_at:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        """Stores a value under key for ttl seconds"""
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def incr(self, key, ttl):
+        """Adds one to the counter stored under key, keeps it ttl seconds and returns it"""
+        now = time.monotonic()
+        with self._lock:
+            self._expire_counters(now)
+            value = self._counters.get(key, (0, 0))[1] + 1
+            self._counters[key] = (now + ttl, value)
+            self._counters.move_to_end(key)
+            return value
+
+    def _expire_counters(self, now):
+        """Drops the counters whose time to live is over (lock held)"""
+        while self._counters:
+            key, (expires_at, _) = next(iter(self._counters.items()))
+            if now < expires_at:
+                return
+            del self._counters[key]
+
+
+class RedisBackend:
+    """A backend on a server speaking the Redis protocol"""
+
+    def __init__(self, client):
+        # imported here so that redis is only needed when it is configured
+        from redis.exceptions import RedisError  # pylint: disable=import-outside-toplevel
+
+        self.errors = (RedisError,)
+        self.client = client
+
+    @classmethod
+    def from_url(cls, url):
+        """Returns a backend connected to the server at url"""
+        import redis  # pylint: disable=import-outside-toplevel
+
+        return cls(redis.Redis.from_url(url))
+
+    def get(self, key, ttl=None):
+        """Returns the value stored under key, or None
+
+        With ttl, the time to live of the key starts over, with GETEX.
+        """
+        if ttl is None:
+            return self.client.get(key)
+        return self.client.getex(key, px=int(ttl * 1000))
+
+    def set(self, key, value, ttl):
+        """Stores a value under key for ttl seconds"""
+        self.client.set(key, value, px=int(ttl * 1000))
+
+    def incr(self, key, ttl):
+        """Adds one to the counter stored under key, keeps it ttl seconds and returns it"""
+        pipeline = self.client.pipeline()
+        pipeline.incr(key)
+        pipeline.pexpire(key, int(ttl * 1000))
+        return pipeline.execute()[0]
+
+
+def create_backend(url, size=1024):
+    """Returns the backend of a cache URL, or None when the URL is empty"""
+    if not url:
+        return None
+    if url.startswith("memory://"):
+        return MemoryBackend(size)
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBackend.from_url(url)
+    raise ValueError(f"Unsupported cache URL: {url}")
+
+
+class PayloadCache:
+    """Encoded promotion payloads under versioned keys"""
+
+    PREFIX = "promotions"
+
+    def __init__(self, backend=None, ttl=5.0, version_ttl=3600.0):
+        self.backend = backend
+        self.ttl = ttl
+        self.version_ttl = version_ttl
+        self._lock = threading.Lock()
+        self._stats = {}
+        self.reset_stats()
+
+    def init_app(self, app):
+        """Connects the backend configured by PROMOTION_PAYLOAD_CACHE_URL"""
+        self.backend = create_backend(
+            app.config.get("PROMOTION_PAYLOAD_CACHE_URL", "memory://"),
+            app.config.get("PROMOTION_CACHE_SIZE", 1024),
+        )
+        self.ttl = app.config.get("PROMOTION_PAYLOAD_CACHE_TTL", 5.0)
+        self.version_ttl = app.config.get("PROMOTION_PAYLOAD_VERSION_TTL", 3600.0)
+        if self.version_ttl <= self.ttl:
+            raise ValueError("PROMOTION_PAYLOAD_VERSION_TTL must be longer than PROMOTION_PAYLOAD_CACHE_TTL")
+        self.reset_stats()
+
+    @property
+    def enabled(self):
+        """True when a backend is configured"""
+        return self.backend is not None
+
+    def get(self, promotion_id, selected):
+        """Returns the current version of a promotion and its cached (etag, body)
+
+        The entry is None on a miss. The version must be handed back to put()
+        so that a payload read while the promotion changes is never found.
+        """
+        if not self.enabled:
+            return None, None
+        try:
+            version = int(self.backend.get(self._version_key(promotion_id), self.version_ttl) or 0)
+            value = self.backend.get(self._payload_key(promotion_id, version, selected))
+        except self.backend.errors as error:
+            logger.warning("Payload cache read failed: %s", error)
+            self._count("errors")
+            return None, None
+        if value is None:
+            self._count("misses")
+            return version, None
+        self._count("hits")
+        etag, body = value.split(b"\n", 1)
+        return version, (etag.decode(), body)
+
+    def put(self, promotion_id, version, selected, etag, body):  # pylint: disable=too-many-arguments
+        """Stores the encoded payload of a promotion read at version"""
+        if not self.enabled or version is None:
+            return
+        try:
+            self.backend.set(
+                self._payload_key(promotion_id, version, selected),
+                etag.encode() + b"\n" + body,
+                self.ttl,
+            )
+        except self.backend.errors as error:
+            logger.warning("Payload cache write failed: %s", error)
+            self._count("errors")
+            return
+        self._count("stores")
+
+    def bump(self, *promotion_ids):
+        """Moves promotions to a new version, for every worker sharing the backend"""
+        if not self.enabled:
+            return
+        for promotion_id in promotion_ids:
+            try:
+                self.backend.incr(self._version_key(promotion_id), self.version_ttl)
+            except self.backend.errors as error:
+                logger.error("Payload cache invalidation of promotion %s failed: %s", promotion_id, error)
+                self._count("errors")
+            else:
+                self._count("bumps")
+
+    def reset_stats(self):
+        """Sets the counters back to zero"""
+        with self._lock:
+            self._stats = dict.fromkeys(("hits", "misses", "stores", "bumps", "errors"), 0)
+
+    def stats(self):
+        """Returns the counters of this worker and its hit ratio"""
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        return stats
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _version_key(self, promotion_id):
+        return f"{self.PREFIX}:{promotion_id}:version"
+
+    def _payload_key(self, promotion_id, version, selected):
+        variant = zlib.crc32(",".join(selected).encode())
+        return f"{self.PREFIX}:{promotion_id}:{version}:{variant:08x}"
@@ -1,8 +1,21 @@
 """
 Flask CLI Command Extensions
 """
+import re
+import time
+
+import click
 from service import app
-from service.models import db
+from service.bulk import (
+    CHUNK_SIZE,
+    FORMATS,
+    BackgroundWriter,
+    export_promotions,
+    file_format,
+    import_promotions,
+    open_records,
+)
+from service.models import db, Promotion
 
 
 ######################################################################
@@ -19,3 +32,215 @@ def db_create():
     db.drop_all()
     db.create_all()
     db.session.commit()
+
+
+######################################################################
+# Command to check that the finders are served by indexes
+# Usage:
+#   flask promotions-explain [--seed 10000000]
+######################################################################
+# an index scan node of a plan, with the name of its index
+INDEX_SCAN = re.compile(r"Index (?:Only )?Scan (?:using|on) (\w+)")
+
+# the page size unselective finders are read with
+EXPLAIN_PAGE_SIZE = 100
+
+# rows generated by --seed: ~10 years of promotions lasting up to two months,
+# a name shared by about 100 rows and 5 promotion types, the last one rare
+SEED_PROMOTIONS = """
+INSERT INTO promotion (code, name, start, expired, available, whole_store,
+                       promo_type, value, counter_shards, version, revision, created_at, updated_at)
+SELECT 'explain-' || n,
+       'Promotion ' || (n % GREATEST(:rows / 100, 1)),
+       CURRENT_DATE - (n % 3650),
+       CURRENT_DATE - (n % 3650) + (n % 61),
+       n % 101,
+       n % 50 = 0,
+       CASE WHEN n % 100 = 0 THEN 5 ELSE 1 + n % 4 END,
+       n % 90,
+       0,
+       1,
+       1,
+       CURRENT_DATE,
+       CURRENT_DATE
+FROM generate_series(1, :rows) AS n
+"""
+
+
+def explain(query):
+    """Returns the plan of a query as text"""
+    sql = query.statement.compile(
+        dialect=db.engine.dialect, compile_kwargs={"literal_binds": True}
+    )
+    return "\n".join(db.session.execute(db.text(f"EXPLAIN {sql}")).scalars())
+
+
+def explain_finders():
+    """Returns the label, access path, expected index and plan of every Promotion finder
+
+    A finder matching a large share of the table is rightly read with a
+    sequential scan, so its first page in id order is explained instead,
+    which its index must still serve. The parameters are taken from an
+    existing row so that the plans are the ones of real lookups, and the
+    promo_type is the rarest one: a common type is rightly read in id order.
+    """
+    sample = Promotion.query.order_by(Promotion.id.desc()).first()
+    if sample is None:
+        return []
+    promo_type = db.session.scalars(
+        db.select(Promotion.promo_type).group_by(Promotion.promo_type).order_by(db.func.count()).limit(1)
+    ).one()
+    # (label, query, the index that must serve it, whether it is paged)
+    finders = [
+        ("find", Promotion.query.filter(Promotion.id == sample.id), "promotion_pkey", False),
+        ("find_by_code", Promotion.find_by_code(sample.code), "promotion_code_key", False),
+        ("find_by_name", Promotion.find_by_name(sample.name), "ix_promotion_name_id", False),
+        ("find_by_promo_type", Promotion.find_by_promo_type(promo_type), "ix_promotion_promo_type_id", True),
+        ("find_active", Promotion.find_active(), "ix_promotion_active_window", False),
+    ]
+    plans = []
+    for label, query, index, paged in finders:
+        if paged:
+            query = query.order_by(Promotion.id).limit(EXPLAIN_PAGE_SIZE)
+        plans.append((label, "first page" if paged else "all rows", index, explain(query)))
+    return plans
+
+
+def uses_index(plan, index):
+    """Returns True if a plan reads through `index` and scans no table sequentially"""
+    return "Seq Scan" not in plan and index in INDEX_SCAN.findall(plan)
+
+
+@app.cli.command("promotions-explain")
+@click.option(
+    "--seed",
+    "rows",
+    type=click.IntRange(min=0),
+    default=0,
+    help="Generate this many promotions first; they are rolled back afterwards.",
+)
+def promotions_explain(rows):
+    """
+    Runs EXPLAIN on every Promotion finder and fails unless each one reads
+    through the index meant for it. With --seed, the rows are generated and analyzed in a transaction
+    that is rolled back, so the command can be pointed at a shared database.
+    """
+    try:
+        if rows:
+            click.echo(f"Seeding {rows} promotions...")
+            db.session.execute(db.text(SEED_PROMOTIONS), {"rows": rows})
+            db.session.execute(db.text("ANALYZE promotion"))
+        plans = explain_finders()
+    finally:
+        db.session.rollback()
+
+    if not plans:
+        raise click.ClickException("There are no promotions to explain, use --seed")
+    failed = []
+    for label, path, index, plan in plans:
+        if uses_index(plan, index):
+            click.echo(f"{label} ({path}): index {index}")
+        else:
+            click.echo(f"{label} ({path}): NO INDEX, expected {index}")
+            failed.append(label)
+        click.echo(plan)
+    if failed:
+        raise click.ClickException(f"Finders not using their index: {', '.join(failed)}")
+
+
+######################################################################
+# Command to load promotions and their products from a file
+# Usage:
+#   flask promotions-import promotions.ndjson [--format csv] [--chunk-size 10000]
+######################################################################
+# rejected records echoed, the others are only counted
+MAX_ERRORS_SHOWN = 20
+
+
+@app.cli.command("promotions-import")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--format",
+    "fmt",
+    type=click.Choice(FORMATS),
+    default=None,
+    help="The format of the file; csv for .csv files and ndjson otherwise by default.",
+)
+@click.option(
+    "--chunk-size",
+    type=click.IntRange(min=1),
+    default=CHUNK_SIZE,
+    show_default=True,
+    help="Records checked, loaded and committed at a time.",
+)
+@click.option("--no-copy", is_flag=True, help="Load with executemany instead of PostgreSQL COPY.")
+def promotions_import(path, fmt, chunk_size, no_copy):
+    """
+    Imports promotions and the products bound to them from a CSV or NDJSON
+    file, gzipped or not. The file is streamed and loaded a committed chunk
+    at a time; promotions whose code already exists are skipped, so an
+    interrupted import can be run again. Fails if any record was rejected.
+    """
+    stream, fmt = open_records(path, fmt)
+    started = time.perf_counter()
+    totals, shown = {}, 0
+    with stream:
+        for totals in import_promotions(stream, fmt, chunk_size, use_copy=False if no_copy else None):
+            for line, error in totals["errors"][: MAX_ERRORS_SHOWN - shown]:
+                click.echo(f"line {line}: {error}", err=True)
+            shown = min(shown + len(totals["errors"]), MAX_ERRORS_SHOWN)
+            elapsed = time.perf_counter() - started
+            click.echo(
+                f"{totals['read']} records read, {totals['created']} created, "
+                f"{totals['skipped']} skipped, {totals['rejected']} rejected "
+                f"({totals['read'] / elapsed:.0f} records/s)"
+            )
+    if not totals:
+        raise click.ClickException("There are no records to import")
+    click.echo(
+        f"Imported {totals['created']} promotions and {totals['bindings']} bindings "
+        f"in {time.perf_counter() - started:.1f}s"
+    )
+    if totals["rejected"]:
+        raise click.ClickException(f"{totals['rejected']} records were rejected")
+
+
+######################################################################
+# Command to dump promotions and their products to a file
+# Usage:
+#   flask promotions-export promotions.ndjson.gz [--format csv] [--batch-size 10000]
+######################################################################
+@app.cli.command("promotions-export")
+@click.argument("path", type=click.Path(dir_okay=False, writable=True))
+@click.option(
+    "--format",
+    "fmt",
+    type=click.Choice(FORMATS),
+    default=None,
+    help="The format of the file; csv for .csv files and ndjson otherwise by default.",
+)
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=CHUNK_SIZE,
+    show_default=True,
+    help="Promotions fetched from the server-side cursor and encoded at a time.",
+)
+def promotions_export(path, fmt, batch_size):
+    """
+    Exports every promotion with the ids of its products to a CSV or NDJSON
+    file, gzipped when its name ends with .gz, in a format promotions-import
+    reads. The tables are streamed from a server-side cursor, and the file is
+    compressed and written from another thread while the next batch is encoded.
+    """
+    compressed, fmt = file_format(path, fmt)
+    started = time.perf_counter()
+    totals = {"promotions": 0, "bindings": 0}
+    with BackgroundWriter(path, compressed) as writer:
+        for totals in export_promotions(writer, fmt, batch_size):
+            elapsed = time.perf_counter() - started
+            click.echo(f"{totals['promotions']} promotions written ({totals['promotions'] / elapsed:.0f} promotions/s)")
+    click.echo(
+        f"Exported {totals['promotions']} promotions and {totals['bindings']} bindings "
+        f"in {time.perf_counter() - started:.1f}s"
+    )
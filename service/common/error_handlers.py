@@ -17,9 +17,10 @@
 """
 Module: error_handlers
 """
-from flask import jsonify
+from flask import got_request_exception, jsonify
 # from service.models import DataValidationError, ResourceConflictError
 from service import app
+from service.models import db
 from . import status
 
 
@@ -107,6 +108,17 @@ def method_not_supported(error):
 #     )
 
 
+@got_request_exception.connect_via(app)
+def rollback_session(_sender, **_extra):
+    """Rolls back the session of a request that raised an error
+
+    The app context pushed by init_db() outlives the requests, and with it
+    the session: a statement that failed would leave it in an aborted
+    transaction, and every later request of the worker would fail too.
+    """
+    db.session.rollback()
+
+
 @app.errorhandler(status.HTTP_500_INTERNAL_SERVER_ERROR)
 def internal_server_error(error):
     """Handles unexpected server error with 500_SERVER_ERROR"""
@@ -0,0 +1,46 @@
+"""
+Module: pagination
+
+Keyset pagination helpers: a page starts after the id its cursor carries,
+so reading page N costs the same as reading the first one.
+"""
+import base64
+import binascii
+
+from flask import current_app
+
+# used when the app config does not set the page sizes
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+def encode_cursor(last_id):
+    """Returns the opaque cursor of the page after the row with id last_id"""
+    return base64.urlsafe_b64encode(str(last_id).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Returns the last id a cursor was made from
+
+    Used as a reqparse type, so a ValueError becomes a 400 Bad Request.
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        last_id = int(base64.urlsafe_b64decode(padded.encode()).decode())
+    except (binascii.Error, UnicodeError, ValueError) as error:
+        raise ValueError("The cursor is not valid") from error
+    if last_id < 0:
+        raise ValueError("The cursor is not valid")
+    return last_id
+
+
+def page_size(limit=None):
+    """Returns the number of rows of a page, capped at PAGE_SIZE_MAX"""
+    default = current_app.config.get("PAGE_SIZE", DEFAULT_PAGE_SIZE)
+    cap = current_app.config.get("PAGE_SIZE_MAX", MAX_PAGE_SIZE)
+    return min(limit or default, cap)
+
+
+def next_link(url):
+    """Returns the value of a Link header pointing to the next page"""
+    return f'<{url}>; rel="next"'
@@ -12,5 +12,59 @@ DATABASE_URI = os.getenv(
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Connection pool of each worker process, which holds up to
+# DATABASE_POOL_SIZE + DATABASE_MAX_OVERFLOW connections, see service.pool
+DATABASE_POOL_SIZE = int(os.getenv("DATABASE_POOL_SIZE", "5"))
+DATABASE_MAX_OVERFLOW = int(os.getenv("DATABASE_MAX_OVERFLOW", "10"))
+# Seconds a request waits for a connection before failing
+DATABASE_POOL_TIMEOUT = float(os.getenv("DATABASE_POOL_TIMEOUT", "30"))
+# Seconds after which a connection is replaced, -1 keeps them; keep it under the idle timeouts of proxies
+DATABASE_POOL_RECYCLE = int(os.getenv("DATABASE_POOL_RECYCLE", "1800"))
+# Checks each connection with a round trip when it is taken from the pool, so a restarted database is not an error
+DATABASE_POOL_PRE_PING = os.getenv("DATABASE_POOL_PRE_PING", "true").lower() in ("true", "1", "yes")
+# Executions after which psycopg prepares a query on the server; empty never prepares,
+# which PgBouncer in transaction pooling mode needs
+DATABASE_PREPARE_THRESHOLD = os.getenv("DATABASE_PREPARE_THRESHOLD", "5")
+
+SQLALCHEMY_ENGINE_OPTIONS = {
+    "pool_size": DATABASE_POOL_SIZE,
+    "max_overflow": DATABASE_MAX_OVERFLOW,
+    "pool_timeout": DATABASE_POOL_TIMEOUT,
+    "pool_recycle": DATABASE_POOL_RECYCLE,
+    "pool_pre_ping": DATABASE_POOL_PRE_PING,
+}
+if DATABASE_URI.startswith("postgresql+psycopg://"):
+    SQLALCHEMY_ENGINE_OPTIONS["connect_args"] = {
+        "prepare_threshold": int(DATABASE_PREPARE_THRESHOLD) if DATABASE_PREPARE_THRESHOLD else None
+    }
+
+# Uses of a promotion each worker leases at a time when applying it,
+# 0 applies every use directly against the database
+PROMOTION_LEASE_SIZE = int(os.getenv("PROMOTION_LEASE_SIZE", "0"))
+# Seconds after which unused leased uses are given back
+PROMOTION_LEASE_TTL = float(os.getenv("PROMOTION_LEASE_TTL", "30"))
+
+# In-process cache of promotion and product snapshots, see models.SnapshotCache
+PROMOTION_CACHE_ENABLED = os.getenv("PROMOTION_CACHE_ENABLED", "true").lower() in ("true", "1", "yes")
+PROMOTION_CACHE_SIZE = int(os.getenv("PROMOTION_CACHE_SIZE", "1024"))
+# Seconds a snapshot is served for, also how long changes made by other workers can go unseen
+PROMOTION_CACHE_TTL = float(os.getenv("PROMOTION_CACHE_TTL", "5"))
+# Pages of list results kept per finder, served until any promotion changes
+PROMOTION_QUERY_CACHE_SIZE = int(os.getenv("PROMOTION_QUERY_CACHE_SIZE", "128"))
+# Promotions kept compiled for cart pricing, see pricing.EvaluatorCache
+PROMOTION_EVALUATOR_CACHE_SIZE = int(os.getenv("PROMOTION_EVALUATOR_CACHE_SIZE", "4096"))
+
+# Cache of encoded promotion payloads shared by the workers, see common.cache:
+# memory:// keeps it in each worker, redis://host:6379/0 shares it, empty turns it off
+PROMOTION_PAYLOAD_CACHE_URL = os.getenv("PROMOTION_PAYLOAD_CACHE_URL", "memory://")
+# Seconds a payload is kept; a memory:// cache can serve other workers' changes that late
+PROMOTION_PAYLOAD_CACHE_TTL = float(os.getenv("PROMOTION_PAYLOAD_CACHE_TTL", "5"))
+# Seconds the version of a promotion is kept once neither read nor bumped; longer than the payloads
+PROMOTION_PAYLOAD_VERSION_TTL = float(os.getenv("PROMOTION_PAYLOAD_VERSION_TTL", "3600"))
+
+# Rows returned by a list endpoint when no limit is given, and the largest limit
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", "100"))
+PAGE_SIZE_MAX = int(os.getenv("PAGE_SIZE_MAX", "1000"))
+
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "pgs3cr3t")
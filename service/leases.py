@@ -0,0 +1,305 @@
+"""
+Worker-local quota leases for applying promotions
+
+Every apply is a database write, even with the atomic UPDATE in
+Promotion.redeem(). When PROMOTION_LEASE_SIZE is set, each worker process
+instead takes a block of that many uses out of Promotion.available in one
+write and hands them out from memory, returning whatever is left when the
+lease expires or when the worker shuts down.
+
+Guarantees:
+  * a promotion is never oversold: leased uses are removed from the
+    database before they are handed out
+  * a lease is bound to the revision of its promotion: once the promotion
+    is updated or cancelled, by any worker, the lease hands out nothing
+    more and its unused uses are dropped instead of given back
+  * at most PROMOTION_LEASE_SIZE uses per promotion are held by a worker,
+    so at most (workers * PROMOTION_LEASE_SIZE) uses can look unavailable
+    in the database while still being redeemable
+  * unused uses go back after PROMOTION_LEASE_TTL seconds at the latest,
+    except when a worker is killed before it can return them: a reaper
+    thread releases expired leases even when the worker gets no more applies
+"""
+import atexit
+import threading
+import time
+from datetime import date
+
+from service.models import db, Promotion, commit_changes
+
+
+class QuotaLease:  # pylint: disable=too-few-public-methods
+    """A block of uses of one promotion held by this worker"""
+
+    __slots__ = ("promotion_id", "revision", "remaining", "start", "expired", "expires_at")
+
+    def __init__(self, promotion_id, revision, remaining, start, expired, expires_at):  # pylint: disable=too-many-arguments
+        self.promotion_id = promotion_id
+        # the revision of the promotion the uses were leased from
+        self.revision = revision
+        self.remaining = remaining
+        self.start = start
+        self.expired = expired
+        self.expires_at = expires_at
+
+    def usable(self, today, now):
+        """Returns True if a use can still be handed out from this lease"""
+        return (
+            self.remaining > 0
+            and now < self.expires_at
+            and self.start <= today <= self.expired
+        )
+
+
+class QuotaLeases:  # pylint: disable=too-many-instance-attributes
+    """Hands out promotion uses from blocks leased out of Promotion.available"""
+
+    def __init__(self, size=0, ttl=30.0):
+        self.app = None
+        self.size = size
+        self.ttl = ttl
+        self._leases = {}
+        self._lock = threading.Lock()
+        self._reaper = None
+        self._stopped = threading.Event()
+        self._stats = dict.fromkeys(
+            ("applies", "db_writes", "leases_acquired", "leases_released", "leases_revoked", "uses_returned"),
+            0,
+        )
+
+    def init_app(self, app):
+        """Reads the lease settings and returns the leases when the worker exits"""
+        self.app = app
+        self.size = app.config.get("PROMOTION_LEASE_SIZE", 0)
+        self.ttl = app.config.get("PROMOTION_LEASE_TTL", 30.0)
+        atexit.register(self.shutdown)
+
+    @property
+    def enabled(self):
+        """True when applies are served from leases"""
+        return self.size > 0
+
+    def redeem(self, promotion_id):
+        """Consumes one use of a promotion, from a lease when leasing is enabled
+
+        The lock only guards the leases in memory: the database is read and
+        written without it, so that applies of other promotions, or of the
+        same one from a valid lease, never wait on that I/O.
+
+        Returns:
+            int: the uses left as far as this worker knows, or None if there is
+            no such promotion
+
+        Raises:
+            PromotionNotApplicableError: the promotion is expired, inactive or used up
+        """
+        if not self.enabled:
+            return Promotion.redeem(promotion_id)
+
+        today, now = date.today(), time.monotonic()
+        with self._lock:
+            expired = self._pop_expired(now)
+            lease = self._leases.get(promotion_id)
+            if lease is not None and not lease.usable(today, now):
+                expired.append(self._leases.pop(promotion_id))
+                lease = None
+
+        # a lease is only used while its promotion is at the revision it was leased at
+        if lease is not None and self._revision(promotion_id) != lease.revision:
+            self._revoke(lease)
+            lease = None
+        remaining = self._take(lease) if lease is not None else None
+        if remaining is None:
+            lease = self._acquire(promotion_id, today, now)
+            if lease is not None:
+                expired.append(self._install(lease))
+                remaining = self._take(lease)
+        for stale in expired:
+            self._release(stale)
+        if remaining is not None:
+            return remaining
+
+        # sharded, missing or not applicable: let the model decide
+        remaining = Promotion.redeem(promotion_id)
+        with self._lock:
+            self._stats["applies"] += 1
+            self._stats["db_writes"] += 1
+        return remaining
+
+    def discard(self, promotion_id):
+        """Forgets the lease on a promotion without giving its uses back
+
+        Used when the promotion was cancelled or deleted by this worker.
+        """
+        with self._lock:
+            self._leases.pop(promotion_id, None)
+
+    def release_all(self):
+        """Returns the unused uses of every lease to the database"""
+        with self._lock:
+            held = list(self._leases.values())
+            self._leases.clear()
+        for lease in held:
+            self._release(lease)
+
+    def shutdown(self):
+        """Stops the reaper and returns every lease from an application context at exit"""
+        self._stopped.set()
+        if self.app is None or not self._leases:
+            return
+        with self.app.app_context():
+            self.release_all()
+            db.session.remove()
+
+    def stats(self):
+        """Returns the lease counters and the database writes saved per apply"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["active_leases"] = len(self._leases)
+            stats["leased_uses"] = sum(lease.remaining for lease in self._leases.values())
+        applies = stats["applies"]
+        stats["db_writes_saved_per_apply"] = (
+            round(1 - stats["db_writes"] / applies, 4) if applies else 0.0
+        )
+        return stats
+
+    ######################################################################
+    #  P R I V A T E   M E T H O D S
+    ######################################################################
+
+    def _take(self, lease):
+        """Hands out one use of a lease still held, returning the uses left or None"""
+        with self._lock:
+            if self._leases.get(lease.promotion_id) is not lease or lease.remaining <= 0:
+                return None
+            lease.remaining -= 1
+            self._stats["applies"] += 1
+            return lease.remaining
+
+    def _install(self, lease):
+        """Holds a new lease, returning the lease it replaces, if any, to be released"""
+        with self._lock:
+            previous = self._leases.get(lease.promotion_id)
+            self._leases[lease.promotion_id] = lease
+            self._start_reaper()
+        return previous
+
+    def _start_reaper(self):
+        """Starts the thread releasing expired leases, unless it runs (lock held)
+
+        Started with the first lease rather than with the app, so that every
+        worker forked from a preloaded app runs its own.
+        """
+        if self.app is None or self._stopped.is_set() or (self._reaper is not None and self._reaper.is_alive()):
+            return
+        self._reaper = threading.Thread(target=self._reap, name="promotion-lease-reaper", daemon=True)
+        self._reaper.start()
+
+    def _next_expiry(self):
+        """Returns the seconds until the next lease expires, or the time to live without leases"""
+        with self._lock:
+            expires_at = min((lease.expires_at for lease in self._leases.values()), default=None)
+        return self.ttl if expires_at is None else max(expires_at - time.monotonic(), 0.0)
+
+    def _reap(self):
+        """Releases the leases whose time to live ran out, until shutdown"""
+        while not self._stopped.wait(self._next_expiry()):
+            with self._lock:
+                expired = self._pop_expired(time.monotonic())
+            if not expired:
+                continue
+            with self.app.app_context():
+                try:
+                    for lease in expired:
+                        self._release(lease)
+                except Exception:  # pylint: disable=broad-exception-caught
+                    # the uses left in memory are lost, like those of a killed worker
+                    self.app.logger.exception("Could not release %d expired leases", len(expired))
+                finally:
+                    db.session.remove()
+
+    def _pop_expired(self, now):
+        """Stops holding the leases whose time to live has run out, and returns them (lock held)"""
+        expired = [promotion_id for promotion_id, lease in self._leases.items() if now >= lease.expires_at]
+        return [self._leases.pop(promotion_id) for promotion_id in expired]
+
+    @staticmethod
+    def _revision(promotion_id):
+        """Returns the current revision of a promotion, or None if it was deleted"""
+        return db.session.execute(
+            db.select(Promotion.revision).where(Promotion.id == promotion_id)
+        ).scalar_one_or_none()
+
+    def _revoke(self, lease):
+        """Drops a lease whose promotion changed, without giving its uses back"""
+        with self._lock:
+            if self._leases.get(lease.promotion_id) is lease:
+                del self._leases[lease.promotion_id]
+            self._stats["leases_revoked"] += 1
+
+    def _acquire(self, promotion_id, today, now):
+        """Takes up to `size` uses of a promotion out of the database"""
+        row = db.session.execute(
+            db.select(Promotion.available, Promotion.revision, Promotion.start, Promotion.expired)
+            .where(
+                Promotion.id == promotion_id,
+                Promotion.counter_shards == 0,
+                Promotion.available > 0,
+                Promotion.start <= today,
+                Promotion.expired >= today,
+            )
+            .with_for_update()
+        ).first()
+        if row is None:
+            db.session.rollback()
+            return None
+        granted = min(row.available, self.size)
+        table = Promotion.__table__
+        db.session.execute(
+            db.update(table)
+            .where(table.c.id == promotion_id)
+            .values(available=table.c.available - granted, version=table.c.version + 1)
+        )
+        commit_changes()
+        Promotion.forget(promotion_id)
+        with self._lock:
+            self._stats["db_writes"] += 1
+            self._stats["leases_acquired"] += 1
+        return QuotaLease(promotion_id, row.revision, granted, row.start, row.expired, now + self.ttl)
+
+    def _release(self, lease):
+        """Gives the unused uses of a lease back to its promotion
+
+        Only while the promotion is at the revision the uses were leased at:
+        once it was updated or cancelled, `available` is what was set then.
+        """
+        if lease is None:
+            return
+        returned = False
+        if lease.remaining > 0:
+            table = Promotion.__table__
+            returned = db.session.execute(
+                db.update(table)
+                .where(
+                    table.c.id == lease.promotion_id,
+                    table.c.revision == lease.revision,
+                    table.c.expired >= date.today(),
+                )
+                .values(available=table.c.available + lease.remaining, version=table.c.version + 1)
+            ).rowcount > 0
+            if returned:
+                commit_changes()
+                Promotion.forget(lease.promotion_id)
+            else:
+                db.session.rollback()
+        with self._lock:
+            self._stats["leases_released"] += 1
+            if returned:
+                self._stats["db_writes"] += 1
+                self._stats["uses_returned"] += lease.remaining
+            elif lease.remaining > 0:
+                self._stats["leases_revoked"] += 1
+
+
+# The leases of this worker process, initialized with the app
+leases = QuotaLeases()
@@ -3,30 +3,357 @@ Models for PromotionModel
 
 All of the models are stored in this module
 """
+# pylint: disable=too-many-lines
+from collections import OrderedDict
 from datetime import date
+from itertools import islice
+from types import MappingProxyType
 import logging
+import threading
+import time
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects import postgresql
+from service.common.cache import PayloadCache
 
 logger = logging.getLogger("flask.app")
 
 # Create the SQLAlchemy object to be initialized later in init_db()
 db = SQLAlchemy()
 
+# the largest value of an Integer column, a PostgreSQL int4
+MAX_INTEGER = 2**31 - 1
+
 # Relationship table for promotion and product
+# One row per binding, looked up by promotion through the primary key and by
+# product through its own index. Rows go away with either side in the database.
 promotion_product = db.Table(
     "promotion_product",
-    db.Column("promotion_id", db.Integer, db.ForeignKey("promotion.id")),
-    db.Column("product_id", db.Integer, db.ForeignKey("product.id")),
+    db.Column(
+        "promotion_id",
+        db.Integer,
+        db.ForeignKey("promotion.id", ondelete="CASCADE"),
+        primary_key=True,
+    ),
+    db.Column(
+        "product_id",
+        db.Integer,
+        db.ForeignKey("product.id", ondelete="CASCADE"),
+        primary_key=True,
+    ),
     db.Column("created_at", db.Date, nullable=False, default=db.func.now()),
     db.Column("updated_at", db.Date, nullable=False, default=db.func.now()),
+    db.Index("ix_promotion_product_product_id", "product_id"),
 )
 
 
+def _product_id_list(product_ids):
+    """Turns one product id or a list of them into a list of distinct ints
+
+    Raises:
+        DataValidationError: an id is not an integer from 0, which the bind
+        route has always accepted, to MAX_INTEGER
+    """
+    if product_ids is None:
+        return []
+    if not isinstance(product_ids, list):
+        product_ids = [product_ids]
+    try:
+        ids = list(dict.fromkeys(int(product_id) for product_id in product_ids))
+    except (TypeError, ValueError) as error:
+        raise DataValidationError(f"Invalid product id: {error}") from error
+    for product_id in ids:
+        if not 0 <= product_id <= MAX_INTEGER:
+            raise DataValidationError(f"Invalid product id: {product_id} is not between 0 and {MAX_INTEGER}")
+    return ids
+
+
+def _binding(promotion_id, product_id):
+    """Returns the condition matching one promotion_product row"""
+    return db.and_(
+        promotion_product.c.promotion_id == promotion_id,
+        promotion_product.c.product_id == product_id,
+    )
+
+
+def _is_bound(promotion_id, product_id):
+    """Returns True if the product is bound to the promotion"""
+    return db.session.execute(
+        db.select(db.exists().where(_binding(promotion_id, product_id)))
+    ).scalar()
+
+
+def _unbind(promotion_id, product_id):
+    """Deletes one binding and returns the number of rows removed"""
+    return db.session.execute(
+        promotion_product.delete().where(_binding(promotion_id, product_id))
+    ).rowcount
+
+
+def _delete_bindings(promotion_id, product_ids, keep=False):
+    """Deletes the bindings of a promotion to the products, or to all the others when `keep`
+
+    Returns:
+        int: the number of bindings removed
+    """
+    ids = _id_array(product_ids)
+    if keep:
+        matches = promotion_product.c.product_id != db.func.all(ids)
+    else:
+        matches = promotion_product.c.product_id == db.func.any(ids)
+    return db.session.execute(
+        promotion_product.delete().where(promotion_product.c.promotion_id == promotion_id, matches)
+    ).rowcount
+
+
+def _insert_bindings(promotion_id, product_ids):
+    """Binds existing products to a promotion, skipping the bound ones
+
+    Returns:
+        int: the number of new bindings
+    """
+    new = db.func.unnest(_id_array(product_ids)).table_valued("product_id").render_derived()
+    inserted = (
+        postgresql.insert(promotion_product)
+        .from_select(
+            ["promotion_id", "product_id"],
+            # the bound products are filtered out before the insert, which is
+            # cheaper than letting each one conflict
+            db.select(db.literal(promotion_id), new.c.product_id).where(
+                ~db.exists().where(_binding(promotion_id, new.c.product_id))
+            ),
+        )
+        .on_conflict_do_nothing()
+        .returning(promotion_product.c.product_id)
+        .cte("inserted")
+    )
+    # INSERT ... SELECT does not report a row count, so count RETURNING
+    return db.session.execute(
+        db.select(db.func.count()).select_from(inserted)
+    ).scalar_one()
+
+
+def _shard_rows(promotion_id, counter_shards, total):
+    """Returns the PromotionCounter rows spreading `total` uses evenly over the shards"""
+    share, remainder = divmod(max(total, 0), counter_shards)
+    return [
+        {
+            "promotion_id": promotion_id,
+            "shard": shard,
+            "available": share + (1 if shard < remainder else 0),
+        }
+        for shard in range(counter_shards)
+    ]
+
+
+def _id_array(ids):
+    """Binds a list of ids as one array parameter, whatever its length
+
+    The ids are sent as the text of an array literal: the driver adapts a
+    list one element at a time, which takes most of a second for 100k ids.
+
+    Raises:
+        DataValidationError: an id is out of the range of an integer column
+    """
+    values = [int(value) for value in ids]
+    if values and (min(values) < -MAX_INTEGER - 1 or max(values) > MAX_INTEGER):
+        raise DataValidationError(f"Invalid id: the ids must be between {-MAX_INTEGER - 1} and {MAX_INTEGER}")
+    text = "{" + ",".join(map(str, values)) + "}"
+    return db.cast(db.literal(text, db.types.NullType()), postgresql.ARRAY(db.Integer))
+
+
+# Change counter of the promotions, advanced by every transaction that changes
+# a promotion, its products or its uses left. Collections are tagged with it.
+promotion_generation = db.Sequence("promotion_generation", metadata=db.metadata)
+
+
+def commit_changes():
+    """Commits the session, then advances the promotion generation
+
+    The generation moves on only once the change is visible, so anyone who
+    reads the new generation before reading the promotions also reads the
+    change, and a page read before the commit is never cached under the new
+    generation. nextval() is not transactional, so it runs alone in
+    autocommit mode, one round trip without BEGIN or COMMIT.
+    """
+    db.session.commit()
+    # nothing to advance on databases without sequences, such as SQLite
+    if not db.engine.dialect.supports_sequences:
+        return
+    with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(db.select(promotion_generation.next_value()))
+
+
+def _touch_promotions(*criteria):
+    """Bumps the version of the promotions matching the criteria, without committing
+
+    Returns:
+        list: the ids of the promotions touched, to forget once committed
+    """
+    return db.session.scalars(
+        db.update(Promotion)
+        .where(*criteria)
+        .values(version=Promotion.version + 1)
+        .returning(Promotion.id)
+        .execution_options(synchronize_session=False)
+    ).all()
+
+
+class SnapshotCache:
+    """A bounded, thread safe LRU cache of read-only snapshots with a time to live
+
+    Misses are cached too, as None, so that repeated lookups of unknown ids
+    or codes do not reach the database either. Entries are dropped by the
+    invalidation hooks of the models as soon as this process changes them;
+    changes made by other processes show after `ttl` seconds at the latest.
+    """
+
+    def __init__(self, size=1024, ttl=5.0, enabled=True):
+        self.size = size
+        self.ttl = ttl
+        self.enabled = enabled
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # bumped by every invalidation, so that a value loaded meanwhile is not stored
+        self._epoch = 0
+        self._stats = {}
+        self.clear()
+
+    def init_app(self, app):
+        """Reads the cache settings"""
+        self.enabled = app.config.get("PROMOTION_CACHE_ENABLED", True)
+        self.size = app.config.get("PROMOTION_CACHE_SIZE", 1024)
+        self.ttl = app.config.get("PROMOTION_CACHE_TTL", 5.0)
+        self.clear()
+
+    def get(self, key, load):
+        """Returns the value cached for key, storing what load() returns on a miss"""
+        if not self.enabled:
+            return load()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if now < expires_at:
+                    self._entries.move_to_end(key)
+                    self._stats["hits"] += 1
+                    if value is None:
+                        self._stats["negative_hits"] += 1
+                    return value
+                del self._entries[key]
+                self._stats["expirations"] += 1
+            self._stats["misses"] += 1
+            epoch = self._epoch
+
+        value = load()
+        with self._lock:
+            if epoch == self._epoch:
+                self._entries[key] = (now + self.ttl, value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+                    self._stats["evictions"] += 1
+        return value
+
+    def invalidate(self, *keys):
+        """Drops the entries of the given keys"""
+        with self._lock:
+            self._epoch += 1
+            for key in keys:
+                if self._entries.pop(key, None) is not None:
+                    self._stats["invalidations"] += 1
+
+    def clear(self):
+        """Drops every entry and resets the counters"""
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+            self._stats = dict.fromkeys(
+                ("hits", "negative_hits", "misses", "evictions", "expirations", "invalidations"),
+                0,
+            )
+
+    def stats(self):
+        """Returns the cache counters and the number of entries"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        return stats
+
+
+# The snapshots of promotions and products of this process, set up by init_db()
+snapshots = SnapshotCache()
+
+
+class QueryCache:
+    """Pages of finder results, one LRU cache per finder
+
+    Pages are keyed by the promotion generation they were read at, see
+    commit_changes(), so any committed change makes every page miss without
+    tracking which pages it affects; pages of old generations are evicted
+    as the cache fills.
+    """
+
+    FINDERS = ("all", "find_by_name", "find_by_code", "find_by_promo_type")
+
+    def __init__(self, size=128, enabled=True):
+        self.caches = {
+            finder: SnapshotCache(size, ttl=float("inf"), enabled=enabled) for finder in self.FINDERS
+        }
+
+    def init_app(self, app):
+        """Reads the cache settings"""
+        for cache in self.caches.values():
+            cache.enabled = app.config.get("PROMOTION_CACHE_ENABLED", True)
+            cache.size = app.config.get("PROMOTION_QUERY_CACHE_SIZE", 128)
+        self.clear()
+
+    def get(self, finder, args, generation, load):
+        """Returns the page of a finder for its normalized arguments at a generation"""
+        return self.caches[finder].get((args, generation), load)
+
+    def clear(self):
+        """Drops every page and resets the counters"""
+        for cache in self.caches.values():
+            cache.clear()
+
+    def stats(self):
+        """Returns the counters of each finder"""
+        return {finder: cache.stats() for finder, cache in self.caches.items()}
+
+
+# The finder pages of this process, set up by init_db()
+queries = QueryCache()
+
+# The encoded promotion payloads shared by the workers, set up by init_db()
+payloads = PayloadCache()
+
+
+def _invalidate(*keys):
+    """Drops cached snapshots, and moves the promotions among them to a new payload version"""
+    snapshots.invalidate(*keys)
+    payloads.bump(*[key[1] for key in keys if key[0] == "promotion"])
+
+
+def _snapshot(row):
+    """Returns an immutable copy of the column values of a model, or None"""
+    if row is None:
+        return None
+    return MappingProxyType(
+        {column.key: getattr(row, column.key) for column in row.__table__.columns}
+    )
+
+
 # Function to initialize the database
 def init_db(app):
     """Initializes the SQLAlchemy app"""
     Promotion.init_db(app)
     Product.init_db(app)
+    snapshots.init_app(app)
+    queries.init_app(app)
+    payloads.init_app(app)
 
 
 class DataValidationError(Exception):
@@ -37,13 +364,39 @@ class ResourceConflictError(Exception):
     """Used for the resource already exist"""
 
 
-class Promotion(db.Model):  # pylint: disable=too-many-instance-attributes
+class PromotionNotApplicableError(Exception):
+    """Used when an existing promotion cannot be applied"""
+
+
+class Promotion(db.Model):  # pylint: disable=too-many-instance-attributes, too-many-public-methods
     """
     Class that represents a PromotionModel
     """
 
     app = None
 
+    # the keys of the serialized representation
+    FIELDS = (
+        "id",
+        "name",
+        "code",
+        "start",
+        "expired",
+        "whole_store",
+        "promo_type",
+        "value",
+        "products",
+        "product_count",
+        "created_at",
+        "updated_at",
+        "available",
+        "counter_shards",
+    )
+    # the product ids are left out, a promotion can have any number of them
+    DEFAULT_FIELDS = tuple(field for field in FIELDS if field != "products")
+    # a promotion_counter row is inserted per shard, more would only slow down reads
+    MAX_COUNTER_SHARDS = 64
+
     # Table Schema
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     code = db.Column(db.String(36), unique=True, nullable=False)
@@ -54,13 +407,24 @@ class Promotion(db.Model):  # pylint: disable=too-many-instance-attributes
     whole_store = db.Column(db.Boolean, nullable=False, default=False)
     promo_type = db.Column(db.Integer, nullable=False)
     value = db.Column(db.Double, nullable=False, default=0.0)
+    # number of PromotionCounter rows holding `available`, 0 means unsharded
+    counter_shards = db.Column(db.Integer, nullable=False, default=0)
+    # incremented by every change of the representation, for the entity tag;
+    # the uses left of sharded promotions change without it
+    version = db.Column(db.Integer, nullable=False, default=1)
+    # incremented only by update() and invalidate(), the changes of the
+    # promotion itself, unlike `version` which every use and binding moves
+    revision = db.Column(db.Integer, nullable=False, default=1)
 
     # Relationships
+    # dynamic, so that membership checks never load the whole collection,
+    # and bindings are deleted by ON DELETE CASCADE without being loaded
     products = db.relationship(
         "Product",
         secondary=promotion_product,
-        backref="promotions",
-        cascade="all, delete",
+        backref=db.backref("promotions", lazy="dynamic", passive_deletes=True),
+        lazy="dynamic",
+        passive_deletes=True,
     )
     created_at = db.Column(db.Date, nullable=False, default=db.func.current_timestamp())
     updated_at = db.Column(
@@ -70,6 +434,22 @@ class Promotion(db.Model):  # pylint: disable=too-many-instance-attributes
         onupdate=db.func.current_timestamp(),
     )
 
+    # Indexes for the finders; `code` already has the one of its unique constraint.
+    # The finders are paged by id, so the lookups lead with the filtered column.
+    # The active window cannot contain today's date, so the partial index keeps
+    # the rows with uses left, ordered by end date: expired promotions, the bulk
+    # of a large table, are skipped by the range on `expired`.
+    __table_args__ = (
+        db.Index("ix_promotion_name_id", name, id),
+        db.Index("ix_promotion_promo_type_id", promo_type, id),
+        db.Index(
+            "ix_promotion_active_window",
+            expired,
+            start,
+            postgresql_where=available > 0,
+        ),
+    )
+
     def __repr__(self):
         return f"<PromotionModel {self.name} id=[{self.id}]>"
 
@@ -84,6 +464,127 @@ class Promotion(db.Model):  # pylint: disable=too-many-instance-attributes
             raise DataValidationError("code attribute is not set")
         if Promotion.find_by_code(self.code).count() > 0:
             raise ResourceConflictError("code already exist")
+        self._check_new()
+        ids = _product_id_list(product_ids)
+
+        db.session.add(self)
+        db.session.flush()
+        _, created = self._bind_products(ids)
+        self._create_counter_shards()
+        # drop the cached misses of the new id, code and products
+        keys = [("promotion", self.id), ("promotion_code", self.code)] + created
+        commit_changes()
+        _invalidate(*keys)
+
+    # the columns given by the creator of a promotion
+    CREATE_COLUMNS = (
+        "code",
+        "name",
+        "start",
+        "expired",
+        "available",
+        "whole_store",
+        "promo_type",
+        "value",
+        "counter_shards",
+    )
+    # the integer columns of CREATE_COLUMNS, checked against the range of PostgreSQL integer
+    INTEGER_COLUMNS = ("available", "promo_type", "counter_shards")
+
+    @classmethod
+    def create_all(cls, promotions):
+        """Creates many PromotionModels with a few statements in one transaction
+
+        The codes are checked against the table with one query, and the valid
+        promotions are added with multi-row INSERTs, their counter shards with
+        more of them. Invalid promotions are left out and reported.
+
+        Args:
+            promotions (list): the deserialized PromotionModels, not added to the session
+
+        Returns:
+            list: the id and code of each promotion, or its code and error
+        """
+        cls.app.logger.info("Creating %d promotions", len(promotions))
+        results = [cls._check_batch_item(promotion) for promotion in promotions]
+        codes = [result["code"] for result in results if "error" not in result]
+        existing = set(db.session.scalars(db.select(cls.code).where(cls.code.in_(codes)))) if codes else set()
+        seen = set()
+        for result in results:
+            if "error" in result:
+                continue
+            if result["code"] in existing or result["code"] in seen:
+                result["error"] = "code already exist"
+            else:
+                seen.add(result["code"])
+
+        valid = [promotion for promotion, result in zip(promotions, results) if "error" not in result]
+        if not valid:
+            db.session.rollback()
+            return results
+        # one cached statement, sent as multi-row INSERTs by executemany; ON
+        # CONFLICT, so that a code created meanwhile leaves out only its promotion
+        table = cls.__table__
+        ids = dict(
+            db.session.execute(
+                postgresql.insert(table)
+                .on_conflict_do_nothing(index_elements=[table.c.code])
+                .returning(table.c.code, table.c.id),
+                [{column: getattr(promotion, column) for column in cls.CREATE_COLUMNS} for promotion in valid],
+            ).all()
+        )
+        shards = [
+            row
+            for promotion in valid
+            if promotion.counter_shards and promotion.code in ids
+            for row in _shard_rows(ids[promotion.code], promotion.counter_shards, promotion.available)
+        ]
+        if shards:
+            db.session.execute(db.insert(PromotionCounter), shards)
+        commit_changes()
+        # drop the cached misses of the new ids and codes
+        _invalidate(
+            *[key for code, promotion_id in ids.items() for key in (("promotion", promotion_id), ("promotion_code", code))]
+        )
+
+        for result in results:
+            if "error" in result:
+                continue
+            if result["code"] in ids:
+                result["id"] = ids[result["code"]]
+            else:
+                result["error"] = "code already exist"
+        return results
+
+    @staticmethod
+    def _check_batch_item(promotion):
+        """Returns the result of a promotion of create_all(), with an error if it is not valid"""
+        result = {"code": promotion.code}
+        try:
+            if promotion.code is None or promotion.code == "":
+                raise DataValidationError("code attribute is not set")
+            promotion._check_new()  # pylint: disable=protected-access
+            promotion._check_columns()  # pylint: disable=protected-access
+        except DataValidationError as error:
+            result["error"] = str(error)
+        return result
+
+    def _check_columns(self):
+        """Validates that the strings and integers of a PromotionModel to create fit their columns
+
+        Statements of many rows bind the strings with a cast to their column
+        type, which would truncate them rather than fail.
+        """
+        for column in ("code", "name"):
+            if len(getattr(self, column)) > Promotion.__table__.c[column].type.length:
+                raise DataValidationError(f"{column} attribute is too long")
+        for column in self.INTEGER_COLUMNS:
+            value = getattr(self, column)
+            if value is not None and not -MAX_INTEGER - 1 <= value <= MAX_INTEGER:
+                raise DataValidationError(f"{column} attribute is out of range")
+
+    def _check_new(self):
+        """Defaults and validates the attributes of a PromotionModel to create, but its code"""
         if self.name is None or self.name == "":
             raise DataValidationError("name attribute is not set")
         if self.start is None:
@@ -92,17 +593,7 @@ class Promotion(db.Model):  # pylint: disable=too-many-instance-attributes
             self.whole_store = False
         if self.promo_type is None:
             raise DataValidationError("promo_type attribute is not set")
-
-        if product_ids is not None:
-            ids = product_ids if isinstance(product_ids, list) else [product_ids]
-            for product_id in ids:
-                product = Product.find(product_id)
-                if product is None:
-                    product = Product(id=product_id)
-                    product.create()
-                self.products.append(product)
-        db.session.add(self)
-        db.session.commit()
+        self._check_counter_shards()
 
     def update(self):
         """Update
@@ -127,7 +618,13 @@ class Promotion(db.Model):  # pylint: disable=too-many-instance-attributes
         if self.promo_type is None:
             raise DataValidationError("promo_type attribute is not set")
 
-        db.session.commit()
+        self._check_counter_shards()
+        self._sync_counter_shards()
+        self.version = Promotion.version + 1
+        self.revision = Promotion.revision + 1
+        keys = self._snapshot_keys()
+        commit_changes()
+        _invalidate(*keys)
 
     def delete(self):
         """Removes a PromotionModel from the data store"""
@@ -135,8 +632,10 @@ class Promotion(db.Model):  # pylint: disable=too-many-instance-attributes
             raise DataValidationError(f"Promotion with ID {self.id} not found.")
 
         self.app.logger.info("Deleting %s", self.name)
+        keys = self._snapshot_keys()
         db.session.delete(self)
-        db.session.commit()
+        commit_changes()
+        _invalidate(*keys)
 
     def invalidate(self):
         """Invalidate the promotion"""
@@ -145,19 +644,124 @@ class Promotion(db.Model):  # pylint: disable=too-many-instance-attributes
 
         self.app.logger.info("Invalidating %s", self.name)
         self.available = 0
+        db.session.execute(
+            db.update(PromotionCounter)
+            .where(PromotionCounter.promotion_id == self.id)
+            .values(available=0)
+        )
         self.expired = db.func.current_timestamp()
 
         # unbind all products
-        self.products.clear()
-        db.session.commit()
+        db.session.execute(
+            promotion_product.delete().where(promotion_product.c.promotion_id == self.id)
+        )
+        self.version = Promotion.version + 1
+        self.revision = Promotion.revision + 1
+        keys = self._snapshot_keys()
+        commit_changes()
+        _invalidate(*keys)
 
     def is_valid(self):
         """Check if the promotion is valid"""
         today = date.today()
-        return self.available > 0 and self.start <= today <= self.expired
+        return self.current_available() > 0 and self.start <= today <= self.expired
+
+    def current_available(self):
+        """Returns the uses left, summing the counter shards if there are any"""
+        if not self.counter_shards:
+            return self.available
+        return db.session.execute(
+            db.select(db.func.coalesce(db.func.sum(PromotionCounter.available), 0))
+            .where(PromotionCounter.promotion_id == self.id)
+        ).scalar_one()
+
+    def _check_counter_shards(self):
+        """Defaults and validates the number of counter shards"""
+        if self.counter_shards is None:
+            self.counter_shards = 0
+        if self.counter_shards < 0:
+            raise DataValidationError("counter_shards must not be negative")
+        if self.counter_shards > self.MAX_COUNTER_SHARDS:
+            raise DataValidationError(f"counter_shards must be at most {self.MAX_COUNTER_SHARDS}")
+
+    def _create_counter_shards(self):
+        """Spreads `available` over the shards of a newly added promotion"""
+        if self.counter_shards:
+            self._shard_available(self.available)
+
+    def _bind_products(self, product_ids):
+        """Binds products by id with set-based statements, without committing
+
+        Missing products are created with one INSERT and the bindings that
+        do not exist yet are added with another, whatever the number of ids.
+
+        Returns:
+            tuple: (the number of new bindings, the snapshot cache keys of the
+            created products, to invalidate once committed)
+        """
+        ids = _product_id_list(product_ids)
+        if not ids:
+            return 0, []
+        created = [("product", product_id) for product_id in Product.create_missing(ids)]
+        return _insert_bindings(self.id, ids), created
 
-    def serialize(self):
-        """Serializes a PromotionModel into a dictionary"""
+    def _shard_available(self, total):
+        """Replaces the counter shards with `total` uses spread evenly over them"""
+        db.session.execute(
+            db.delete(PromotionCounter).where(PromotionCounter.promotion_id == self.id)
+        )
+        if not self.counter_shards:
+            return
+        db.session.execute(db.insert(PromotionCounter), _shard_rows(self.id, self.counter_shards, total))
+
+    def _sync_counter_shards(self):
+        """Re-shards `available` when the shard count or the quantity changed"""
+        attrs = db.inspect(self).attrs
+        shards_changed = attrs.counter_shards.history.has_changes()
+        available_changed = attrs.available.history.has_changes()
+        if not available_changed:
+            if not shards_changed:
+                return
+            # keep the uses left when only the number of shards changes
+            previous = attrs.counter_shards.history.deleted
+            if previous and previous[0]:
+                self.available = db.session.execute(
+                    db.select(db.func.coalesce(db.func.sum(PromotionCounter.available), 0))
+                    .where(PromotionCounter.promotion_id == self.id)
+                ).scalar_one()
+        elif not self.counter_shards and not shards_changed:
+            return
+        self._shard_available(self.available)
+
+    def not_applicable_reason(self, available=None):
+        """Returns why the promotion cannot be applied today, or None
+
+        Args:
+            available (int): the uses left, when already read
+        """
+        today = date.today()
+        if today > self.expired:
+            return "Applying expired promotions is not supported"
+        if today < self.start:
+            return "Applying Inactive promotions is not supported"
+        if (self.current_available() if available is None else available) <= 0:
+            return (
+                "Applying unavailable promotions is not supported, "
+                "reach the limit of promotion"
+            )
+        return None
+
+    def serialize(self, fields=None, loaded=None):
+        """Serializes a PromotionModel into a dictionary
+
+        Args:
+            fields (list): the keys to return, DEFAULT_FIELDS when omitted; the
+                products, their count and the uses left are only read when asked for
+            loaded (dict): the values of `products`, `product_count` or
+                `available` already read by serialize_all()
+        """
+        fields = self.DEFAULT_FIELDS if fields is None else fields
+        loaded = loaded or {}
         serialized_data = {
             "id": self.id,
             "name": self.name,
@@ -167,11 +771,19 @@ class Promotion(db.Model):  # pylint: disable=too-many-instance-attributes
             "whole_store": self.whole_store,
             "promo_type": int(self.promo_type),
             "value": float(self.value),
-            "products": [product.id for product in self.products],
             "created_at": self.created_at,
             "updated_at": self.updated_at,
-            "available": self.available,
+            "counter_shards": self.counter_shards,
+        }
+        # the fields that need a query, run only when asked for and not loaded
+        lazy = {
+            "products": self.bound_product_ids,
+            "product_count": self.count_products,
+            "available": self.current_available,
         }
+        for key, load in lazy.items():
+            if key in fields:
+                serialized_data[key] = loaded[key] if key in loaded else load()
 
         # Optionally include 'created_at'
         if self.created_at is not None:
@@ -184,7 +796,7 @@ class Promotion(db.Model):  # pylint: disable=too-many-instance-attributes
             serialized_data["updated_at"] = self.updated_at.isoformat()
         else:
             serialized_data["updated_at"] = self.updated_at
-        return serialized_data
+        return {key: serialized_data[key] for key in fields}
 
     def deserialize(self, data):
         """
@@ -202,6 +814,8 @@ class Promotion(db.Model):  # pylint: disable=too-many-instance-attributes
             self.promo_type = int(data["promo_type"])
             self.value = float(data["value"])
             self.available = int(data["available"])
+            if data.get("counter_shards") is not None:
+                self.counter_shards = int(data["counter_shards"])
         except KeyError as error:
             raise DataValidationError(
                 "Invalid PromotionModel: missing " + error.args[0]
@@ -220,40 +834,239 @@ class Promotion(db.Model):  # pylint: disable=too-many-instance-attributes
         return self
 
     def bind_product(self, product_id):
-        """Bind a product to a promotion
+        """Bind a product to a promotion, creating the product if needed
         Args:
             product_id (int): the id of the product
+
+        Returns:
+            bool: False if the product was already in the promotion
         """
-        product = Product.find(product_id)
-        if product is None:
-            product = Product(id=product_id)
-            product.create()
-        if product_id not in self.products:
-            self.products.append(product)
-        else:
-            self.app.logger.info(f"Product with id '{id}' is already in the promotion.")
-        db.session.commit()
+        added, created = self._bind_products([product_id])
+        if not added:
+            self.app.logger.info(
+                "Product with id '%s' is already in the promotion.", product_id
+            )
+            db.session.commit()
+            return False
+        self.version = Promotion.version + 1
+        commit_changes()
+        _invalidate(("promotion", self.id), *created)
+        return True
 
     def unbind_product(self, product_id):
         """Unbind a product to a promotion
         Args:
             product_id (int): the id of the product
         """
-        product = Product.find(product_id)
-        if product is None:
-            raise DataValidationError(f"Product with id '{id}' was not found.")
-
-        if product in self.products:
-            self.products.remove(product)
-        else:
+        if not _unbind(self.id, product_id):
+            if Product.find(product_id) is None:
+                raise DataValidationError(f"Product with id '{product_id}' was not found.")
             raise DataValidationError(
-                f"Product with id '{id}' is not in the promotion."
+                f"Product with id '{product_id}' is not in the promotion."
             )
-        db.session.commit()
+        self.version = Promotion.version + 1
+        commit_changes()
+        Promotion.forget(self.id)
+
+    def add_products(self, product_ids):
+        """Binds many products at once, creating the missing ones
+
+        Args:
+            product_ids (list): the ids of the products
+
+        Returns:
+            int: the number of new bindings, the bound products are skipped
+        """
+        added, created = self._bind_products(product_ids)
+        self._commit_bindings(added, created)
+        return added
+
+    def remove_products(self, product_ids):
+        """Unbinds many products at once with one DELETE
+
+        Args:
+            product_ids (list): the ids of the products
+
+        Returns:
+            int: the number of bindings removed, products not in the promotion are skipped
+        """
+        ids = _product_id_list(product_ids)
+        removed = _delete_bindings(self.id, ids) if ids else 0
+        self._commit_bindings(removed)
+        return removed
+
+    def replace_products(self, product_ids):
+        """Makes the products of the promotion exactly these, in one transaction
+
+        The bindings to other products are deleted with one statement and
+        the missing ones are added with the statements of add_products(), so
+        only the difference is written.
+
+        Args:
+            product_ids (list): the ids of the products, empty to unbind them all
+
+        Returns:
+            tuple: (the number of bindings added, the number removed)
+        """
+        ids = _product_id_list(product_ids)
+        removed = _delete_bindings(self.id, ids, keep=True)
+        added, created = self._bind_products(ids)
+        self._commit_bindings(added + removed, created)
+        return added, removed
+
+    def _commit_bindings(self, changed, created=()):
+        """Commits bindings changed in bulk, moving to a new version when any did
+
+        Args:
+            changed (int): the number of bindings added or removed
+            created (list): the snapshot cache keys of the products created for them
+        """
+        if not changed:
+            db.session.commit()
+            return
+        self.app.logger.info("Changed %d bindings of promotion %s", changed, self.id)
+        self.version = Promotion.version + 1
+        commit_changes()
+        _invalidate(("promotion", self.id), *created)
+
+    def has_product(self, product_id):
+        """Returns True if the product is in the promotion, with one EXISTS query"""
+        return _is_bound(self.id, product_id)
+
+    def bound_product_ids(self):
+        """Returns the ids of the products in the promotion without loading them"""
+        if self.id is None:
+            return []
+        return db.session.scalars(
+            db.select(promotion_product.c.product_id)
+            .where(promotion_product.c.promotion_id == self.id)
+            .order_by(promotion_product.c.product_id)
+        ).all()
+
+    @classmethod
+    def serialize_all(cls, promotions, fields=None):
+        """Serializes PromotionModels with a fixed number of queries
+
+        The product ids or the product counts of all the PromotionModels are
+        read with one query on promotion_product, and the uses left of the
+        sharded ones with another, instead of a query per PromotionModel.
+        None of them is run when its field is not asked for.
+
+        Args:
+            promotions (list): the PromotionModels to serialize
+            fields (list): the keys to return, DEFAULT_FIELDS when omitted
+        """
+        fields = cls.DEFAULT_FIELDS if fields is None else fields
+        promotions = list(promotions)
+        ids = [promotion.id for promotion in promotions]
+        loaded = {promotion_id: {} for promotion_id in ids}
+        if ids and "products" in fields:
+            for promotion_id, product_ids in cls._load_product_ids(ids).items():
+                loaded[promotion_id]["products"] = product_ids
+        if ids and "product_count" in fields:
+            for promotion_id, count in cls._load_product_counts(ids).items():
+                loaded[promotion_id]["product_count"] = count
+        if "available" in fields:
+            for promotion_id, available in cls._load_available(promotions).items():
+                loaded[promotion_id]["available"] = available
+        return [promotion.serialize(fields, loaded[promotion.id]) for promotion in promotions]
+
+    @staticmethod
+    def _load_product_ids(ids):
+        """Returns the bound product ids of each promotion id, with one query"""
+        product_ids = {promotion_id: [] for promotion_id in ids}
+        rows = db.session.execute(
+            db.select(promotion_product.c.promotion_id, promotion_product.c.product_id)
+            .where(promotion_product.c.promotion_id == db.func.any(_id_array(ids)))
+            .order_by(promotion_product.c.promotion_id, promotion_product.c.product_id)
+        ).all()
+        for promotion_id, product_id in rows:
+            product_ids[promotion_id].append(product_id)
+        return product_ids
+
+    @staticmethod
+    def _load_product_counts(ids):
+        """Returns the number of bound products of each promotion id, with one query"""
+        counts = dict.fromkeys(ids, 0)
+        counts.update(
+            db.session.execute(
+                db.select(promotion_product.c.promotion_id, db.func.count())
+                .where(promotion_product.c.promotion_id == db.func.any(_id_array(ids)))
+                .group_by(promotion_product.c.promotion_id)
+            ).all()
+        )
+        return counts
+
+    @staticmethod
+    def _load_available(promotions):
+        """Returns the uses left of each promotion, summing the shards with one query"""
+        available = {
+            promotion.id: 0 if promotion.counter_shards else promotion.available
+            for promotion in promotions
+        }
+        sharded = [promotion.id for promotion in promotions if promotion.counter_shards]
+        if sharded:
+            available.update(
+                db.session.execute(
+                    db.select(PromotionCounter.promotion_id, db.func.sum(PromotionCounter.available))
+                    .where(PromotionCounter.promotion_id == db.func.any(_id_array(sharded)))
+                    .group_by(PromotionCounter.promotion_id)
+                ).all()
+            )
+        return available
+
+    def etag(self):
+        """Returns a value that changes whenever the serialized PromotionModel does
+
+        Built from the version, plus the uses left of a sharded PromotionModel,
+        since its shards are redeemed without touching the promotion row.
+        """
+        tag = f"{self.id}-{self.version}"
+        if self.counter_shards:
+            tag += f"-{self.current_available()}"
+        return tag
+
+    @staticmethod
+    def generation():
+        """Returns the promotion change counter, see promotion_generation
+
+        A new sequence has a `last_value` of 1 before its first nextval() as
+        well as after it, so it counts as 0 until it was called.
+        """
+        return db.session.execute(
+            db.text(f"SELECT CASE WHEN is_called THEN last_value ELSE 0 END FROM {promotion_generation.name}")
+        ).scalar_one()
+
+    def count_products(self):
+        """Returns the number of products in the promotion, read from the index"""
+        if self.id is None:
+            return 0
+        return db.session.execute(
+            db.select(db.func.count())
+            .select_from(promotion_product)
+            .where(promotion_product.c.promotion_id == self.id)
+        ).scalar_one()
+
+    def product_page(self, after_id=None, limit=100):
+        """Returns a page of the products in the promotion in id order
+
+        The page is a range of the (promotion_id, product_id) primary key
+        starting after `after_id`, so it costs the same wherever it is.
+
+        Args:
+            after_id (int): the id of the last product of the previous page
+            limit (int): the maximum number of products to return
+        """
+        query = Product.query.join(
+            promotion_product, promotion_product.c.product_id == Product.id
+        ).filter(promotion_product.c.promotion_id == self.id)
+        if after_id is not None:
+            query = query.filter(promotion_product.c.product_id > after_id)
+        return query.order_by(promotion_product.c.product_id).limit(limit).all()
 
     def product_ids(self):
         """Returns all product ids"""
-        return [str(product.id) for product in self.products]
+        return [str(product_id) for product_id in self.bound_product_ids()]
 
     @classmethod
     def init_db(cls, _app):
@@ -276,6 +1089,179 @@ class Promotion(db.Model):  # pylint: disable=too-many-instance-attributes
         cls.app.logger.info("Processing lookup for id %s ...", by_id)
         return cls.query.get(by_id)
 
+    @classmethod
+    def lookup(cls, by_id):
+        """Returns a read-only copy of a PromotionModel by it's ID, from the snapshot cache
+
+        The copy is not attached to the session: use find() to change it.
+        """
+        snapshot = snapshots.get(("promotion", by_id), lambda: _snapshot(cls.find(by_id)))
+        return None if snapshot is None else cls(**snapshot)
+
+    @classmethod
+    def lookup_by_code(cls, code):
+        """Returns a read-only copy of the PromotionModel with a code, from the snapshot cache"""
+        snapshot = snapshots.get(
+            ("promotion_code", code), lambda: _snapshot(cls.find_by_code(code).first())
+        )
+        return None if snapshot is None else cls(**snapshot)
+
+    @staticmethod
+    def forget(*promotion_ids):
+        """Drops the cached snapshots and payloads of promotions changed by this process"""
+        _invalidate(*[("promotion", promotion_id) for promotion_id in promotion_ids])
+
+    def _snapshot_keys(self):
+        """Returns the snapshot cache keys of the promotion, under its old and new code"""
+        codes = db.inspect(self).attrs.code.history.sum() or [self.code]
+        return [("promotion", self.id)] + [("promotion_code", code) for code in codes]
+
+    @classmethod
+    def find_for_update(cls, by_id):
+        """Finds a PromotionModel by it's ID and locks it until the next commit"""
+        cls.app.logger.info("Processing locked lookup for id %s ...", by_id)
+        return db.session.get(cls, by_id, with_for_update=True, populate_existing=True)
+
+    @classmethod
+    def redeem(cls, promotion_id):
+        """Consumes one use of a promotion in a single round trip
+
+        The date window and the remaining quantity are checked by the same
+        conditional UPDATE ... RETURNING that decrements ``available``, so
+        concurrent callers can never oversell or lose a decrement.
+
+        Args:
+            promotion_id (int): the id of the promotion to apply
+
+        Returns:
+            int: the uses left after this one, or None if there is no such promotion
+
+        Raises:
+            PromotionNotApplicableError: the promotion is expired, inactive or used up
+        """
+        today = date.today()
+        # the apply is one statement and its COMMIT, before the generation moves on
+        table = cls.__table__
+        remaining = db.session.execute(
+            db.update(table)
+            .where(
+                table.c.id == promotion_id,
+                table.c.counter_shards == 0,
+                table.c.available > 0,
+                table.c.start <= today,
+                table.c.expired >= today,
+            )
+            .values(available=table.c.available - 1, version=table.c.version + 1)
+            .returning(table.c.available)
+        ).scalar()
+        if remaining is None:
+            remaining = PromotionCounter.redeem(promotion_id, today)
+        if remaining is not None:
+            commit_changes()
+            cls.forget(promotion_id)
+            return remaining
+
+        # cold path: nothing was updated, find out why
+        promotion = cls.find(promotion_id)
+        if promotion is None:
+            return None
+        raise PromotionNotApplicableError(
+            promotion.not_applicable_reason()
+            or "Promotion could not be applied, please retry"
+        )
+
+    @classmethod
+    def redeem_all(cls, ids=(), codes=()):
+        """Consumes one use of each of several promotions, all of them or none
+
+        The promotions are read, locked and checked with one query, in id
+        order, so that concurrent batches sharing promotions queue on the
+        first one they share instead of deadlocking. The checks are the ones
+        of redeem(); when any of them fails nothing is applied.
+
+        Args:
+            ids (list): the ids of promotions to apply
+            codes (list): the codes of promotions to apply
+
+        Returns:
+            tuple: (True if every promotion was applied, the result of each
+            id then of each code, with the uses left or the error)
+        """
+        shard_total = (
+            db.select(db.func.coalesce(db.func.sum(PromotionCounter.available), 0))
+            .where(PromotionCounter.promotion_id == cls.id)
+            .scalar_subquery()
+        )
+        cls.app.logger.info("Processing locked lookup for %d ids and %d codes ...", len(ids), len(codes))
+        rows = db.session.execute(
+            db.select(cls, shard_total)
+            .where(db.or_(cls.id.in_(ids), cls.code.in_(codes)))
+            .order_by(cls.id)
+            .with_for_update(of=cls)
+            .execution_options(populate_existing=True)
+        ).all()
+        by_id = {promotion.id: (promotion, total) for promotion, total in rows}
+        by_code = {promotion.code: (promotion, total) for promotion, total in rows}
+        found = [by_id.get(promotion_id) for promotion_id in ids] + [by_code.get(code) for code in codes]
+        results = cls._check_all(list(ids) + list(codes), found)
+
+        if all("error" not in result for result in results):
+            remaining = cls._take_all([promotion for promotion, _ in found])
+            if remaining is not None:
+                commit_changes()
+                cls.forget(*remaining)
+                for result in results:
+                    result["available"] = remaining[result["id"]]
+                return True, results
+            for result in results:
+                result["error"] = "Promotion could not be applied, please retry"
+        db.session.rollback()
+        return False, results
+
+    @staticmethod
+    def _check_all(requested, found):
+        """Returns the result of each requested id or code, with an error if it cannot be applied"""
+        results, seen = [], set()
+        for key, row in zip(requested, found):
+            if row is None:
+                results.append({"id": None, "code": None, "error": f"Promotion {key} was not found."})
+                continue
+            promotion, total = row
+            result = {"id": promotion.id, "code": promotion.code}
+            reason = promotion.not_applicable_reason(total if promotion.counter_shards else promotion.available)
+            if promotion.id in seen:
+                reason = "A promotion can only be applied once per batch"
+            if reason:
+                result["error"] = reason
+            seen.add(promotion.id)
+            results.append(result)
+        return results
+
+    @staticmethod
+    def _take_all(promotions):
+        """Consumes one use of each locked and checked promotion, without committing
+
+        Returns:
+            dict: the uses left by promotion id, or None if a sharded one ran out meanwhile
+        """
+        today = date.today()
+        plain = [promotion.id for promotion in promotions if not promotion.counter_shards]
+        remaining = dict(
+            db.session.execute(
+                db.update(Promotion)
+                .where(Promotion.id.in_(plain))
+                .values(available=Promotion.available - 1, version=Promotion.version + 1)
+                .returning(Promotion.id, Promotion.available)
+                .execution_options(synchronize_session=False)
+            ).all()
+        ) if plain else {}
+        for promotion in promotions:
+            if promotion.counter_shards:
+                remaining[promotion.id] = PromotionCounter.redeem(promotion.id, today)
+                if remaining[promotion.id] is None:
+                    return None
+        return remaining
+
     @classmethod
     def find_by_name(cls, name):
         """Returns all PromotionModels with the given name
@@ -306,6 +1292,201 @@ class Promotion(db.Model):  # pylint: disable=too-many-instance-attributes
         cls.app.logger.info("Processing promo_type query for %s ...", promo_type)
         return cls.query.filter(cls.promo_type == promo_type)
 
+    @classmethod
+    def find_page(cls, query=None, after_id=None, limit=100):
+        """Returns a page of PromotionModels in id order
+
+        The page starts after `after_id` with WHERE id > :after_id, so it is
+        read from the id index whatever its position in the results.
+
+        Args:
+            query (Query): the finder to page through, all PromotionModels by default
+            after_id (int): the id of the last PromotionModel of the previous page
+            limit (int): the maximum number of PromotionModels to return
+        """
+        query = cls.query if query is None else query
+        if after_id is not None:
+            query = query.filter(cls.id > after_id)
+        return query.order_by(cls.id).limit(limit).all()
+
+    @classmethod
+    def search(cls, generation, after_id=None, limit=100, **criteria):  # pylint: disable=too-many-arguments
+        """Returns a page of read-only copies of the PromotionModels matching a filter
+
+        Only the first filter given of name, code and promo_type is applied,
+        as by the list endpoint. Pages come from the query cache when they
+        were read at the same generation.
+
+        Args:
+            generation (int): the promotion generation, read before calling
+            after_id (int): the id of the last PromotionModel of the previous page
+            limit (int): the maximum number of PromotionModels to return
+            criteria (dict): name, code or promo_type
+        """
+        finder, value = next(
+            ((f"find_by_{name}", criteria[name]) for name in ("name", "code", "promo_type") if criteria.get(name)),
+            ("all", None),
+        )
+        query = None if value is None else getattr(cls, finder)(value)
+        rows = queries.get(
+            finder,
+            (value, after_id, limit),
+            generation,
+            lambda: tuple(_snapshot(row) for row in cls.find_page(query, after_id, limit)),
+        )
+        return [cls(**row) for row in rows]
+
+    @classmethod
+    def stream(cls, query=None, batch_size=1000):
+        """Yields PromotionModels in id order, in lists of `batch_size`
+
+        Rows are fetched one batch at a time from a server-side cursor,
+        so memory stays bounded whatever the number of PromotionModels,
+        and each batch can be serialized with serialize_all().
+
+        Args:
+            query (Query): the finder to read, all PromotionModels by default
+            batch_size (int): the number of rows fetched per round trip
+        """
+        query = cls.query if query is None else query
+        rows = iter(query.order_by(cls.id).yield_per(batch_size))
+        batch = list(islice(rows, batch_size))
+        while batch:
+            yield batch
+            batch = list(islice(rows, batch_size))
+
+    @classmethod
+    def find_active(cls, on_date=None):
+        """Returns all PromotionModels with uses left on a date
+
+        Sharded promotions keep a positive `available` while any shard has uses
+        left, so they are matched here and checked by is_valid()
+
+        Args:
+            on_date (date): the date the promotions must be running on, today by default
+        """
+        on_date = on_date or date.today()
+        cls.app.logger.info("Processing active query for %s ...", on_date)
+        return cls.query.filter(
+            cls.available > 0, cls.start <= on_date, cls.expired >= on_date
+        )
+
+    @classmethod
+    def applicable_to(cls, product_ids, on_date=None):
+        """Returns the ids of the valid PromotionModels of each product, in one query
+
+        The promotions bound to the products are read through the product
+        index of promotion_product, and the whole store promotions through
+        the active window index; both are added to every product asked for.
+
+        Args:
+            product_ids (list): the ids of the products
+            on_date (date): the date the promotions must be running on, today by default
+
+        Returns:
+            dict: the sorted promotion ids of each product id, in the order given
+        """
+        ids = _product_id_list(product_ids)
+        if not ids:
+            return {}
+        on_date = on_date or date.today()
+        valid = (
+            cls.available > 0,
+            cls.start <= on_date,
+            cls.expired >= on_date,
+            # sharded promotions keep a positive available until every shard is used up
+            db.or_(
+                cls.counter_shards == 0,
+                db.exists().where(
+                    PromotionCounter.promotion_id == cls.id, PromotionCounter.available > 0
+                ),
+            ),
+        )
+        bound = (
+            db.select(promotion_product.c.product_id, cls.id)
+            .join(promotion_product, promotion_product.c.promotion_id == cls.id)
+            .where(promotion_product.c.product_id == db.func.any(_id_array(ids)), *valid)
+        )
+        whole_store = db.select(db.null().cast(db.Integer), cls.id).where(cls.whole_store.is_(True), *valid)
+        cls.app.logger.info("Processing applicable query for %d products ...", len(ids))
+        rows = db.session.execute(bound.union_all(whole_store)).all()
+
+        everywhere = sorted(promotion_id for product_id, promotion_id in rows if product_id is None)
+        applicable = {product_id: list(everywhere) for product_id in ids}
+        for product_id, promotion_id in rows:
+            if product_id is not None:
+                applicable[product_id].append(promotion_id)
+        return {product_id: sorted(set(found)) for product_id, found in applicable.items()}
+
+
+class PromotionCounter(db.Model):
+    """
+    Class that represents one shard of a Promotion's available uses
+
+    Hot promotions can spread `available` over several rows so that
+    concurrent applies lock different rows instead of queueing on one.
+    """
+
+    # Table Schema
+    promotion_id = db.Column(
+        db.Integer,
+        db.ForeignKey("promotion.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    shard = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    available = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return (
+            f"<PromotionCounter promotion_id=[{self.promotion_id}] "
+            f"shard=[{self.shard}] available=[{self.available}]>"
+        )
+
+    @classmethod
+    def redeem(cls, promotion_id, today):
+        """Consumes one use from a random shard that still has some left
+
+        Shards locked by other transactions are skipped, and a shard that
+        reaches zero simply stops being picked, so callers fall over to the
+        remaining shards. The blocking retry only happens when every shard
+        with uses left is locked at the same time.
+
+        Returns:
+            int: the uses left over all shards, or None if nothing was redeemed
+        """
+        for skip_locked in (True, False):
+            shard = (
+                db.select(cls.shard)
+                .join(Promotion, Promotion.id == cls.promotion_id)
+                .where(
+                    cls.promotion_id == promotion_id,
+                    cls.available > 0,
+                    Promotion.start <= today,
+                    Promotion.expired >= today,
+                )
+                .order_by(db.func.random())
+                .limit(1)
+                .with_for_update(of=cls, skip_locked=skip_locked)
+                .scalar_subquery()
+            )
+            # the subquery in RETURNING sees the shards as they were before
+            # this statement, hence the - 1
+            counter = cls.__table__
+            total = (
+                db.select(db.func.sum(counter.c.available))
+                .where(counter.c.promotion_id == promotion_id)
+                .scalar_subquery()
+            )
+            remaining = db.session.execute(
+                db.update(counter)
+                .where(counter.c.promotion_id == promotion_id, counter.c.shard == shard)
+                .values(available=counter.c.available - 1)
+                .returning(total - 1)
+            ).scalar_one_or_none()
+            if remaining is not None:
+                return remaining
+        return None
+
 
 class Product(db.Model):
     """
@@ -314,6 +1495,9 @@ class Product(db.Model):
 
     app = None
 
+    # the keys of the serialized representation
+    FIELDS = ("id", "promotions", "created_at", "updated_at")
+
     # Table Schema
     id = db.Column(db.Integer, primary_key=True)
     # Relationships
@@ -336,21 +1520,98 @@ class Product(db.Model):
         self.app.logger.info("Creating Product[id: %s]", self.id)
         db.session.add(self)
         db.session.commit()
+        _invalidate(("product", self.id))
+
+    @classmethod
+    def create_missing(cls, product_ids):
+        """Creates the products that do not exist yet, without committing
+
+        One INSERT ... SELECT adds the ids that are not in the table, so only
+        the new ones come back, and ON CONFLICT DO NOTHING keeps concurrent
+        creators from colliding.
+
+        The cached misses of the new products are left to the caller, to be
+        invalidated once the transaction is committed: invalidated before, a
+        lookup in between could cache the miss again.
+
+        Args:
+            product_ids (list): distinct product ids, see _product_id_list()
+
+        Returns:
+            list: the ids of the products created
+        """
+        new = db.func.unnest(_id_array(product_ids)).table_valued("id").render_derived()
+        missing = db.session.scalars(
+            postgresql.insert(cls.__table__)
+            .from_select(["id"], db.select(new.c.id).where(~db.exists().where(cls.id == new.c.id)))
+            .on_conflict_do_nothing()
+            .returning(cls.id)
+        ).all()
+        if missing:
+            cls.app.logger.info("Created %d missing products", len(missing))
+        return missing
 
     def delete(self):
         """Removes a PromotionModel from the data store"""
         self.app.logger.info("Deleting Product[id: %s]", self.id)
+        # the promotions of the product lose it to ON DELETE CASCADE
+        touched = _touch_promotions(
+            Promotion.id.in_(
+                db.select(promotion_product.c.promotion_id)
+                .where(promotion_product.c.product_id == self.id)
+            )
+        )
         db.session.delete(self)
-        db.session.commit()
+        commit_changes()
+        _invalidate(("product", self.id), *[("promotion", promotion_id) for promotion_id in touched])
 
-    def serialize(self):
-        """Serializes a PromotionModel into a dictionary"""
-        return {
+    def serialize(self, promotions=None, fields=None):
+        """Serializes a ProductModel into a dictionary
+
+        Args:
+            promotions (list): the serialized promotions of the product, when already loaded
+            fields (list): the keys to return, all of FIELDS by default; the
+                promotions are only loaded when asked for
+        """
+        fields = self.FIELDS if fields is None else fields
+        if promotions is None and "promotions" in fields:
+            promotions = Promotion.serialize_all(self.promotions)
+        serialized_data = {
             "id": self.id,
-            "promotions": [promotion.serialize() for promotion in self.promotions],
+            "promotions": promotions,
             "created_at": self.created_at,
             "updated_at": self.updated_at,
         }
+        return {key: serialized_data[key] for key in fields}
+
+    @classmethod
+    def serialize_all(cls, products, fields=None):
+        """Serializes ProductModels with a fixed number of queries
+
+        When the promotions are asked for, the bindings of all the products
+        are read with one query and the promotions with another, and each
+        promotion is serialized once however many products it has.
+
+        Args:
+            products (list): the ProductModels to serialize
+            fields (list): the keys to return, all of FIELDS by default
+        """
+        fields = cls.FIELDS if fields is None else fields
+        products = list(products)
+        promotions = {product.id: [] for product in products}
+        if products and "promotions" in fields:
+            bindings = db.session.execute(
+                db.select(promotion_product.c.product_id, promotion_product.c.promotion_id)
+                .where(promotion_product.c.product_id == db.func.any(_id_array(promotions)))
+                .order_by(promotion_product.c.product_id, promotion_product.c.promotion_id)
+            ).all()
+            bound = Promotion.query.filter(
+                Promotion.id == db.func.any(_id_array({row.promotion_id for row in bindings}))
+            )
+            serialized = {data["id"]: data for data in Promotion.serialize_all(bound)}
+            for product_id, promotion_id in bindings:
+                promotions[product_id].append(serialized[promotion_id])
+        return [product.serialize(promotions[product.id], fields) for product in products]
 
     def deserialize(self, data):
         """
@@ -378,13 +1639,15 @@ class Product(db.Model):
                 f"Promotion with id '{promotion_id}' was not found."
             )
 
-        if promotion not in self.promotions:
-            self.promotions.append(promotion)
-        else:
+        if not _insert_bindings(promotion_id, [self.id]):
             self.app.logger.info(
-                f"Promotion with id '{promotion_id}' is already in the product."
+                "Promotion with id '%s' is already in the product.", promotion_id
             )
-        db.session.commit()
+            db.session.commit()
+            return
+        _touch_promotions(Promotion.id == promotion_id)
+        commit_changes()
+        Promotion.forget(promotion_id)
 
     def unbind_promotion(self, promotion_id):
         """Unbind a promotion to a product
@@ -397,13 +1660,17 @@ class Product(db.Model):
                 f"Promotion with id '{promotion_id}' was not found."
             )
 
-        if promotion in self.promotions:
-            self.promotions.remove(promotion)
-        else:
+        if not _unbind(promotion_id, self.id):
             raise DataValidationError(
                 f"Promotion with id '{promotion_id}' is not in the product."
             )
-        db.session.commit()
+        _touch_promotions(Promotion.id == promotion_id)
+        commit_changes()
+        Promotion.forget(promotion_id)
+
+    def has_promotion(self, promotion_id):
+        """Returns True if the promotion applies to the product, with one EXISTS query"""
+        return _is_bound(promotion_id, self.id)
 
     @classmethod
     def init_db(cls, _app):
@@ -425,3 +1692,9 @@ class Product(db.Model):
         """Finds a PromotionModel by it's ID"""
         cls.app.logger.info("Processing lookup for id %s ...", by_id)
         return cls.query.get(by_id)
+
+    @classmethod
+    def lookup(cls, by_id):
+        """Returns a read-only copy of a ProductModel by it's ID, from the snapshot cache"""
+        snapshot = snapshots.get(("product", by_id), lambda: _snapshot(cls.find(by_id)))
+        return None if snapshot is None else cls(**snapshot)
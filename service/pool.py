@@ -0,0 +1,137 @@
+"""
+Connection pool telemetry
+
+Every gunicorn worker has its own SQLAlchemy pool of at most
+DATABASE_POOL_SIZE + DATABASE_MAX_OVERFLOW connections. To size those
+from data, the pool of the worker times every checkout and counts the
+ones that found it full:
+
+  * `wait_ms` is a histogram of the time taken to get a connection from
+    the pool, opening a new one included, with cumulative buckets like
+    Prometheus `le` ones
+  * `saturated` counts checkouts that found every connection in use and
+    had to wait for one to be returned, `timeouts` the ones that gave up
+    after DATABASE_POOL_TIMEOUT seconds
+  * `overflow_checkouts` counts checkouts served by a connection opened
+    beyond DATABASE_POOL_SIZE, which is closed again when returned
+
+A pool that saturates needs more connections per worker, or fewer
+threads; one that never overflows and waits well under a millisecond can
+be made smaller.
+"""
+import threading
+import time
+from bisect import bisect_left
+
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+
+from service.models import db
+
+# upper bounds of the checkout wait buckets, in milliseconds
+WAIT_BUCKETS_MS = (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000, 5000)
+
+
+class MonitoredQueuePool(QueuePool):
+    """A QueuePool that times its checkouts and counts the ones that found it full"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._telemetry_lock = threading.Lock()
+        self._telemetry, self._waits = {}, []
+        self.clear_telemetry()
+
+    def _do_get(self):
+        saturated = self._max_overflow > -1 and self.checkedout() >= self.size() + self._max_overflow
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            self._record(time.perf_counter() - started, saturated, timed_out=True)
+            raise
+        self._record(time.perf_counter() - started, saturated)
+        return connection
+
+    def _record(self, seconds, saturated, timed_out=False):
+        """Counts one checkout that took `seconds`"""
+        milliseconds = seconds * 1000
+        checked_out = self.checkedout()
+        with self._telemetry_lock:
+            telemetry = self._telemetry
+            telemetry["checkouts"] += 1
+            telemetry["saturated"] += saturated
+            telemetry["timeouts"] += timed_out
+            telemetry["overflow_checkouts"] += not timed_out and checked_out > self.size()
+            telemetry["max_checked_out"] = max(telemetry["max_checked_out"], checked_out)
+            telemetry["wait_ms_sum"] += milliseconds
+            telemetry["wait_ms_max"] = max(telemetry["wait_ms_max"], milliseconds)
+            self._waits[bisect_left(WAIT_BUCKETS_MS, milliseconds)] += 1
+
+    def clear_telemetry(self):
+        """Resets the counters and the wait histogram"""
+        with self._telemetry_lock:
+            self._telemetry = dict.fromkeys(
+                ("checkouts", "saturated", "timeouts", "overflow_checkouts", "max_checked_out"), 0
+            )
+            self._telemetry.update(wait_ms_sum=0.0, wait_ms_max=0.0)
+            self._waits = [0] * (len(WAIT_BUCKETS_MS) + 1)
+
+    def telemetry(self):
+        """Returns the checkout counters, the wait histogram and the current use of the pool"""
+        with self._telemetry_lock:
+            stats = dict(self._telemetry)
+            waits = list(self._waits)
+        checkouts = stats["checkouts"]
+        buckets, total = {}, 0
+        for bound, count in zip(WAIT_BUCKETS_MS + ("+Inf",), waits):
+            total += count
+            buckets[str(bound)] = total
+        stats["wait_ms"] = {
+            "count": checkouts,
+            "sum": round(stats.pop("wait_ms_sum"), 3),
+            "max": round(stats.pop("wait_ms_max"), 3),
+            "buckets": buckets,
+        }
+        stats["saturation_ratio"] = round(stats["saturated"] / checkouts, 4) if checkouts else 0.0
+        stats.update(
+            pool_size=self.size(),
+            max_overflow=self._max_overflow,
+            timeout=self._timeout,
+            checked_out=self.checkedout(),
+            checked_in=self.checkedin(),
+        )
+        return stats
+
+
+class PoolMonitor:
+    """Installs MonitoredQueuePool as the pool of the worker and reads its telemetry"""
+
+    def __init__(self):
+        self.app = None
+
+    def init_app(self, app):
+        """Makes the engine use a MonitoredQueuePool; must run before db.init_app()"""
+        self.app = app
+        options = dict(app.config.get("SQLALCHEMY_ENGINE_OPTIONS") or {})
+        options.setdefault("poolclass", MonitoredQueuePool)
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = options
+
+    @property
+    def enabled(self):
+        """True when the pool of the engine is monitored"""
+        return isinstance(db.engine.pool, MonitoredQueuePool)
+
+    def clear(self):
+        """Resets the telemetry of the pool"""
+        if self.enabled:
+            db.engine.pool.clear_telemetry()
+
+    def stats(self):
+        """Returns the telemetry of the pool, or only its status when it is not monitored"""
+        pool = db.engine.pool
+        if isinstance(pool, MonitoredQueuePool):
+            return pool.telemetry()
+        return {"status": pool.status()}
+
+
+monitor = PoolMonitor()
@@ -0,0 +1,514 @@
+"""
+Cart pricing with the promotions that apply to it
+
+Every candidate promotion is evaluated at once: the discounts are computed
+over NumPy arrays of the (promotion, line) pairs where a promotion applies,
+one vectorized rule per promo_type, so the cost of a cart does not grow
+with a Python loop over promotions times lines. Each promotion is compiled
+once into an Evaluator, cached until the promotion changes.
+
+Combination rules:
+  * a line gets at most one promotion; promotions do not stack
+  * the per-line types (1, 3 and 5) save on a line whatever the other lines,
+    so each line takes the one saving it the most
+  * a cart wide type (2 and 4) takes every free line it applies to; the
+    combinations of the CART_WIDE_SEARCH most promising ones are searched
+    exactly, with the per-line promotions on the lines they leave
+  * whole store promotions apply to every line, the others to the lines of
+    their products
+"""
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from service.models import db, Promotion
+
+# promo_type values, see the Promotion Schema in the README
+PERCENTAGE = 1
+FIXED_AMOUNT = 2
+BUY_X_GET_ONE_FREE = 3
+BUY_ONE_GET_ONE_OFF = 4
+SAME_PRODUCT_SECOND_OFF = 5
+
+
+######################################################################
+#  E V A L U A T O R S
+######################################################################
+class Evaluator:
+    """A promotion compiled for pricing
+
+    Holds what pricing needs of a promotion as plain values, with its `value`
+    already turned into the parameter of its rule, so that pricing neither
+    dispatches on promo_type nor reads the ORM once per line. Evaluators are
+    immutable, and shared by the requests of a worker through `evaluators`.
+
+    This base class is the evaluator of unknown promo types: it never
+    discounts anything. Each subclass handles one promo_type.
+    """
+
+    __slots__ = ("promotion_id", "code", "revision", "param")
+    kind = 0
+
+    def __init__(self, promotion_id, code, revision, value):
+        for name, field in zip(Evaluator.__slots__, (promotion_id, code, revision, self.compile(value))):
+            object.__setattr__(self, name, field)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __repr__(self):
+        return f"<{type(self).__name__} promotion={self.promotion_id} revision={self.revision} param={self.param}>"
+
+    @staticmethod
+    def compile(value):
+        """Returns the parameter of the rule from the value of the promotion"""
+        return value
+
+    @staticmethod
+    def discounts(_params, _rows, prices, _quantities, _count):
+        """Returns the discount of each (promotion, line) pair of this type
+
+        Args:
+            params (ndarray): the compiled parameter of the promotion of each pair
+            rows (ndarray): the promotion row of each pair
+            prices (ndarray): the unit price of the line of each pair
+            quantities (ndarray): the quantity of the line of each pair
+            count (int): the number of promotion rows
+
+        The pairs come in promotion row order and, within a row, in ascending
+        unit price order.
+        """
+        return np.zeros(len(prices))
+
+
+class PercentageOff(Evaluator):
+    """`value` percent off every eligible unit"""
+
+    __slots__ = ()
+    kind = PERCENTAGE
+
+    @staticmethod
+    def compile(value):
+        return min(max(value, 0), 100) / 100
+
+    @staticmethod
+    def discounts(params, _rows, prices, quantities, _count):
+        return prices * quantities * params
+
+
+class FixedAmountOff(Evaluator):
+    """`value` off the eligible lines, spread over them by their share of the subtotal"""
+
+    __slots__ = ()
+    kind = FIXED_AMOUNT
+
+    @staticmethod
+    def compile(value):
+        return max(value, 0)
+
+    @staticmethod
+    def discounts(params, rows, prices, quantities, count):
+        totals = prices * quantities
+        subtotals = np.bincount(rows, totals, minlength=count)[rows]
+        amounts = np.minimum(params, subtotals)
+        return totals * np.divide(amounts, subtotals, out=np.zeros_like(amounts), where=subtotals > 0)
+
+
+class BuyXGetOneFree(Evaluator):
+    """One unit free for every `value` units bought of the same product"""
+
+    __slots__ = ()
+    kind = BUY_X_GET_ONE_FREE
+
+    @staticmethod
+    def compile(value):
+        # the units of a group, the free one included
+        return max(int(value), 1) + 1
+
+    @staticmethod
+    def discounts(params, _rows, prices, quantities, _count):
+        return quantities // params.astype(np.int64) * prices
+
+
+class BuyOneGetOneOff(PercentageOff):
+    """`value` percent off the cheaper half of the eligible units, across products"""
+
+    __slots__ = ()
+    kind = BUY_ONE_GET_ONE_OFF
+
+    @staticmethod
+    def discounts(params, rows, prices, quantities, count):
+        # the units of the cheaper lines of the same promotion, from the cheapest up
+        per_row = np.bincount(rows, quantities, minlength=count).astype(np.int64)
+        row_start = np.cumsum(per_row) - per_row
+        before = np.cumsum(quantities) - quantities - row_start[rows]
+        discounted = np.clip(per_row[rows] // 2 - before, 0, quantities)
+        return discounted * prices * params
+
+
+class SecondUnitOff(PercentageOff):
+    """`value` percent off every second unit of the same product"""
+
+    __slots__ = ()
+    kind = SAME_PRODUCT_SECOND_OFF
+
+    @staticmethod
+    def discounts(params, _rows, prices, quantities, _count):
+        return quantities // 2 * prices * params
+
+
+# the evaluator of each promo_type
+EVALUATORS = {
+    evaluator.kind: evaluator
+    for evaluator in (PercentageOff, FixedAmountOff, BuyXGetOneFree, BuyOneGetOneOff, SecondUnitOff)
+}
+
+# the types whose discount on a line depends on the other lines: a promotion
+# of these types takes every eligible line, the others only the lines they discount
+CART_WIDE = (FIXED_AMOUNT, BUY_ONE_GET_ONE_OFF)
+
+# the most cart wide promotions of a cart searched for the best combination
+CART_WIDE_SEARCH = 4
+
+
+def compile_evaluator(promotion_id, code, revision, promo_type, value):  # pylint: disable=too-many-arguments
+    """Returns the evaluator of a promotion"""
+    return EVALUATORS.get(promo_type, Evaluator)(promotion_id, code, revision, value)
+
+
+class EvaluatorCache:
+    """The evaluators of this process, by promotion id
+
+    An evaluator is compiled again when the revision of its promotion has
+    changed, which every update of the promotion does, so the only query of
+    a cached lookup is the one reading the revisions. The revision, unlike
+    the version, stays put when a use is redeemed or leased, so a promotion
+    in use keeps its evaluator.
+    """
+
+    def __init__(self, size=4096, enabled=True):
+        self.size = size
+        self.enabled = enabled
+        self._evaluators = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {}
+        self.clear()
+
+    def init_app(self, app):
+        """Reads the cache settings"""
+        self.enabled = app.config.get("PROMOTION_CACHE_ENABLED", True)
+        self.size = app.config.get("PROMOTION_EVALUATOR_CACHE_SIZE", 4096)
+        self.clear()
+
+    def get(self, promotion_ids):
+        """Returns the evaluators of the promotions that exist, in id order"""
+        if not promotion_ids:
+            return []
+        revisions = db.session.execute(
+            db.select(Promotion.id, Promotion.revision)
+            .where(Promotion.id.in_(promotion_ids))
+            .order_by(Promotion.id)
+        ).all()
+        with self._lock:
+            found = {}
+            for promotion_id, revision in revisions:
+                evaluator = self._evaluators.get(promotion_id) if self.enabled else None
+                if evaluator is not None and evaluator.revision == revision:
+                    self._evaluators.move_to_end(promotion_id)
+                    found[promotion_id] = evaluator
+            self._stats["hits"] += len(found)
+
+        stale = [promotion_id for promotion_id, _ in revisions if promotion_id not in found]
+        if stale:
+            compiled = [
+                compile_evaluator(*row)
+                for row in db.session.execute(
+                    db.select(Promotion.id, Promotion.code, Promotion.revision, Promotion.promo_type, Promotion.value)
+                    .where(Promotion.id.in_(stale))
+                ).all()
+            ]
+            with self._lock:
+                self._stats["compiles"] += len(compiled)
+                for evaluator in compiled:
+                    found[evaluator.promotion_id] = evaluator
+                    if self.enabled:
+                        self._evaluators[evaluator.promotion_id] = evaluator
+                        self._evaluators.move_to_end(evaluator.promotion_id)
+                while len(self._evaluators) > self.size:
+                    self._evaluators.popitem(last=False)
+                    self._stats["evictions"] += 1
+        return [found[promotion_id] for promotion_id in sorted(found)]
+
+    def clear(self):
+        """Drops every evaluator and resets the counters"""
+        with self._lock:
+            self._evaluators.clear()
+            self._stats = dict.fromkeys(("hits", "compiles", "evictions"), 0)
+
+    def stats(self):
+        """Returns the cache counters and the number of evaluators"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._evaluators)
+        lookups = stats["hits"] + stats["compiles"]
+        stats["hit_ratio"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        return stats
+
+
+# The evaluators of this process, set up by the app
+evaluators = EvaluatorCache()
+
+
+######################################################################
+#  P R I C I N G
+######################################################################
+def pair_discounts(kinds, params, rows, lines, prices, quantities):  # pylint: disable=too-many-arguments
+    """Returns the discount of each (promotion, line) pair
+
+    Args:
+        kinds (ndarray): the promo_type of each promotion
+        params (ndarray): the rule parameter of each promotion
+        rows (ndarray): the promotion of each pair, in ascending order
+        lines (ndarray): the line of each pair, ascending within a promotion
+        prices (ndarray): the unit price of each line, in ascending order
+        quantities (ndarray): the quantity of each line
+    """
+    discounts = np.zeros(len(rows))
+    pair_kinds = kinds[rows]
+    for kind, evaluator in EVALUATORS.items():
+        pairs = pair_kinds == kind
+        if pairs.any():
+            columns = lines[pairs]
+            discounts[pairs] = evaluator.discounts(
+                params[rows[pairs]], rows[pairs], prices[columns], quantities[columns], len(kinds)
+            )
+    return discounts
+
+
+def _arrays(promotions):
+    """Returns the promo_type and the rule parameter of each evaluator as arrays"""
+    kinds = np.fromiter((promotion.kind for promotion in promotions), dtype=np.int64, count=len(promotions))
+    params = np.fromiter((promotion.param for promotion in promotions), dtype=float, count=len(promotions))
+    return kinds, params
+
+
+def line_discounts(promotions, eligible, prices, quantities):
+    """Returns the discount of every promotion on every line, as a matrix
+
+    Args:
+        promotions (list): the Evaluator of each promotion
+        eligible (ndarray): (promotions x lines) booleans, True where a promotion applies
+        prices (ndarray): the unit price of each line, in ascending order
+        quantities (ndarray): the quantity of each line
+    """
+    rows, lines = np.nonzero(eligible)
+    discounts = np.zeros(eligible.shape)
+    discounts[rows, lines] = pair_discounts(*_arrays(promotions), rows, lines, prices, quantities)
+    return discounts
+
+
+def _line_best(rows, lines, discounts, count):
+    """Returns the best per-line promotion row of each line, or -1, and its discount
+
+    The discount of a per-line promotion on a line does not depend on the
+    other lines, so each line simply takes the promotion saving it the most,
+    the first one of a tie.
+
+    Args:
+        rows, lines, discounts (ndarray): the per-line (promotion, line) pairs and their discount
+        count (int): the number of lines
+    """
+    line_promotion, line_discount = np.full(count, -1), np.zeros(count)
+    # by line, then by discount, the lowest row last
+    ordered = np.lexsort((-rows, discounts, lines))
+    best = ordered[np.flatnonzero(np.diff(lines[ordered], append=count))]
+    best = best[discounts[best] > 0]
+    line_promotion[lines[best]] = rows[best]
+    line_discount[lines[best]] = discounts[best]
+    return line_promotion, line_discount
+
+
+def _cart_wide_candidates(rows, lines, discounts, line_saved, count):
+    """Returns the cart wide promotion rows worth searching, the most promising first
+
+    At most CART_WIDE_SEARCH of them: the ones saving the most over the
+    per-line promotions of their lines when applied alone.
+
+    Args:
+        rows, lines, discounts (ndarray): the cart wide (promotion, line) pairs and their discount
+        line_saved (ndarray): the discount of the per-line promotion of each line
+        count (int): the number of promotions
+    """
+    totals = np.bincount(rows, discounts, minlength=count)
+    gains = totals - np.bincount(rows, line_saved[lines], minlength=count)
+    found = np.flatnonzero(totals > 0)
+    return found[np.argsort(-gains[found], kind="stable")][:CART_WIDE_SEARCH].tolist()
+
+
+def _search_cart_wide(candidates, eligible, discounts_of, line_saved):
+    """Returns the cart wide promotions to apply, as (row, lines taken, discounts)
+
+    A cart wide promotion takes every free line it applies to, and what it
+    saves depends on all of them, so the combinations of candidates are
+    searched exactly: what is left to gain only depends on the free lines,
+    which makes the search visit at most one state per set of candidates
+    applied.
+    """
+    memo = {}
+
+    def best(free):
+        key = free.tobytes()
+        if key not in memo:
+            value, plan = 0.0, []
+            for row in candidates:
+                taken = np.flatnonzero(eligible[row] & free)
+                if taken.size == 0:
+                    continue
+                discounts = discounts_of(row, taken)
+                left = free.copy()
+                left[taken] = False
+                rest, rest_plan = best(left)
+                gain = discounts.sum() - line_saved[taken].sum() + rest
+                if discounts.sum() > 0 and gain > value:
+                    value, plan = gain, [(row, taken, discounts)] + rest_plan
+            memo[key] = value, plan
+        return memo[key]
+
+    return best(np.ones(eligible.shape[1], dtype=bool))[1]
+
+
+# pylint: disable-next=too-many-arguments,too-many-locals
+def _add_cart_wide(kinds, params, pairs, free, prices, quantities, line_saved):
+    """Returns the cart wide promotions to apply on the free lines beyond the searched ones
+
+    One at a time, the one gaining the most over the per-line promotions of
+    its lines first, until none gains anything.
+
+    Args:
+        pairs (tuple): the rows and lines of the cart wide (promotion, line) pairs
+        free (ndarray): the lines no promotion took yet, updated as they are taken
+    """
+    rows, lines = pairs
+    left = free[lines]
+    rows, lines = rows[left], lines[left]
+    plan = []
+    while len(rows):
+        discounts = pair_discounts(kinds, params, rows, lines, prices, quantities)
+        totals = np.bincount(rows, discounts, minlength=len(kinds))
+        gains = np.where(totals > 0, totals - np.bincount(rows, line_saved[lines], minlength=len(kinds)), 0)
+        best = int(gains.argmax())
+        if gains[best] <= 0:
+            break
+        taken = rows == best
+        plan.append((best, lines[taken], discounts[taken]))
+        # the lines taken are no longer eligible for any promotion
+        free[lines[taken]] = False
+        left = free[lines]
+        rows, lines = rows[left], lines[left]
+    return plan
+
+
+def evaluate(promotions, eligible, prices, quantities):  # pylint: disable=too-many-locals
+    """Picks the promotions of a cart
+
+    Takes the same arguments as line_discounts(), with the lines in any order.
+
+    Returns:
+        tuple: (the picked promotion rows with the discount of each, the most
+        saving first, the promotion row of each line or -1, the discount of each line)
+    """
+    kinds, params = _arrays(promotions)
+    # sorted once here, so that no rule has to order the lines by price
+    order = np.argsort(prices, kind="stable")
+    eligible = eligible[:, order]
+    prices, quantities = prices[order], quantities[order]
+    rows, lines = np.nonzero(eligible)
+    discounts = pair_discounts(kinds, params, rows, lines, prices, quantities)
+    wide = np.isin(kinds, CART_WIDE)[rows]
+    line_promotion, line_discount = _line_best(rows[~wide], lines[~wide], discounts[~wide], len(prices))
+
+    def discounts_of(row, taken):
+        rule = EVALUATORS[kinds[row]]
+        return rule.discounts(np.full(len(taken), params[row]), np.zeros(len(taken), dtype=np.int64),
+                              prices[taken], quantities[taken], 1)
+
+    candidates = _cart_wide_candidates(rows[wide], lines[wide], discounts[wide], line_discount, len(kinds))
+    plan = _search_cart_wide(candidates, eligible, discounts_of, line_discount)
+    free = np.ones(len(prices), dtype=bool)
+    for _, taken, _ in plan:
+        free[taken] = False
+    plan += _add_cart_wide(kinds, params, (rows[wide], lines[wide]), free, prices, quantities, line_discount)
+    saved = {}
+    for row, taken, discounts in plan:
+        line_promotion[taken] = row
+        line_discount[taken] = discounts
+        saved[row] = float(discounts.sum())
+    per_line = (line_promotion >= 0) & ~np.isin(line_promotion, list(saved))
+    totals = np.bincount(line_promotion[per_line], line_discount[per_line], minlength=len(kinds))
+    saved.update((int(row), float(totals[row])) for row in np.unique(line_promotion[per_line]))
+    picked = sorted(saved.items(), key=lambda item: -item[1])
+
+    unsorted = np.empty_like(order)
+    unsorted[order] = np.arange(len(order))
+    return picked, line_promotion[unsorted], line_discount[unsorted]
+
+
+def _priced_lines(lines, line_promotion, line_discount, promotions):
+    """Returns the cart lines with their subtotal, discount, total and promotion"""
+    priced = []
+    for line, promotion, discount in zip(lines, line_promotion.tolist(), line_discount.tolist()):
+        subtotal = round(line["unit_price"] * line["quantity"], 2)
+        discount = round(discount, 2)
+        priced.append({
+            "product_id": line["product_id"],
+            "quantity": line["quantity"],
+            "unit_price": line["unit_price"],
+            "subtotal": subtotal,
+            "discount": discount,
+            "total": round(subtotal - discount, 2),
+            "promotion_id": promotions[promotion].promotion_id if promotion >= 0 else None,
+        })
+    return priced
+
+
+def price_cart(lines):
+    """Prices cart lines with the best combination of their valid promotions
+
+    Args:
+        lines (list): dicts with the product_id, quantity and unit_price of each line
+
+    Returns:
+        dict: the promotions applied, the lines with their discount, and the totals
+    """
+    product_ids = [line["product_id"] for line in lines]
+    applicable = Promotion.applicable_to(product_ids)
+    promotions = evaluators.get({promotion_id for found in applicable.values() for promotion_id in found})
+
+    row_of = {promotion.promotion_id: row for row, promotion in enumerate(promotions)}
+    eligible = np.zeros((len(promotions), len(lines)), dtype=bool)
+    for column, product_id in enumerate(product_ids):
+        # a promotion deleted since the lookup has no evaluator
+        found = [row_of[promotion_id] for promotion_id in applicable[product_id] if promotion_id in row_of]
+        eligible[found, column] = True
+
+    picked, line_promotion, line_discount = evaluate(
+        promotions,
+        eligible,
+        np.array([line["unit_price"] for line in lines], dtype=float),
+        np.array([line["quantity"] for line in lines], dtype=np.int64),
+    )
+
+    priced = _priced_lines(lines, line_promotion, line_discount, promotions)
+    subtotal = round(sum(line["subtotal"] for line in priced), 2)
+    discount = round(sum(line["discount"] for line in priced), 2)
+    return {
+        "promotions": [
+            {"id": promotions[row].promotion_id, "code": promotions[row].code, "discount": round(saved, 2)}
+            for row, saved in picked
+        ],
+        "lines": priced,
+        "subtotal": subtotal,
+        "discount": discount,
+        "total": round(subtotal - discount, 2),
+    }
@@ -3,11 +3,28 @@ My Service
 
 Describe what your service does here
 """
-from datetime import date
-from flask import render_template, jsonify
-from flask_restx import Resource, fields, reqparse
+# pylint: disable=too-many-lines
+import json
+import zlib
+from flask import Response, render_template, jsonify, request, stream_with_context
+from werkzeug.http import quote_etag
+from flask_restx import Resource, fields, reqparse, inputs, marshal
 from service.common import status  # HTTP Status Codes
-from service.models import Promotion, DataValidationError, Product
+from service.common.pagination import decode_cursor, encode_cursor, next_link, page_size
+from service.models import (
+    db,
+    MAX_INTEGER,
+    Promotion,
+    DataValidationError,
+    PromotionNotApplicableError,
+    Product,
+    payloads,
+    queries,
+    snapshots,
+)
+from service.leases import leases
+from service.pool import monitor
+from service.pricing import evaluators, price_cart
 from . import app, api
 
 # Define the model for Promotion
@@ -32,14 +49,43 @@ create_model = api.model(
             required=True, description="Type of the promotion"
         ),
         "value": fields.Float(required=True, description="Value of the promotion"),
+        "counter_shards": fields.Integer(
+            min=0,
+            max=Promotion.MAX_COUNTER_SHARDS,
+            description="Number of rows the available uses are spread over (0 for a single counter)",
+        ),
         "products": fields.List(
             fields.Integer,
             description="List of product IDs associated with the promotion",
         ),
     },
 )
+
+
+def field_list(value):
+    """Parses a comma separated list of field names"""
+    return [name.strip() for name in value.split(",") if name.strip()]
+
+
 # query string arguments
-promotion_args = reqparse.RequestParser()
+# sparse fieldsets: the fields to return, and the related data to add to them
+projection_args = reqparse.RequestParser()
+projection_args.add_argument(
+    "fields",
+    type=field_list,
+    location="args",
+    required=False,
+    help="Comma separated fields to return, all the default fields if omitted",
+)
+projection_args.add_argument(
+    "expand",
+    type=field_list,
+    location="args",
+    required=False,
+    help="Comma separated related data to add to the fields",
+)
+
+promotion_args = projection_args.copy()
 promotion_args.add_argument(
     "name", type=str, location="args", required=False, help="List Promotions by name"
 )
@@ -53,6 +99,31 @@ promotion_args.add_argument(
     required=False,
     help="List Promotions by promo_type",
 )
+# the export takes the same filters as the list, without the paging
+export_args = promotion_args.copy()
+
+
+def add_page_arguments(parser, items):
+    """Adds the keyset pagination arguments to a parser"""
+    parser.add_argument(
+        "limit",
+        type=inputs.positive,
+        location="args",
+        required=False,
+        help=f"Maximum number of {items} to return, capped by the service",
+    )
+    parser.add_argument(
+        "cursor",
+        type=decode_cursor,
+        location="args",
+        required=False,
+        help="Where the page starts, from the next link of the previous page",
+    )
+    return parser
+
+
+add_page_arguments(promotion_args, "Promotions")
+promotion_product_args = add_page_arguments(reqparse.RequestParser(), "Products")
 
 
 create_product_model = api.model(
@@ -75,6 +146,15 @@ promotion_model = api.inherit(
         "id": fields.Integer(
             readOnly=True, description="The unique id assigned internally by service"
         ),
+        "product_count": fields.Integer(
+            readOnly=True, description="Number of products in the promotion"
+        ),
+        "created_at": fields.DateTime(
+            readOnly=True, description="Creation date of the promotion"
+        ),
+        "updated_at": fields.DateTime(
+            readOnly=True, description="Last update date of the promotion"
+        ),
     },
 )
 
@@ -85,14 +165,207 @@ product_model = api.inherit(
         "id": fields.Integer(
             readOnly=True, description="The unique id assigned internally by service"
         ),
+        "promotions": fields.List(
+            fields.Nested(promotion_model, skip_none=True),
+            readOnly=True,
+            description="The promotions of the product, with expand=promotions",
+        ),
+    },
+)
+
+# the most products one lookup of applicable promotions can ask for
+LOOKUP_MAX_PRODUCTS = 1000
+
+lookup_model = api.model(
+    "PromotionLookup",
+    {
+        "product_ids": fields.List(
+            fields.Integer(min=1, max=MAX_INTEGER),
+            required=True,
+            max_items=LOOKUP_MAX_PRODUCTS,
+            description="The ids of the products, for example the ones in a cart",
+        ),
+    },
+)
+
+applicable_model = api.model(
+    "ApplicablePromotions",
+    {
+        "product_id": fields.Integer(description="The id of a product asked for"),
+        "promotion_ids": fields.List(
+            fields.Integer,
+            description="The valid promotions of the product, whole store ones included",
+        ),
+    },
+)
+
+# the most lines a cart can have to be priced
+CART_MAX_LINES = 1000
+# the most units of a line and the highest unit price, so that the totals of
+# the largest cart stay well within the int64 and float64 arrays they are summed in
+CART_MAX_QUANTITY = 1_000_000
+CART_MAX_UNIT_PRICE = 1_000_000_000
+
+cart_line_model = api.model(
+    "CartLine",
+    {
+        "product_id": fields.Integer(required=True, min=1, max=MAX_INTEGER, description="The id of the product"),
+        "quantity": fields.Integer(required=True, min=1, max=CART_MAX_QUANTITY, description="The number of units"),
+        "unit_price": fields.Float(
+            required=True, min=0, max=CART_MAX_UNIT_PRICE, description="The price of one unit"
+        ),
+    },
+)
+
+cart_model = api.model(
+    "Cart",
+    {
+        "lines": fields.List(
+            fields.Nested(cart_line_model),
+            required=True,
+            min_items=1,
+            max_items=CART_MAX_LINES,
+            description="The lines of the cart",
+        ),
+    },
+)
+
+priced_line_model = api.inherit(
+    "PricedCartLine",
+    cart_line_model,
+    {
+        "subtotal": fields.Float(description="unit_price times quantity"),
+        "discount": fields.Float(description="The amount taken off the line"),
+        "total": fields.Float(description="subtotal minus discount"),
+        "promotion_id": fields.Integer(description="The promotion applied to the line, if any"),
+    },
+)
+
+applied_promotion_model = api.model(
+    "AppliedPromotion",
+    {
+        "id": fields.Integer(description="The id of the promotion"),
+        "code": fields.String(description="The code of the promotion"),
+        "discount": fields.Float(description="The amount the promotion takes off the cart"),
+    },
+)
+
+cart_price_model = api.model(
+    "CartPrice",
+    {
+        "promotions": fields.List(
+            fields.Nested(applied_promotion_model),
+            description="The promotions applied, the one saving the most first",
+        ),
+        "lines": fields.List(fields.Nested(priced_line_model)),
+        "subtotal": fields.Float(),
+        "discount": fields.Float(),
+        "total": fields.Float(),
+    },
+)
+
+# the most promotions a batch can create
+CREATE_MAX_PROMOTIONS = 1000
+
+create_result_model = api.model(
+    "CreateResult",
+    {
+        "id": fields.Integer(description="The id of the new promotion"),
+        "code": fields.String(description="The code of the promotion"),
+        "error": fields.String(description="Why the promotion was not created"),
+    },
+)
+
+batch_create_result_model = api.model(
+    "BatchCreateResult",
+    {
+        "created": fields.Integer(description="The number of promotions created"),
+        "results": fields.List(fields.Nested(create_result_model, skip_none=True)),
+    },
+)
+
+# the most promotions a batch can apply
+APPLY_MAX_PROMOTIONS = 100
+
+batch_apply_model = api.model(
+    "BatchApply",
+    {
+        "ids": fields.List(
+            fields.Integer(min=1, max=MAX_INTEGER),
+            max_items=APPLY_MAX_PROMOTIONS,
+            description="The ids of the promotions to apply",
+        ),
+        "codes": fields.List(
+            fields.String, max_items=APPLY_MAX_PROMOTIONS, description="The codes of the promotions to apply"
+        ),
+    },
+)
+
+apply_result_model = api.model(
+    "ApplyResult",
+    {
+        "id": fields.Integer(description="The id of the promotion, null when not found"),
+        "code": fields.String(description="The code of the promotion, null when not found"),
+        "available": fields.Integer(description="The uses left once applied"),
+        "error": fields.String(description="Why the promotion cannot be applied"),
+    },
+)
+
+batch_apply_result_model = api.model(
+    "BatchApplyResult",
+    {
+        "message": fields.String(description="Why nothing was applied"),
+        "results": fields.List(fields.Nested(apply_result_model, skip_none=True)),
     },
 )
 
+# the most products one request can bind, unbind or replace
+BIND_MAX_PRODUCTS = 100_000
+
+product_ids_model = api.model(
+    "ProductIds",
+    {
+        "product_ids": fields.List(
+            fields.Integer(min=1, max=MAX_INTEGER),
+            required=True,
+            max_items=BIND_MAX_PRODUCTS,
+            description="The ids of the products",
+        ),
+    },
+)
+
+product_binding_result_model = api.model(
+    "ProductBindingResult",
+    {
+        "id": fields.Integer(description="The id of the promotion"),
+        "added": fields.Integer(description="The number of products bound by the request"),
+        "removed": fields.Integer(description="The number of products unbound by the request"),
+        "product_count": fields.Integer(description="The number of products of the promotion now"),
+    },
+)
+
+apply_args = reqparse.RequestParser()
+apply_args.add_argument(
+    "lean",
+    type=inputs.boolean,
+    location="args",
+    required=False,
+    default=False,
+    help="Only return the id and the remaining uses of the Promotion",
+)
+
 product_args = reqparse.RequestParser()
 product_args.add_argument(
     "id", type=int, location="args", required=True, help="The existing product id"
 )
 
+# the fields returned when fields= is omitted: a promotion with the number of
+# its products, which are added with expand=products or paged through
+# /promotions/<id>/products, and a product without its promotions, which are
+# added with expand=promotions
+PROMOTION_DEFAULT_FIELDS = Promotion.DEFAULT_FIELDS
+PRODUCT_DEFAULT_FIELDS = ("id", "created_at", "updated_at")
+
 ######################################################################
 # GET INDEX
 ######################################################################
@@ -116,6 +389,51 @@ def health():
     return jsonify({"status": "OK"}), 200
 
 
+######################################################################
+# Quota Lease Metrics
+# Returns the apply counters of this worker's quota leases
+######################################################################
+
+
+@app.route("/admin/leases", methods=["GET"])
+def lease_stats():
+    """quota lease metrics"""
+    return jsonify(enabled=leases.enabled, **leases.stats()), 200
+
+
+######################################################################
+# Snapshot Cache Metrics
+# Returns the counters of this worker's promotion and product snapshot cache
+######################################################################
+
+
+@app.route("/admin/cache", methods=["GET"])
+def cache_stats():
+    """snapshot, payload and evaluator cache metrics"""
+    return (
+        jsonify(
+            enabled=snapshots.enabled,
+            **snapshots.stats(),
+            queries=queries.stats(),
+            payloads={"enabled": payloads.enabled, **payloads.stats()},
+            evaluators={"enabled": evaluators.enabled, **evaluators.stats()},
+        ),
+        200,
+    )
+
+
+######################################################################
+# Connection Pool Metrics
+# Returns the checkout waits and saturation of this worker's database pool
+######################################################################
+
+
+@app.route("/admin/pool", methods=["GET"])
+def pool_stats():
+    """database connection pool metrics"""
+    return jsonify(enabled=monitor.enabled, **monitor.stats()), 200
+
+
 ######################################################################
 # Promotions User View
 ######################################################################
@@ -125,7 +443,7 @@ def health():
 def promotion_detail_view_id(promotion_id):
     """Root URL response"""
     app.logger.info("Request for ID URL")
-    promotion = Promotion.find(promotion_id)
+    promotion = Promotion.lookup(promotion_id)
     pruducts = Product.all()
 
     if promotion is None:
@@ -134,10 +452,11 @@ def promotion_detail_view_id(promotion_id):
             f"Promotion with id {promotion_id} was not found.",
         )
 
+    bound = set(promotion.bound_product_ids())
     bind_products = [
         {
             "id": product.id,
-            "selected": product in promotion.products,
+            "selected": product.id in bound,
         }
         for product in pruducts
     ]
@@ -151,7 +470,7 @@ def promotion_detail_view_id(promotion_id):
 def promotion_detail_view_code(promotion_id):
     """Root URL response"""
     app.logger.info("Request for Code URL")
-    promotion = Promotion.find_by_code(promotion_id).first()
+    promotion = Promotion.lookup_by_code(promotion_id)
     products = Product.all()
 
     if promotion is None:
@@ -160,10 +479,11 @@ def promotion_detail_view_code(promotion_id):
             f"Promotion with code {promotion_id} was not found.",
         )
 
+    bound = set(promotion.bound_product_ids())
     bind_products = [
         {
             "id": product.id,
-            "selected": product in promotion.products,
+            "selected": product.id in bound,
         }
         for product in products
     ]
@@ -190,12 +510,15 @@ class ProductCollection(Resource):
     # LIST ALL PRODUCTS
     ######################################################################
     @api.doc("list_products")
-    @api.marshal_list_with(product_model)
+    @api.expect(projection_args, validate=True)
+    @api.marshal_list_with(product_model, skip_none=True)
     def get(self):
         """For Promotion Internal Use only: Returns all of the Products"""
         app.logger.info("Request for product list")
+        args = projection_args.parse_args()
+        selected = projection(args, Product.FIELDS, PRODUCT_DEFAULT_FIELDS, ("promotions",))
         products = Product.all()
-        results = [p.serialize() for p in products]
+        results = Product.serialize_all(products, selected)
         app.logger.info("Returning %d products", len(results))
         return results, status.HTTP_200_OK
 
@@ -238,6 +561,35 @@ class ProductCollection(Resource):
             app.logger.error("Error updating promotion: %s", str(error))
             return {"message": "Invalid data or operation"}, status.HTTP_400_BAD_REQUEST
 
+######################################################################
+# PATH: /products/promotions:lookup
+######################################################################
+
+
+@api.route("/products/promotions:lookup")
+class ProductPromotionLookup(Resource):
+    """Finds the Promotions that apply to many Products at once"""
+
+    @api.doc("lookup_product_promotions")
+    @api.response(400, "The posted data was not valid")
+    @api.expect(lookup_model, validate=True)
+    @api.marshal_list_with(applicable_model)
+    def post(self):
+        """
+        Returns the ids of the valid Promotions of each Product
+
+        Whole store promotions are returned for every product. The products
+        are answered in the order given, each once, in a single query.
+        """
+        product_ids = api.payload["product_ids"]
+        app.logger.info("Request for the promotions of %d products", len(product_ids))
+        applicable = Promotion.applicable_to(product_ids)
+        return [
+            {"product_id": product_id, "promotion_ids": promotion_ids}
+            for product_id, promotion_ids in applicable.items()
+        ], status.HTTP_200_OK
+
+
 ######################################################################
 # PATH: /product/<int:product_id>
 ######################################################################
@@ -301,7 +653,7 @@ class PromotionCollection(Resource):
     @api.doc("create_promotions")
     @api.response(415, "Unsupported media type")
     @api.expect(create_model)
-    @api.marshal_with(promotion_model, code=201)
+    @api.marshal_with(promotion_model, code=201, skip_none=True)
     def post(self):
         """
         Create a new promotion.
@@ -342,28 +694,154 @@ class PromotionCollection(Resource):
     ######################################################################
 
     @api.doc("list_promotions")
+    @api.response(304, "Not modified since the If-None-Match ETag")
     @api.expect(promotion_args, validate=True)
-    @api.marshal_list_with(promotion_model)
+    @api.header("Link", 'The next page as <url>; rel="next", absent on the last page')
+    @api.marshal_list_with(promotion_model, skip_none=True)
     def get(self):
-        """Returns all of the Promotions"""
+        """Returns a page of the Promotions in id order"""
         app.logger.info("Request for promotion list")
         args = promotion_args.parse_args()
-        name = args["name"]
-        code = args["code"]
-        promo_type = args["promo_type"]
-
-        if name:
-            promotions = Promotion.find_by_name(name)
-        elif code:
-            promotions = Promotion.find_by_code(code)
-        elif promo_type:
-            promotions = Promotion.find_by_promo_type(promo_type)
+        selected = projection(args, Promotion.FIELDS, PROMOTION_DEFAULT_FIELDS, ("products",))
+
+        # the generation is read before the promotions, see commit_changes()
+        generation = Promotion.generation()
+        etag = collection_tag(generation)
+        if request.if_none_match.contains_weak(etag):
+            return None, status.HTTP_304_NOT_MODIFIED, {"ETag": quote_etag(etag, weak=True)}
+
+        page, headers = paginate(
+            lambda after_id, limit: Promotion.search(
+                generation,
+                after_id,
+                limit,
+                name=args["name"],
+                code=args["code"],
+                promo_type=args["promo_type"],
+            ),
+            args,
+            PromotionCollection,
+            **query_string(args, "name", "code", "promo_type", "fields", "expand"),
+        )
+        results = Promotion.serialize_all(page, selected)
+        app.logger.info("Returning %d promotions", len(results))
+        headers["ETag"] = quote_etag(etag, weak=True)
+        return results, status.HTTP_200_OK, headers
+
+
+######################################################################
+# PATH: /promotions:batch
+######################################################################
+
+
+@api.route("/promotions:batch")
+class PromotionBatchCreate(Resource):
+    """Creates many Promotions at once"""
+
+    @api.doc("create_promotions_in_batch")
+    @api.expect([create_model])
+    @api.response(201, "Every promotion was created", batch_create_result_model)
+    @api.response(200, "Some promotions were created", batch_create_result_model)
+    @api.response(400, "No promotion was created", batch_create_result_model)
+    def post(self):
+        """
+        Create many Promotions in one transaction
+
+        Each promotion is checked like the ones created one at a time. The
+        valid ones are created together and the others reported, with the
+        result of each promotion in the order given.
+        """
+        data = api.payload
+        if not isinstance(data, list) or not data or len(data) > CREATE_MAX_PROMOTIONS:
+            abort(
+                status.HTTP_400_BAD_REQUEST,
+                f"Post a list of 1 to {CREATE_MAX_PROMOTIONS} promotions.",
+            )
+        app.logger.info("Request to create %d promotions", len(data))
+
+        # the promotions and the deserialization errors, by position
+        promotions, results = {}, {}
+        for position, item in enumerate(data):
+            try:
+                promotions[position] = Promotion().deserialize(item)
+            except DataValidationError as error:
+                results[position] = {"code": item.get("code") if isinstance(item, dict) else None, "error": str(error)}
+        results.update(zip(promotions, Promotion.create_all(list(promotions.values()))))
+        results = [results[position] for position in range(len(data))]
+
+        count = sum("error" not in result for result in results)
+        app.logger.info("Created %d of %d promotions", count, len(results))
+        if count == len(results):
+            code = status.HTTP_201_CREATED
         else:
-            promotions = Promotion.all()
+            code = status.HTTP_200_OK if count else status.HTTP_400_BAD_REQUEST
+        return marshal({"created": count, "results": results}, batch_create_result_model), code
 
-        results = [p.serialize() for p in promotions]
-        app.logger.info("Returning %d promotions", len(results))
-        return results, status.HTTP_200_OK
+
+######################################################################
+# PATH: /promotions/export
+######################################################################
+
+
+@api.route("/promotions/export")
+class PromotionExport(Resource):
+    """Streams collections of Promotions"""
+
+    ######################################################################
+    # EXPORT ALL PROMOTIONS
+    ######################################################################
+    @api.doc("export_promotions")
+    @api.expect(export_args, validate=True)
+    @api.produces(["application/x-ndjson"])
+    def get(self):
+        """Streams all of the Promotions, one JSON document per line
+
+        Rows are read in id order from a server-side cursor and written as
+        they are serialized, so the response never sits in memory as a whole.
+        """
+        app.logger.info("Request for promotion export")
+        args = export_args.parse_args()
+        selected = projection(args, Promotion.FIELDS, PROMOTION_DEFAULT_FIELDS, ("products",))
+        promotions = find_promotions(args["name"], args["code"], args["promo_type"])
+
+        def generate():
+            for batch in Promotion.stream(promotions):
+                yield "".join(
+                    json.dumps(data) + "\n" for data in Promotion.serialize_all(batch, selected)
+                )
+
+        return Response(
+            stream_with_context(generate()),
+            status=status.HTTP_200_OK,
+            mimetype="application/x-ndjson",
+        )
+
+
+######################################################################
+# PATH: /promotions/evaluate
+######################################################################
+
+
+@api.route("/promotions/evaluate")
+class PromotionEvaluate(Resource):
+    """Prices carts with the Promotions that apply to them"""
+
+    @api.doc("evaluate_promotions")
+    @api.response(400, "The posted data was not valid")
+    @api.expect(cart_model, validate=True)
+    @api.marshal_with(cart_price_model)
+    def post(self):
+        """
+        Prices a cart with the best combination of its valid Promotions
+
+        A line gets at most one promotion, the per-line one saving it the most
+        unless a cart wide one takes it; whole store promotions apply to every
+        line. The promotions applied and the price of each line are returned
+        with the totals.
+        """
+        lines = api.payload["lines"]
+        app.logger.info("Request to price a cart of %d lines", len(lines))
+        return price_cart(lines), status.HTTP_200_OK
 
 
 ######################################################################
@@ -413,6 +891,7 @@ class PromotionResource(Resource):
 
         app.logger.info("Deleting promotion with id %s", promotion_id)
         promotion.delete()
+        leases.discard(promotion_id)
 
         return "", status.HTTP_204_NO_CONTENT
 
@@ -422,8 +901,9 @@ class PromotionResource(Resource):
     @api.doc("update_promotions")
     @api.response(404, "Promotion not found")
     @api.response(400, "Bad request")
+    @api.response(412, "The If-Match ETag is not the current one")
     @api.expect(create_model)
-    @api.marshal_with(promotion_model)
+    @api.marshal_with(promotion_model, skip_none=True)
     def put(self, promotion_id):
         """Update a Promotion
         This endpoint will update a Promotion based on the body that is posted
@@ -432,42 +912,174 @@ class PromotionResource(Resource):
         Returns:
             json: The promotion that was updated
         """
-        promotion = Promotion.find(promotion_id)
+        # a conditional update holds the row from the check to the commit
+        if request.if_match:
+            promotion = Promotion.find_for_update(promotion_id)
+        else:
+            promotion = Promotion.find(promotion_id)
         if not promotion:
             abort(
                 status.HTTP_404_NOT_FOUND,
                 f"Promotion with id {promotion_id} was not found.",
             )
+        if request.if_match and not request.if_match.contains(
+            entity_tag(promotion, PROMOTION_DEFAULT_FIELDS)
+        ):
+            abort(
+                status.HTTP_412_PRECONDITION_FAILED,
+                f"Promotion with id {promotion_id} was changed since it was read.",
+            )
         app.logger.info("Updating promotion with id %s", promotion_id)
         data = api.payload
-        promotion.deserialize(data)
-
-        promotion.update()
-        return (promotion.serialize(), status.HTTP_200_OK)
+        try:
+            promotion.deserialize(data)
+            promotion.update()
+        except DataValidationError as error:
+            # drop the attributes set on the promotion, and its lock
+            db.session.rollback()
+            abort(status.HTTP_400_BAD_REQUEST, str(error))
+        etag = entity_tag(promotion, PROMOTION_DEFAULT_FIELDS)
+        return (promotion.serialize(), status.HTTP_200_OK, {"ETag": quote_etag(etag)})
 
     ######################################################################
     # RETRIEVE A PROMOTION
     ######################################################################
 
     @api.doc("get_promotions")
+    @api.response(200, "Success", promotion_model)
     @api.response(404, "Promotion not found")
-    @api.marshal_with(promotion_model)
+    @api.response(304, "Not modified since the If-None-Match ETag")
+    @api.expect(projection_args, validate=True)
     def get(self, promotion_id):
         """
         Retrieve a single Promotion
 
-        This endpoint will return a Promotion based on it's id
+        This endpoint will return a Promotion based on it's id.
+        The encoded response is served from the payload cache when it holds
+        the current version of the promotion.
         """
         app.logger.info("Request for promotion with id: %s", promotion_id)
-        promotion = Promotion.find(promotion_id)
-        if not promotion:
+        args = projection_args.parse_args()
+        selected = projection(args, Promotion.FIELDS, PROMOTION_DEFAULT_FIELDS, ("products",))
+        version, cached = payloads.get(promotion_id, selected)
+        if cached is not None:
+            etag, body = cached
+        else:
+            # read from the database: the snapshot may predate the version
+            promotion = Promotion.find(promotion_id)
+            if not promotion:
+                abort(
+                    status.HTTP_404_NOT_FOUND,
+                    f"Promotion with id '{promotion_id}' was not found.",
+                )
+            etag = entity_tag(promotion, selected)
+            body = encode_json(marshal(promotion.serialize(fields=selected), promotion_model, skip_none=True))
+            # the uses left of sharded promotions change without a new version
+            if not promotion.counter_shards:
+                payloads.put(promotion_id, version, selected, etag, body)
+
+        headers = {"ETag": quote_etag(etag)}
+        if request.if_none_match.contains_weak(etag):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        app.logger.info("Returning promotion %s", promotion_id)
+        return Response(body, status=status.HTTP_200_OK, mimetype="application/json", headers=headers)
+
+
+######################################################################
+# PATH: /promotions/<int:promotion_id>/products
+######################################################################
+
+
+@api.route("/promotions/<int:promotion_id>/products")
+@api.param("promotion_id", "The Promotion identifier")
+class PromotionProductCollection(Resource):
+    """Handles the Products bound to a Promotion"""
+
+    ######################################################################
+    # LIST THE PRODUCTS OF A PROMOTION
+    ######################################################################
+    @api.doc("list_promotion_products")
+    @api.expect(promotion_product_args, validate=True)
+    @api.response(404, "Promotion not found")
+    @api.header("Link", 'The next page as <url>; rel="next", absent on the last page')
+    @api.marshal_list_with(product_model, skip_none=True)
+    def get(self, promotion_id):
+        """Returns a page of the Products of a Promotion in id order"""
+        app.logger.info("Request for the products of promotion %s", promotion_id)
+        args = promotion_product_args.parse_args()
+        promotion = Promotion.lookup(promotion_id)
+        if promotion is None:
             abort(
                 status.HTTP_404_NOT_FOUND,
-                f"Promotion with id '{promotion_id}' was not found.",
+                f"Promotion with id {promotion_id} was not found.",
             )
 
-        app.logger.info("Returning promotion: %s", promotion.name)
-        return promotion.serialize(), status.HTTP_200_OK
+        page, headers = paginate(
+            promotion.product_page, args, PromotionProductCollection, promotion_id=promotion_id
+        )
+        results = Product.serialize_all(page, PRODUCT_DEFAULT_FIELDS)
+        app.logger.info("Returning %d products", len(results))
+        return results, status.HTTP_200_OK, headers
+
+    ######################################################################
+    # REPLACE THE PRODUCTS OF A PROMOTION
+    ######################################################################
+    @api.doc("replace_promotion_products")
+    @api.response(400, "The posted data was not valid")
+    @api.response(404, "Promotion not found")
+    @api.expect(product_ids_model)
+    @api.marshal_with(product_binding_result_model)
+    def put(self, promotion_id):
+        """
+        Makes the Products of a Promotion exactly the ones given
+
+        Only the difference is written: the other products are unbound and
+        the missing ones bound, creating the products that do not exist.
+        """
+        product_ids = product_ids_payload()
+        promotion = find_promotion_for_bindings(promotion_id)
+        added, removed = promotion.replace_products(product_ids)
+        return binding_result(promotion, added, removed), status.HTTP_200_OK
+
+    ######################################################################
+    # BIND PRODUCTS TO A PROMOTION
+    ######################################################################
+    @api.doc("bind_promotion_products")
+    @api.response(400, "The posted data was not valid")
+    @api.response(404, "Promotion not found")
+    @api.expect(product_ids_model)
+    @api.marshal_with(product_binding_result_model)
+    def post(self, promotion_id):
+        """
+        Binds many Products to a Promotion
+
+        Products that do not exist are created and the ones already in the
+        promotion are skipped.
+        """
+        product_ids = product_ids_payload()
+        promotion = find_promotion_for_bindings(promotion_id)
+        added = promotion.add_products(product_ids)
+        return binding_result(promotion, added, 0), status.HTTP_200_OK
+
+    ######################################################################
+    # UNBIND PRODUCTS FROM A PROMOTION
+    ######################################################################
+    @api.doc("unbind_promotion_products")
+    @api.response(400, "The posted data was not valid")
+    @api.response(404, "Promotion not found")
+    @api.expect(product_ids_model)
+    @api.marshal_with(product_binding_result_model)
+    def delete(self, promotion_id):
+        """
+        Unbinds many Products from a Promotion
+
+        Products that are not in the promotion are skipped.
+        """
+        product_ids = product_ids_payload()
+        promotion = find_promotion_for_bindings(promotion_id)
+        removed = promotion.remove_products(product_ids)
+        return binding_result(promotion, 0, removed), status.HTTP_200_OK
 
 
 ######################################################################
@@ -484,6 +1096,7 @@ class PromotionApply(Resource):
     # Apply Promotion
     ######################################################################
     @api.doc("apply_promotion")
+    @api.expect(apply_args, validate=True)
     @api.response(404, "Promotion not found")
     @api.response(405, "Promotion cannot be applied")
     def post(self, promotion_id):
@@ -495,39 +1108,69 @@ class PromotionApply(Resource):
         Returns:
             json: The data of the promotion
         """
-        promotion = Promotion.find(promotion_id)
+        args = apply_args.parse_args()
+        app.logger.info("Applying promotion with id %s", promotion_id)
+        try:
+            remaining = leases.redeem(promotion_id)
+        except PromotionNotApplicableError as error:
+            app.logger.warning("Received request to apply a promotion: %s", error)
+            abort(status.HTTP_405_METHOD_NOT_ALLOWED, str(error))
 
-        if promotion is None:
+        if remaining is None:
             abort(
                 status.HTTP_404_NOT_FOUND,
                 f"Promotion with id {promotion_id} was not found.",
             )
-        if date.today() > promotion.expired:
-            app.logger.warning("Received request to apply an expired promotion.")
-            abort(
-                status.HTTP_405_METHOD_NOT_ALLOWED,
-                "Applying expired promotions is not supported",
-            )
-        elif date.today() < promotion.start:
-            app.logger.warning("Received request to apply an Inactive promotion.")
-            abort(
-                status.HTTP_405_METHOD_NOT_ALLOWED,
-                "Applying Inactive promotions is not supported",
-            )
 
-        if promotion.available == 0:
-            app.logger.warning("Received request to apply an unavailable promotion.")
-            abort(
-                status.HTTP_405_METHOD_NOT_ALLOWED,
-                "Applying unavailable promotions is not supported, reach the limit of promotion",
-            )
+        if args["lean"]:
+            return {"id": promotion_id, "available": remaining}, status.HTTP_200_OK
 
-        app.logger.info("Applying promotion with id %s", promotion_id)
-        promotion.available -= 1
-        promotion.update()
+        promotion = Promotion.lookup(promotion_id)
         return (promotion.serialize(), status.HTTP_200_OK)
 
 
+######################################################################
+# PATH: /promotions/apply:batch
+######################################################################
+
+
+@api.route("/promotions/apply:batch")
+class PromotionBatchApply(Resource):
+    """Apply action on several Promotions at once"""
+
+    @api.doc("apply_promotions")
+    @api.expect(batch_apply_model, validate=True)
+    @api.response(200, "Success", batch_apply_result_model)
+    @api.response(400, "The posted data was not valid")
+    @api.response(404, "A promotion was not found", batch_apply_result_model)
+    @api.response(405, "A promotion cannot be applied", batch_apply_result_model)
+    def post(self):
+        """
+        Apply several Promotions in one transaction
+
+        Every promotion is applied, or none is: the result of each id then of
+        each code tells the uses left, or why it cannot be applied.
+        """
+        ids = api.payload.get("ids") or []
+        codes = api.payload.get("codes") or []
+        if not ids and not codes:
+            abort(status.HTTP_400_BAD_REQUEST, "Give the ids or the codes of the promotions to apply.")
+        app.logger.info("Applying %d promotions by id and %d by code", len(ids), len(codes))
+
+        applied, results = Promotion.redeem_all(ids, codes)
+        body = {"results": results}
+        if applied:
+            return marshal(body, batch_apply_result_model, skip_none=True), status.HTTP_200_OK
+
+        app.logger.warning("Received request to apply promotions that cannot all be applied")
+        body["message"] = "No promotion was applied."
+        not_found = any(result["id"] is None for result in results)
+        return (
+            marshal(body, batch_apply_result_model, skip_none=True),
+            status.HTTP_404_NOT_FOUND if not_found else status.HTTP_405_METHOD_NOT_ALLOWED,
+        )
+
+
 ######################################################################
 # Cancel A Promotion
 ######################################################################
@@ -556,6 +1199,7 @@ class PromotionCancel(Resource):
             )
         app.logger.info("Canceling promotion with id %s", promotion_id)
         promotion.invalidate()
+        leases.discard(promotion_id)
         return (promotion.serialize(), status.HTTP_200_OK)
 
 
@@ -591,19 +1235,12 @@ class PromotionBindProduct(Resource):
                 status.HTTP_404_NOT_FOUND,
                 f"Promotion with id {promotion_id} was not found.",
             )
-        # check if product is in the promotion
-        product = Product.find(product_id)
-        if product is None:
-            product = Product(id=product_id)
-            product.create()
-            promotion.products.append(product)
-        elif product in promotion.products:
+        # missing products are created, bound ones are rejected
+        if not promotion.bind_product(product_id):
             abort(
                 status.HTTP_409_CONFLICT,
                 f"Product with id {product_id} is already in the promotion.",
             )
-        else:
-            promotion.products.append(product)
 
         app.logger.info("Updating promotion with id %s", promotion_id)
         return (promotion.serialize(), status.HTTP_200_OK)
@@ -642,19 +1279,19 @@ class PromotionUnbindProduct(Resource):
                 f"Promotion with id {promotion_id} was not found.",
             )
         # check if product is in the promotion
-        product = Product.find(product_id)
+        product = Product.lookup(product_id)
         if product is None:
             abort(
                 status.HTTP_404_NOT_FOUND,
                 f"Product with id {product_id} was not found.",
             )
-        elif product not in promotion.products:
+        try:
+            promotion.unbind_product(product_id)
+        except DataValidationError:
             abort(
                 status.HTTP_409_CONFLICT,
                 f"Product with id {product_id} is not in the promotion.",
             )
-        else:
-            promotion.products.remove(product)
 
         app.logger.info("Updating promotion with id %s", promotion_id)
         return (promotion.serialize(), status.HTTP_200_OK)
@@ -665,6 +1302,135 @@ class PromotionUnbindProduct(Resource):
 ######################################################################
 
 
+def projection(args, known, default, expandable):
+    """Returns the fields to serialize for the fields= and expand= arguments
+
+    Args:
+        args (dict): the parsed projection_args
+        known (tuple): every field of the representation
+        default (tuple): the fields returned when fields= is omitted
+        expandable (tuple): the related data expand= can add
+    """
+    requested = args["fields"] or list(default)
+    expand = args["expand"] or []
+    unknown = [name for name in requested if name not in known]
+    unknown += [name for name in expand if name not in expandable]
+    if unknown:
+        abort(status.HTTP_400_BAD_REQUEST, f"Unknown fields: {', '.join(unknown)}")
+    return list(dict.fromkeys(requested + expand))
+
+
+def paginate(fetch, args, resource, **url_args):
+    """Returns a page of rows and the headers linking to the next one
+
+    Args:
+        fetch (function): called with (after_id, limit), returns the rows in id order
+        args (dict): the parsed limit and cursor arguments
+        resource (Resource): the resource the next link points to
+        url_args (dict): the other arguments of the next link
+    """
+    # one extra row tells whether there is a next page
+    limit = page_size(args["limit"])
+    page = fetch(args["cursor"], limit + 1)
+    headers = {}
+    if len(page) > limit:
+        page = page[:limit]
+        url = api.url_for(
+            resource,
+            limit=limit,
+            cursor=encode_cursor(page[-1].id),
+            _external=True,
+            **url_args,
+        )
+        headers["Link"] = next_link(url)
+    return page, headers
+
+
+def query_string(args, *names):
+    """Returns the arguments that were given, as they appear in a query string"""
+    given = {}
+    for name in names:
+        value = args.get(name)
+        if value:
+            given[name] = ",".join(value) if isinstance(value, list) else value
+    return given
+
+
+def entity_tag(promotion, selected):
+    """Returns the strong ETag of a Promotion in the representation with the given fields"""
+    return f"{promotion.etag()}-{zlib.crc32(','.join(selected).encode()):08x}"
+
+
+def encode_json(data):
+    """Returns a response body encoded the way the API encodes JSON"""
+    return (json.dumps(data, **app.config.get("RESTX_JSON", {})) + "\n").encode()
+
+
+def collection_tag(generation):
+    """Returns the weak ETag of a list of Promotions, as asked for by the query string"""
+    return f"{generation}-{zlib.crc32(request.query_string):08x}"
+
+
+def find_promotions(name=None, code=None, promo_type=None):
+    """Returns the finder query for the first filter given, or None for all Promotions"""
+    if name:
+        return Promotion.find_by_name(name)
+    if code:
+        return Promotion.find_by_code(code)
+    if promo_type:
+        return Promotion.find_by_promo_type(promo_type)
+    return None
+
+
+def product_ids_payload():
+    """Returns the product ids posted to change the products of a Promotion, or aborts with 400
+
+    The list is checked here rather than against the JSON schema of the
+    model, which takes seconds to walk a hundred thousand ids.
+    """
+    product_ids = api.payload.get("product_ids") if isinstance(api.payload, dict) else None
+    if (
+        not isinstance(product_ids, list)
+        or len(product_ids) > BIND_MAX_PRODUCTS
+        or not all(
+            isinstance(product_id, int) and not isinstance(product_id, bool) and 1 <= product_id <= MAX_INTEGER
+            for product_id in product_ids
+        )
+    ):
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            f"Post the product_ids, a list of up to {BIND_MAX_PRODUCTS} integers from 1 to {MAX_INTEGER}.",
+        )
+    return product_ids
+
+
+def find_promotion_for_bindings(promotion_id):
+    """Returns a Promotion locked until its bindings are committed, or aborts with 404
+
+    The lock makes concurrent changes to the products of one promotion
+    apply one after the other.
+    """
+    app.logger.info("Request to change the products of promotion %s", promotion_id)
+    promotion = Promotion.find_for_update(promotion_id)
+    if promotion is None:
+        abort(
+            status.HTTP_404_NOT_FOUND,
+            f"Promotion with id {promotion_id} was not found.",
+        )
+    return promotion
+
+
+def binding_result(promotion, added, removed):
+    """Returns the body answering a change to the products of a Promotion"""
+    app.logger.info("Bound %d and unbound %d products of promotion %s", added, removed, promotion.id)
+    return {
+        "id": promotion.id,
+        "added": added,
+        "removed": removed,
+        "product_count": promotion.count_products(),
+    }
+
+
 def abort(error_code: int, message: str):
     """Logs errors before aborting"""
     app.logger.error(message)
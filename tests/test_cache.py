@@ -0,0 +1,160 @@
+"""
+Test cases for the shared payload cache
+
+"""
+import unittest
+from unittest.mock import patch
+
+import fakeredis
+from flask import Flask
+from service.common.cache import MemoryBackend, PayloadCache, RedisBackend, create_backend
+
+FIELDS = ("id", "name")
+
+
+######################################################################
+#  P A Y L O A D   C A C H E   T E S T   C A S E S
+######################################################################
+class PayloadCacheTests:
+    """Test Cases shared by every backend of the PayloadCache"""
+
+    def make_backend(self):
+        """Returns a new backend, sharing its data with the other ones of the test"""
+        raise NotImplementedError
+
+    def setUp(self):  # pylint: disable=invalid-name
+        """This runs before each test"""
+        self.cache = PayloadCache(self.make_backend(), ttl=60)
+
+    def test_miss_then_hit(self):
+        """It should return a stored payload with its ETag"""
+        version, cached = self.cache.get(1, FIELDS)
+        self.assertEqual(version, 0)
+        self.assertIsNone(cached)
+        self.cache.put(1, version, FIELDS, "1-1-abc", b'{"id": 1}\n')
+        self.assertEqual(self.cache.get(1, FIELDS), (0, ("1-1-abc", b'{"id": 1}\n')))
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["stores"]), (1, 1, 1))
+        self.assertEqual(stats["hit_ratio"], 0.5)
+
+    def test_fields_cached_apart(self):
+        """It should keep the payloads of different fields apart"""
+        self.cache.put(1, 0, FIELDS, "a", b"{}")
+        self.assertIsNone(self.cache.get(1, ("id",))[1])
+
+    def test_bump_invalidates_every_worker(self):
+        """It should make every worker sharing the backend miss after a bump"""
+        other = PayloadCache(self.make_backend(), ttl=60)
+        self.cache.put(1, 0, FIELDS, "a", b"{}")
+        self.assertIsNotNone(other.get(1, FIELDS)[1])
+        other.bump(1)
+        version, cached = self.cache.get(1, FIELDS)
+        self.assertEqual(version, 1)
+        self.assertIsNone(cached)
+        self.assertIsNotNone(self.cache.get(2, FIELDS)[0])
+
+    def test_payload_read_before_bump_not_found(self):
+        """It should never serve a payload read at a version that was bumped meanwhile"""
+        version, _ = self.cache.get(1, FIELDS)
+        self.cache.bump(1)
+        self.cache.put(1, version, FIELDS, "stale", b"{}")
+        self.assertIsNone(self.cache.get(1, FIELDS)[1])
+
+
+class TestMemoryPayloadCache(PayloadCacheTests, unittest.TestCase):
+    """Test Cases for the PayloadCache on a MemoryBackend"""
+
+    def setUp(self):
+        """This runs before each test"""
+        self.backend = MemoryBackend(size=2)
+        super().setUp()
+
+    def make_backend(self):
+        return self.backend
+
+    def test_least_recently_used_evicted(self):
+        """It should evict payloads but never versions"""
+        self.backend.incr("version", 60)
+        for key in ("a", "b", "c"):
+            self.backend.set(key, b"x", 60)
+        self.assertIsNone(self.backend.get("a"))
+        self.assertEqual(self.backend.get("c"), b"x")
+        self.assertEqual(self.backend.get("version"), 1)
+
+    def test_payload_expires(self):
+        """It should drop a payload after its time to live"""
+        with patch("service.common.cache.time.monotonic", return_value=100.0):
+            self.backend.set("a", b"x", 5)
+        with patch("service.common.cache.time.monotonic", return_value=106.0):
+            self.assertIsNone(self.backend.get("a"))
+
+    def test_version_expires(self):
+        """It should drop a version once neither read nor bumped for its time to live"""
+        with patch("service.common.cache.time.monotonic", return_value=100.0):
+            self.cache.bump(1)
+            self.cache.bump(2)
+        with patch("service.common.cache.time.monotonic", return_value=3000.0):
+            self.assertEqual(self.cache.get(1, FIELDS)[0], 1)
+        with patch("service.common.cache.time.monotonic", return_value=3701.0):
+            # read at 3000, so kept until 6600
+            self.assertEqual(self.cache.get(1, FIELDS)[0], 1)
+            self.assertEqual(self.cache.get(2, FIELDS)[0], 0)
+        self.assertEqual(list(self.backend._counters), ["promotions:1:version"])  # pylint: disable=protected-access
+
+
+class TestRedisPayloadCache(PayloadCacheTests, unittest.TestCase):
+    """Test Cases for the PayloadCache on a RedisBackend"""
+
+    def setUp(self):
+        """This runs before each test"""
+        self.server = fakeredis.FakeServer()
+        super().setUp()
+
+    def make_backend(self):
+        return RedisBackend(fakeredis.FakeRedis(server=self.server))
+
+    def test_payload_expires(self):
+        """It should store payloads and versions with their time to live"""
+        self.cache.bump(1)
+        self.cache.put(1, 1, FIELDS, "a", b"{}")
+        client = fakeredis.FakeRedis(server=self.server)
+        (key,) = [key for key in client.keys() if not key.endswith(b":version")]
+        self.assertGreater(client.pttl(key), 59000)
+        self.assertGreater(client.pttl(b"promotions:1:version"), 3599000)
+
+        client.pexpire(b"promotions:1:version", 1000)
+        self.cache.get(1, FIELDS)
+        self.assertGreater(client.pttl(b"promotions:1:version"), 3599000)
+
+    def test_server_down(self):
+        """It should count the errors and fall back to the database when the server is down"""
+        self.server.connected = False
+        self.assertEqual(self.cache.get(1, FIELDS), (None, None))
+        self.cache.put(1, 0, FIELDS, "a", b"{}")
+        self.cache.bump(1)
+        self.assertEqual(self.cache.stats()["errors"], 3)
+
+
+class TestCreateBackend(unittest.TestCase):
+    """Test Cases for the cache URLs"""
+
+    def test_backends(self):
+        """It should create the backend of a cache URL"""
+        self.assertIsNone(create_backend(""))
+        self.assertIsInstance(create_backend("memory://"), MemoryBackend)
+        self.assertIsInstance(create_backend("redis://localhost:6379/0"), RedisBackend)
+        self.assertRaises(ValueError, create_backend, "memcached://localhost")
+
+    def test_version_ttl_longer_than_payloads(self):
+        """It should refuse versions kept no longer than the payloads"""
+        app = Flask(__name__)
+        app.config.update(PROMOTION_PAYLOAD_CACHE_TTL=60, PROMOTION_PAYLOAD_VERSION_TTL=60)
+        self.assertRaises(ValueError, PayloadCache().init_app, app)
+
+    def test_disabled_cache(self):
+        """It should always miss without a backend"""
+        cache = PayloadCache()
+        self.assertFalse(cache.enabled)
+        cache.put(1, 0, FIELDS, "a", b"{}")
+        cache.bump(1)
+        self.assertEqual(cache.get(1, FIELDS), (None, None))
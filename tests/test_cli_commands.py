@@ -1,11 +1,30 @@
 """
 CLI Command Extensions for Flask
 """
+import gzip
+import io
+import json
 import os
+import tempfile
 from unittest import TestCase
 from unittest.mock import patch, MagicMock
 from click.testing import CliRunner
-from service.common.cli_commands import db_create
+from flask import Flask
+from sqlalchemy.exc import DataError
+from service import bulk
+from service.bulk import BackgroundWriter, WRITE_QUEUE_DEPTH
+from service.common.cli_commands import db_create, promotions_explain, promotions_export, promotions_import
+from service.models import db, Product, Promotion, PromotionCounter, promotion_product
+
+PROMOTION = {
+    "name": "Imported",
+    "start": "2024-01-01",
+    "expired": "2030-01-01",
+    "whole_store": False,
+    "promo_type": 1,
+    "value": 10.0,
+    "available": 5,
+}
 
 
 class TestFlaskCLI(TestCase):
@@ -21,3 +40,224 @@ class TestFlaskCLI(TestCase):
         with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
             result = self.runner.invoke(db_create)
             self.assertEqual(result.exit_code, 0)
+
+    def test_promotions_explain(self):
+        """It should confirm that every finder is read through an index"""
+        result = self.runner.invoke(promotions_explain, ["--seed", "20000"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        for finder in ("find_by_name", "find_by_promo_type", "find_active"):
+            self.assertIn(f"{finder} (", result.output)
+        self.assertNotIn("NO INDEX", result.output)
+
+    def test_promotions_explain_missing_index(self):
+        """It should fail when a finder is not read through its own index"""
+        # DDL is transactional: the command rolls the drop back when it is done
+        db.session.execute(db.text("DROP INDEX ix_promotion_promo_type_id"))
+        db.session.execute(db.text("DROP INDEX ix_promotion_active_window"))
+        result = self.runner.invoke(promotions_explain, ["--seed", "20000"])
+        self.assertEqual(result.exit_code, 1, result.output)
+        self.assertIn("find_by_promo_type (first page): NO INDEX, expected ix_promotion_promo_type_id", result.output)
+        self.assertIn("find_active (all rows): NO INDEX, expected ix_promotion_active_window", result.output)
+        self.assertIn("find_by_name (all rows): index ix_promotion_name_id", result.output)
+        indexes = [index["name"] for index in db.inspect(db.engine).get_indexes("promotion")]
+        self.assertIn("ix_promotion_promo_type_id", indexes)
+        self.assertIn("ix_promotion_active_window", indexes)
+
+
+class TestPromotionsFiles(TestCase):
+    """Test the promotions-import and promotions-export commands"""
+
+    def setUp(self):
+        self.runner = CliRunner()
+        self.directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.clear()
+
+    @staticmethod
+    def clear():
+        """Deletes the promotions and products"""
+        db.session.query(promotion_product).delete()
+        db.session.query(Product).delete()
+        db.session.query(Promotion).delete()
+        db.session.commit()
+
+    def tearDown(self):
+        self.directory.cleanup()
+        db.session.remove()
+
+    def write(self, name, text):
+        """Writes a file to import and returns its path"""
+        path = os.path.join(self.directory.name, name)
+        with (gzip.open if name.endswith(".gz") else open)(path, "wt", encoding="utf-8") as file:
+            file.write(text)
+        return path
+
+    def test_import_ndjson(self):
+        """It should import promotions with their products and shards, by COPY or executemany"""
+        for options in ([], ["--no-copy"]):
+            records = [
+                dict(PROMOTION, code=f"N1{options}", products=[1, 2]),
+                dict(PROMOTION, code=f"N2{options}", available=10, counter_shards=3),
+            ]
+            path = self.write("promotions.ndjson.gz", "".join(json.dumps(record) + "\n" for record in records))
+            result = self.runner.invoke(promotions_import, [path, "--chunk-size", "1"] + options)
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn("Imported 2 promotions and 2 bindings", result.output)
+
+            first = Promotion.find_by_code(f"N1{options}").first()
+            self.assertEqual(first.bound_product_ids(), [1, 2])
+            sharded = Promotion.find_by_code(f"N2{options}").first()
+            shards = PromotionCounter.query.filter_by(promotion_id=sharded.id).order_by(PromotionCounter.shard)
+            self.assertEqual([shard.available for shard in shards], [4, 3, 3])
+
+    def test_import_csv(self):
+        """It should import a CSV file and reject its invalid records"""
+        header = "code,name,start,expired,whole_store,promo_type,value,available,counter_shards,products"
+        path = self.write(
+            "promotions.csv",
+            f"""{header}
+C1,One,2024-01-01,2030-01-01,true,1,10,5,,7 8
+C2,,2024-01-01,2030-01-01,false,1,10,5,,
+C3,Three,2024-01-01,2030-01-01,false,1,10,5,,x
+C1,Again,2024-01-01,2030-01-01,false,1,10,5,,
+""",
+        )
+        result = self.runner.invoke(promotions_import, [path])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("4 records read, 1 created, 1 skipped, 2 rejected", result.output)
+        self.assertIn("line 3: name attribute is not set", result.stderr)
+        self.assertIn("line 4: Invalid product id", result.stderr)
+        promotion = Promotion.find_by_code("C1").first()
+        self.assertEqual((promotion.name, promotion.whole_store), ("One", True))
+        self.assertEqual(promotion.bound_product_ids(), [7, 8])
+
+    def test_import_without_copy_support(self):
+        """It should import with executemany by default on a database other than PostgreSQL"""
+        records = [dict(PROMOTION, code="S1", products=[1, 2]), dict(PROMOTION, code="S2", available=10, counter_shards=3)]
+        stream = io.StringIO("".join(json.dumps(record) + "\n" for record in records))
+        sqlite = Flask(__name__)
+        sqlite.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+        db.init_app(sqlite)
+        with sqlite.app_context():
+            db.create_all()
+            totals = list(bulk.import_promotions(stream, "ndjson", chunk_size=1))[-1]
+            self.assertEqual((totals["created"], totals["bindings"], totals["rejected"]), (2, 2, 0))
+            codes = db.session.scalars(db.select(Promotion.code).order_by(Promotion.code)).all()
+            self.assertEqual(codes, ["S1", "S2"])
+            self.assertEqual(db.session.query(PromotionCounter).count(), 3)
+            db.session.remove()
+
+    def test_import_out_of_range(self):
+        """It should reject the records with integers out of the range of the columns"""
+        records = [
+            dict(PROMOTION, code="R1", available=2**40),
+            dict(PROMOTION, code="R2", promo_type=-(2**31) - 1),
+            dict(PROMOTION, code="R3", products=[1, 2**31]),
+            dict(PROMOTION, code="R4", products=[2**31 - 1]),
+        ]
+        path = self.write("promotions.ndjson", "".join(json.dumps(record) + "\n" for record in records))
+        result = self.runner.invoke(promotions_import, [path])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("4 records read, 1 created, 0 skipped, 3 rejected", result.output)
+        self.assertIn("line 1: available attribute is out of range", result.stderr)
+        self.assertIn("line 2: promo_type attribute is out of range", result.stderr)
+        self.assertIn("line 3: Invalid product id", result.stderr)
+        self.assertEqual(Promotion.find_by_code("R4").first().bound_product_ids(), [2**31 - 1])
+
+    def test_import_failed_chunk(self):
+        """It should roll back a chunk that fails to load, keeping the chunks before it"""
+        records = [dict(PROMOTION, code="F1"), dict(PROMOTION, code="F2")]
+        path = self.write("promotions.ndjson", "".join(json.dumps(record) + "\n" for record in records))
+        copy_chunk = bulk._copy_chunk  # pylint: disable=protected-access
+
+        def fail_second(rows):
+            if rows[0][1] == "F2":
+                db.session.execute(db.text("SELECT 1/0"))
+            return copy_chunk(rows)
+
+        with patch("service.bulk._copy_chunk", side_effect=fail_second):
+            result = self.runner.invoke(promotions_import, [path, "--chunk-size", "1"])
+        self.assertIsInstance(result.exception, DataError)
+        # the session is usable again
+        self.assertEqual(Promotion.find_by_code("F1").count(), 1)
+        self.assertEqual(Promotion.find_by_code("F2").count(), 0)
+
+    def test_import_again(self):
+        """It should skip the promotions imported before"""
+        path = self.write("promotions.ndjson", json.dumps(dict(PROMOTION, code="AGAIN")) + "\n")
+        self.assertEqual(self.runner.invoke(promotions_import, [path]).exit_code, 0)
+        result = self.runner.invoke(promotions_import, [path, "--format", "ndjson"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("0 created, 1 skipped", result.output)
+        self.assertEqual(Promotion.find_by_code("AGAIN").count(), 1)
+
+        result = self.runner.invoke(promotions_import, [self.write("empty.ndjson", "\n")])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("There are no records to import", result.stderr)
+
+    def test_export(self):
+        """It should export promotions with their products in a format it can import again"""
+        records = [
+            dict(PROMOTION, code="E1", products=[3, 1, 2]),
+            dict(PROMOTION, code="E2", whole_store=True),
+            dict(PROMOTION, code="E3", available=10, counter_shards=3, products=[2]),
+        ]
+        source = self.write("source.ndjson", "".join(json.dumps(record) + "\n" for record in records))
+        self.assertEqual(self.runner.invoke(promotions_import, [source]).exit_code, 0)
+        sharded = Promotion.find_by_code("E3").first()
+        PromotionCounter.query.filter_by(promotion_id=sharded.id, shard=0).update({"available": 0})
+        db.session.commit()
+
+        for name in ("promotions.ndjson.gz", "promotions.csv"):
+            path = os.path.join(self.directory.name, name)
+            result = self.runner.invoke(promotions_export, [path, "--batch-size", "2"])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn("Exported 3 promotions and 4 bindings", result.output)
+
+            self.clear()
+            result = self.runner.invoke(promotions_import, [path])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn("3 created", result.output)
+            self.assertEqual(Promotion.find_by_code("E1").first().bound_product_ids(), [1, 2, 3])
+            self.assertTrue(Promotion.find_by_code("E2").first().whole_store)
+            sharded = Promotion.find_by_code("E3").first()
+            self.assertEqual((sharded.counter_shards, sharded.current_available()), (3, 6))
+
+        self.assertEqual(
+            sorted(os.listdir(self.directory.name)), ["promotions.csv", "promotions.ndjson.gz", "source.ndjson"]
+        )
+        with gzip.open(os.path.join(self.directory.name, "promotions.ndjson.gz"), "rt") as file:
+            exported = [json.loads(line) for line in file]
+        self.assertEqual([record["code"] for record in exported], ["E1", "E2", "E3"])
+        self.assertEqual(exported[0]["products"], [1, 2, 3])
+        self.assertEqual(exported[0]["start"], "2024-01-01")
+
+    def test_export_failed(self):
+        """It should leave the previous export in place when an export fails"""
+        path = self.write("promotions.ndjson", "previous\n")
+        with patch("service.bulk.read_promotions", side_effect=OSError("connection lost")):
+            result = self.runner.invoke(promotions_export, [path])
+        self.assertIsInstance(result.exception, OSError)
+        with open(path, encoding="utf-8") as file:
+            self.assertEqual(file.read(), "previous\n")
+        self.assertEqual(os.listdir(self.directory.name), ["promotions.ndjson"])
+
+    def test_writer_error(self):
+        """It should raise any error of the writer thread without blocking the writes"""
+        path = self.write("promotions.ndjson", "previous\n")
+        with self.assertRaises(TypeError):
+            with BackgroundWriter(path) as writer:
+                writer.write("not bytes")
+                for _ in range(WRITE_QUEUE_DEPTH * 4):
+                    writer.write(b"more\n")
+        with open(path, encoding="utf-8") as file:
+            self.assertEqual(file.read(), "previous\n")
+        self.assertEqual(os.listdir(self.directory.name), ["promotions.ndjson"])
+
+    def test_export_empty(self):
+        """It should export an empty table as an empty file"""
+        path = os.path.join(self.directory.name, "promotions.csv")
+        result = self.runner.invoke(promotions_export, [path])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Exported 0 promotions", result.output)
+        with open(path, encoding="utf-8") as file:
+            self.assertEqual(file.read().count("\n"), 1)
@@ -0,0 +1,257 @@
+"""
+Test cases for the worker-local quota leases
+
+"""
+from datetime import date, timedelta
+import os
+import logging
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+from flask import Flask
+from tests.factories import PromotionFactory
+from service.leases import QuotaLeases
+from service.models import (
+    Product,
+    Promotion,
+    PromotionNotApplicableError,
+    db,
+    init_db,
+    promotion_product,
+    snapshots,
+)
+
+
+######################################################################
+#  Q U O T A   L E A S E   T E S T   C A S E S
+######################################################################
+class TestQuotaLeases(unittest.TestCase):
+    """Test Cases for QuotaLeases"""
+
+    @classmethod
+    def setUpClass(cls):
+        """This runs once before the entire test suite"""
+        app = Flask(__name__)
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.logger.setLevel(logging.CRITICAL)
+        app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("DATABASE_URI")
+        init_db(app)
+
+    @classmethod
+    def tearDownClass(cls):
+        """This runs once after the entire test suite"""
+        db.session.close()
+
+    def setUp(self):
+        """This runs before each test"""
+        db.session.query(promotion_product).delete()
+        db.session.query(Product).delete()
+        db.session.query(Promotion).delete()
+        db.session.commit()
+        snapshots.clear()
+
+    def tearDown(self):
+        """This runs after each test"""
+        db.session.remove()
+
+    def _create_promotion(self, available, **kwargs):
+        """Creates a promotion that can be applied today"""
+        promotion = PromotionFactory(start=date.today(), available=available, **kwargs)
+        promotion.create()
+        return promotion.id
+
+    @staticmethod
+    def _available(promotion_id):
+        """Returns the uses left in the database"""
+        db.session.expire_all()
+        return Promotion.find(promotion_id).available
+
+    ######################################################################
+    #  T E S T   C A S E S
+    ######################################################################
+    def test_disabled_leases_redeem_directly(self):
+        """It should apply against the database when leasing is disabled"""
+        promotion_id = self._create_promotion(10)
+        leases = QuotaLeases(size=0)
+        self.assertFalse(leases.enabled)
+        self.assertEqual(leases.redeem(promotion_id), 9)
+        self.assertEqual(self._available(promotion_id), 9)
+
+    def test_redeem_from_lease(self):
+        """It should lease a block of uses with one write and hand them out from memory"""
+        promotion_id = self._create_promotion(100)
+        leases = QuotaLeases(size=10, ttl=60)
+        remaining = [leases.redeem(promotion_id) for _ in range(4)]
+        self.assertEqual(remaining, [9, 8, 7, 6])
+        self.assertEqual(self._available(promotion_id), 90)
+
+        stats = leases.stats()
+        self.assertEqual(stats["applies"], 4)
+        self.assertEqual(stats["db_writes"], 1)
+        self.assertEqual(stats["leased_uses"], 6)
+        self.assertEqual(stats["db_writes_saved_per_apply"], 0.75)
+
+        leases.release_all()
+        self.assertEqual(self._available(promotion_id), 96)
+        self.assertEqual(leases.stats()["uses_returned"], 6)
+
+    def test_lease_renewed_when_used_up(self):
+        """It should lease a new block once the current one is used up"""
+        promotion_id = self._create_promotion(100)
+        leases = QuotaLeases(size=3, ttl=60)
+        for _ in range(7):
+            leases.redeem(promotion_id)
+        self.assertEqual(leases.stats()["leases_acquired"], 3)
+        self.assertEqual(self._available(promotion_id), 91)
+
+    def test_lease_smaller_than_size(self):
+        """It should never lease more uses than are left"""
+        promotion_id = self._create_promotion(2)
+        leases = QuotaLeases(size=50, ttl=60)
+        leases.redeem(promotion_id)
+        leases.redeem(promotion_id)
+        with self.assertRaises(PromotionNotApplicableError):
+            leases.redeem(promotion_id)
+        self.assertEqual(self._available(promotion_id), 0)
+
+    def test_expired_lease_returned(self):
+        """It should give back the uses of a lease once its time to live is over"""
+        promotion_id = self._create_promotion(20)
+        leases = QuotaLeases(size=5, ttl=60)
+        with patch("service.leases.time.monotonic", return_value=1000.0):
+            leases.redeem(promotion_id)
+        self.assertEqual(self._available(promotion_id), 15)
+        with patch("service.leases.time.monotonic", return_value=1061.0):
+            self.assertEqual(leases.redeem(promotion_id), 4)
+        # 4 uses came back and a new block of 5 was leased
+        self.assertEqual(self._available(promotion_id), 14)
+        self.assertEqual(leases.stats()["uses_returned"], 4)
+
+    def test_expired_lease_reaped(self):
+        """It should give back the uses of an expired lease without another apply"""
+        promotion_id = self._create_promotion(10)
+        leases = QuotaLeases(size=10, ttl=0.2)
+        leases.app = Promotion.app
+        try:
+            self.assertEqual(leases.redeem(promotion_id), 9)
+            self.assertEqual(self._available(promotion_id), 0)
+            for _ in range(50):
+                if leases.stats()["uses_returned"]:
+                    break
+                time.sleep(0.05)
+            self.assertEqual(leases.stats()["active_leases"], 0)
+            self.assertEqual(self._available(promotion_id), 9)
+        finally:
+            leases.shutdown()
+
+    def test_lease_not_returned_to_expired_promotion(self):
+        """It should not bring an expired promotion back to life"""
+        promotion_id = self._create_promotion(20)
+        leases = QuotaLeases(size=5, ttl=60)
+        leases.redeem(promotion_id)
+        promotion = Promotion.find(promotion_id)
+        promotion.start = date.today() - timedelta(days=2)
+        promotion.expired = date.today() - timedelta(days=1)
+        promotion.update()
+        leases.release_all()
+        self.assertEqual(self._available(promotion_id), 15)
+
+    def test_lease_revoked_when_promotion_cancelled(self):
+        """It should stop serving and not give back a lease once another worker cancels the promotion"""
+        promotion_id = self._create_promotion(50)
+        leases, other = QuotaLeases(size=5, ttl=60), QuotaLeases(size=5, ttl=60)
+        leases.redeem(promotion_id)
+        Promotion.find(promotion_id).invalidate()
+        with self.assertRaises(PromotionNotApplicableError):
+            leases.redeem(promotion_id)
+        leases.release_all()
+        other.release_all()
+        self.assertEqual(self._available(promotion_id), 0)
+        self.assertEqual(leases.stats()["leases_revoked"], 1)
+        self.assertRaises(PromotionNotApplicableError, Promotion.redeem, promotion_id)
+
+    def test_lease_revoked_when_available_lowered(self):
+        """It should only hand out the uses set by an update made while a lease is held"""
+        promotion_id = self._create_promotion(100)
+        leases = QuotaLeases(size=50, ttl=60)
+        for _ in range(9):
+            leases.redeem(promotion_id)
+        promotion = Promotion.find(promotion_id)
+        promotion.available = 10
+        promotion.update()
+
+        served = 0
+        with self.assertRaises(PromotionNotApplicableError):
+            while served < 100:
+                leases.redeem(promotion_id)
+                served += 1
+        self.assertEqual(served, 10)
+        leases.release_all()
+        self.assertEqual(self._available(promotion_id), 0)
+
+    def test_lease_not_returned_after_update(self):
+        """It should drop the unused uses of a lease instead of adding them to updated ones"""
+        promotion_id = self._create_promotion(20)
+        leases = QuotaLeases(size=5, ttl=60)
+        leases.redeem(promotion_id)
+        promotion = Promotion.find(promotion_id)
+        promotion.available = 7
+        promotion.update()
+        leases.release_all()
+        self.assertEqual(self._available(promotion_id), 7)
+        self.assertEqual(leases.stats()["uses_returned"], 0)
+
+    def test_discard_lease(self):
+        """It should forget a lease without giving its uses back"""
+        promotion_id = self._create_promotion(20)
+        leases = QuotaLeases(size=5, ttl=60)
+        leases.redeem(promotion_id)
+        leases.discard(promotion_id)
+        leases.release_all()
+        self.assertEqual(self._available(promotion_id), 15)
+        self.assertEqual(leases.stats()["active_leases"], 0)
+
+    def test_lease_falls_back_for_missing_and_sharded_promotions(self):
+        """It should let the model handle promotions that cannot be leased"""
+        leases = QuotaLeases(size=5, ttl=60)
+        self.assertIsNone(leases.redeem(0))
+        promotion_id = self._create_promotion(6, counter_shards=2)
+        self.assertEqual(leases.redeem(promotion_id), 5)
+        self.assertEqual(leases.stats()["active_leases"], 0)
+
+    def test_shutdown_returns_leases(self):
+        """It should return every lease when the worker exits"""
+        promotion_id = self._create_promotion(30)
+        leases = QuotaLeases(size=10, ttl=60)
+        leases.app = Promotion.app
+        leases.redeem(promotion_id)
+        leases.shutdown()
+        self.assertEqual(self._available(promotion_id), 29)
+
+    def test_workers_never_oversell(self):
+        """It should never hand out more uses than available over several workers"""
+        promotion_id = self._create_promotion(45)
+        workers = [QuotaLeases(size=10, ttl=60) for _ in range(4)]
+
+        def hammer(leases):
+            redeemed = 0
+            with Promotion.app.app_context():
+                for _ in range(20):
+                    try:
+                        leases.redeem(promotion_id)
+                        redeemed += 1
+                    except PromotionNotApplicableError:
+                        leases.release_all()
+                db.session.remove()
+            return redeemed
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            redeemed = sum(executor.map(hammer, workers))
+
+        self.assertLessEqual(redeemed, 45)
+        for leases in workers:
+            leases.release_all()
+        self.assertEqual(self._available(promotion_id), 45 - redeemed)
@@ -2,20 +2,31 @@
 Test cases for YourResourceModel Model
 
 """
+# pylint: disable=too-many-lines
 from datetime import datetime, timedelta, date
 import os
 import logging
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
 
 from flask import Flask
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
 from tests.factories import PromotionFactory, ProductFactory
 from service.models import (
     Product,
     Promotion,
     DataValidationError,
+    PromotionNotApplicableError,
+    PromotionCounter,
     db,
     init_db,
     promotion_product,
+    queries,
+    snapshots,
+    SnapshotCache,
+    commit_changes as commit,
 )
 
 
@@ -47,6 +58,8 @@ class TestPromotionResourceModel(unittest.TestCase):
         db.session.query(Product).delete()
         db.session.query(Promotion).delete()
         db.session.commit()
+        snapshots.clear()
+        queries.clear()
 
     def tearDown(self):
         """This runs after each test"""
@@ -542,40 +555,195 @@ class TestPromotionResourceModel(unittest.TestCase):
         for promotion in found:
             self.assertEqual(promotion.promo_type, promo_type)
 
+    def test_find_page(self):
+        """It should return the Promotions after an id in id order"""
+        for promotion in PromotionFactory.create_batch(5):
+            promotion.create()
+        ids = [promotion.id for promotion in Promotion.find_page(limit=10)]
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(len(ids), 5)
+        page = Promotion.find_page(after_id=ids[1], limit=2)
+        self.assertEqual([promotion.id for promotion in page], ids[2:4])
+        promo_type = Promotion.find(ids[0]).promo_type
+        page = Promotion.find_page(Promotion.find_by_promo_type(promo_type), limit=10)
+        self.assertTrue(all(promotion.promo_type == promo_type for promotion in page))
+
+    def test_stream(self):
+        """It should yield every Promotion in id order, batch by batch"""
+        for promotion in PromotionFactory.create_batch(7):
+            promotion.create()
+        batches = list(Promotion.stream(batch_size=3))
+        self.assertEqual([len(batch) for batch in batches], [3, 3, 1])
+        ids = [promotion.id for batch in batches for promotion in batch]
+        self.assertEqual(ids, sorted(ids))
+
+    def test_serialize_fields(self):
+        """It should only serialize the fields asked for"""
+        promotion = PromotionFactory()
+        promotion.create([1])
+        self.assertEqual(promotion.serialize(fields=["code", "id"]), {"code": promotion.code, "id": promotion.id})
+        data = Promotion.serialize_all([promotion], fields=["products"])
+        self.assertEqual(data, [{"products": [1]}])
+
+    def test_serialize_all_products(self):
+        """It should serialize products with their promotions in a fixed number of queries"""
+        first, second = PromotionFactory(), PromotionFactory()
+        first.create([1, 2])
+        second.create([2])
+        data = Product.serialize_all(Product.query.order_by(Product.id), fields=["id", "promotions"])
+        self.assertEqual(
+            [(item["id"], [promotion["id"] for promotion in item["promotions"]]) for item in data],
+            [(1, [first.id]), (2, sorted([first.id, second.id]))],
+        )
+        data = Product.serialize_all(Product.query.order_by(Product.id), fields=["id"])
+        self.assertEqual(data, [{"id": 1}, {"id": 2}])
+
+    def test_product_page(self):
+        """It should page through the products of a Promotion and count them"""
+        promotion = PromotionFactory()
+        promotion.create([3, 1, 2])
+        self.assertEqual(promotion.count_products(), 3)
+        self.assertEqual([product.id for product in promotion.product_page(limit=2)], [1, 2])
+        self.assertEqual([product.id for product in promotion.product_page(after_id=2)], [3])
+        self.assertEqual(PromotionFactory().count_products(), 0)
+
+    def test_version_and_generation(self):
+        """It should count the changes of a Promotion and of all Promotions"""
+        generation = Promotion.generation()
+        promotion = PromotionFactory(start=date.today(), available=3)
+        promotion.create()
+        self.assertEqual(promotion.version, 1)
+        self.assertGreater(Promotion.generation(), generation)
+        etag = promotion.etag()
+
+        promotion.bind_product(1)
+        promotion.unbind_product(1)
+        promotion.name = "renamed"
+        promotion.update()
+        Promotion.redeem(promotion.id)
+        db.session.refresh(promotion)
+        self.assertEqual(promotion.version, 5)
+        self.assertNotEqual(promotion.etag(), etag)
+
+        generation = Promotion.generation()
+        self.assertTrue(promotion.bind_product(2))
+        # binding it again changes nothing
+        self.assertFalse(promotion.bind_product(2))
+        self.assertEqual(Promotion.generation(), generation + 1)
+
+    def test_generation_of_new_database(self):
+        """It should move the generation on with the first change of a new database"""
+        db.session.execute(db.text("ALTER SEQUENCE promotion_generation RESTART"))
+        db.session.commit()
+        self.assertEqual(Promotion.generation(), 0)
+        PromotionFactory().create()
+        self.assertEqual(Promotion.generation(), 1)
+
+    def test_find_active(self):
+        """It should Find the Promotions running with uses left"""
+        today = date.today()
+        running = PromotionFactory(start=today, expired=today + timedelta(days=1), available=5)
+        running.create()
+        PromotionFactory(start=today, expired=today + timedelta(days=1), available=0).create()
+        PromotionFactory(start=today + timedelta(days=1), expired=today + timedelta(days=1)).create()
+        PromotionFactory(start=today - timedelta(days=2), expired=today - timedelta(days=1)).create()
+        found = Promotion.find_active().all()
+        self.assertEqual([promotion.id for promotion in found], [running.id])
+        found = Promotion.find_active(today + timedelta(days=2))
+        self.assertEqual(found.count(), 0)
+
+    def test_applicable_to_products(self):
+        """It should find the valid promotions of many products, whole store ones included"""
+        today = date.today()
+        tomorrow = today + timedelta(days=1)
+        bound = PromotionFactory(whole_store=False, start=today, expired=tomorrow)
+        bound.create([1, 2])
+        everywhere = PromotionFactory(whole_store=True, start=today, expired=tomorrow)
+        everywhere.create()
+        PromotionFactory(whole_store=False, start=today, expired=tomorrow, available=0).create([1])
+        PromotionFactory(whole_store=True, start=tomorrow, expired=tomorrow).create()
+        used_up = PromotionFactory(whole_store=False, start=today, expired=tomorrow, available=2, counter_shards=2)
+        used_up.create([2])
+        Promotion.redeem(used_up.id)
+        Promotion.redeem(used_up.id)
+
+        found = Promotion.applicable_to([2, 1, 3, 2])
+        self.assertEqual(list(found), [2, 1, 3])
+        self.assertEqual(found[1], sorted([bound.id, everywhere.id]))
+        self.assertEqual(found[2], sorted([bound.id, everywhere.id]))
+        self.assertEqual(found[3], [everywhere.id])
+        self.assertEqual(Promotion.applicable_to([1], today + timedelta(days=5)), {1: []})
+        self.assertEqual(Promotion.applicable_to([]), {})
+        self.assertRaises(DataValidationError, Promotion.applicable_to, ["x"])
+        self.assertRaises(DataValidationError, Promotion.applicable_to, [1, 2**31])
+        # ids bound as an array are checked too, whatever checked them before
+        self.assertRaises(DataValidationError, Product.create_missing, [1, 2**31])
+        self.assertEqual(Promotion.applicable_to([1]), {1: sorted([bound.id, everywhere.id])})
+
     def test_create_with_products(self):
         """It should create a promotion with products"""
         promotion = PromotionFactory()
         promotion.create([1, 2, 3])
-        self.assertEqual(len(promotion.products), 3)
+        self.assertEqual(promotion.products.count(), 3)
 
         promotion2 = PromotionFactory()
         promotion2.create(4)
-        self.assertEqual(len(promotion2.products), 1)
+        self.assertEqual(promotion2.products.count(), 1)
 
     def test_bind_product(self):
         """It should bind a product to a promotion"""
         promotion = PromotionFactory()
         promotion.create()
         promotion.bind_product(1)
-        self.assertEqual(len(promotion.products), 1)
+        self.assertEqual(promotion.products.count(), 1)
 
     def test_bind_product_twice(self):
         """It should not bind a product to a promotion twice"""
         promotion = PromotionFactory()
         promotion.create()
         promotion.bind_product(1)
-        self.assertEqual(len(promotion.products), 1)
+        self.assertEqual(promotion.products.count(), 1)
         promotion.bind_product(1)
-        self.assertEqual(len(promotion.products), 1)
+        self.assertEqual(promotion.products.count(), 1)
 
     def test_unbind_product(self):
         """It should unbind a product from a promotion"""
         promotion = PromotionFactory()
         promotion.create()
         promotion.bind_product(1)
-        self.assertEqual(len(promotion.products), 1)
+        self.assertEqual(promotion.products.count(), 1)
         promotion.unbind_product(1)
-        self.assertEqual(len(promotion.products), 0)
+        self.assertEqual(promotion.products.count(), 0)
+
+    def test_add_and_remove_products(self):
+        """It should bind and unbind many products at once, skipping the ones already done"""
+        promotion = PromotionFactory()
+        promotion.create()
+        version = promotion.version
+        self.assertEqual(promotion.add_products([3, 1, 2, 1]), 3)
+        self.assertEqual(promotion.add_products([2, 4]), 1)
+        self.assertEqual(promotion.bound_product_ids(), [1, 2, 3, 4])
+        self.assertEqual(promotion.version, version + 2)
+        self.assertEqual(promotion.remove_products([1, 4, 9]), 2)
+        self.assertEqual(promotion.remove_products([9]), 0)
+        self.assertEqual(promotion.bound_product_ids(), [2, 3])
+        self.assertEqual(promotion.version, version + 3)
+        self.assertRaises(DataValidationError, promotion.add_products, ["x"])
+
+    def test_replace_products(self):
+        """It should only write the difference when replacing the products of a promotion"""
+        promotion = PromotionFactory()
+        promotion.create([1, 2, 3])
+        other = PromotionFactory()
+        other.create([1, 2])
+        self.assertEqual(promotion.replace_products([2, 3, 4, 5]), (2, 1))
+        self.assertEqual(promotion.bound_product_ids(), [2, 3, 4, 5])
+        version = promotion.version
+        self.assertEqual(promotion.replace_products([5, 4, 3, 2]), (0, 0))
+        self.assertEqual(promotion.version, version)
+        self.assertEqual(promotion.replace_products([]), (0, 4))
+        self.assertEqual(promotion.bound_product_ids(), [])
+        self.assertEqual(other.bound_product_ids(), [1, 2])
 
     # Product Model Tests
     def test_create_product_(self):
@@ -625,7 +793,7 @@ class TestPromotionResourceModel(unittest.TestCase):
         self.assertIsNotNone(new_product.created_at)
         self.assertIsNotNone(new_product.updated_at)
         self.assertEqual(len(Product.all()), product_count + 1)
-        self.assertEqual(len(new_product.promotions), 1)
+        self.assertEqual(new_product.promotions.count(), 1)
         self.assertEqual(new_product.promotions[0].id, promotion.id)
 
     def test_create_with_deserialize_product_withoutid(self):
@@ -667,7 +835,7 @@ class TestPromotionResourceModel(unittest.TestCase):
         promotion = PromotionFactory()
         promotion.create()
         product.bind_promotion(promotion.id)
-        self.assertEqual(len(product.promotions), 1)
+        self.assertEqual(product.promotions.count(), 1)
         self.assertEqual(product.promotions[0].id, promotion.id)
 
     def test_bind_promotion_with_nonexistent_product(self):
@@ -678,7 +846,7 @@ class TestPromotionResourceModel(unittest.TestCase):
         promotion.create()
 
         product.bind_promotion(promotion.id)
-        self.assertEqual(len(product.promotions), 1)
+        self.assertEqual(product.promotions.count(), 1)
         self.assertEqual(product.promotions[0].id, promotion.id)
 
     def test_bind_promotion(self):
@@ -688,7 +856,7 @@ class TestPromotionResourceModel(unittest.TestCase):
         promotion = PromotionFactory()
         promotion.create()
         product.bind_promotion(promotion.id)
-        self.assertEqual(len(product.promotions), 1)
+        self.assertEqual(product.promotions.count(), 1)
         self.assertEqual(product.promotions[0].id, promotion.id)
 
     def test_bind_promotion_twice(self):
@@ -698,10 +866,10 @@ class TestPromotionResourceModel(unittest.TestCase):
         promotion = PromotionFactory()
         promotion.create()
         product.bind_promotion(promotion.id)
-        self.assertEqual(len(product.promotions), 1)
+        self.assertEqual(product.promotions.count(), 1)
         self.assertEqual(product.promotions[0].id, promotion.id)
         product.bind_promotion(promotion.id)
-        self.assertEqual(len(product.promotions), 1)
+        self.assertEqual(product.promotions.count(), 1)
         self.assertEqual(product.promotions[0].id, promotion.id)
 
     def test_bind_nonexistent_promotion(self):
@@ -718,10 +886,10 @@ class TestPromotionResourceModel(unittest.TestCase):
         promotion = PromotionFactory()
         promotion.create()
         product.bind_promotion(promotion.id)
-        self.assertEqual(len(product.promotions), 1)
+        self.assertEqual(product.promotions.count(), 1)
         self.assertEqual(product.promotions[0].id, promotion.id)
         product.unbind_promotion(promotion.id)
-        self.assertEqual(len(product.promotions), 0)
+        self.assertEqual(product.promotions.count(), 0)
 
     def test_unbind_nonexistent_promotion(self):
         """It should not unbind a nonexistent promotion from a product"""
@@ -789,10 +957,534 @@ class TestPromotionResourceModel(unittest.TestCase):
         self.assertEqual(
             promotion.expired, datetime.utcnow().date()
         )  # Compare only dates
-        self.assertEqual(len(promotion.products), 0)
+        self.assertEqual(promotion.products.count(), 0)
 
     def test_invalid_promotion_id_raises_error(self):
         """Test deletion of a promotion with invalid ID raises DataValidationError."""
         promotion = PromotionFactory()
         with self.assertRaises(DataValidationError):
             promotion.invalidate()
+
+    def test_redeem_promotion(self):
+        """It should redeem a promotion and return the uses left"""
+        promotion = PromotionFactory(start=date.today(), available=2)
+        promotion.create()
+        self.assertEqual(Promotion.redeem(promotion.id), 1)
+        self.assertEqual(Promotion.redeem(promotion.id), 0)
+        self.assertEqual(Promotion.find(promotion.id).available, 0)
+        with self.assertRaises(PromotionNotApplicableError) as error:
+            Promotion.redeem(promotion.id)
+        self.assertIn("unavailable", str(error.exception))
+
+    def test_redeem_nonexistent_promotion(self):
+        """It should return None when redeeming a promotion that does not exist"""
+        self.assertIsNone(Promotion.redeem(0))
+
+    def test_redeem_outside_date_window(self):
+        """It should not redeem an expired or inactive promotion"""
+        expired = PromotionFactory(
+            start=date.today() - timedelta(days=3),
+            expired=date.today() - timedelta(days=1),
+        )
+        expired.create()
+        inactive = PromotionFactory(start=date.today() + timedelta(days=1))
+        inactive.create()
+        with self.assertRaises(PromotionNotApplicableError) as error:
+            Promotion.redeem(expired.id)
+        self.assertIn("expired", str(error.exception))
+        with self.assertRaises(PromotionNotApplicableError) as error:
+            Promotion.redeem(inactive.id)
+        self.assertIn("Inactive", str(error.exception))
+        self.assertEqual(Promotion.find(expired.id).available, expired.available)
+
+    def test_redeem_concurrently_never_oversells(self):
+        """It should hand out exactly `available` uses under contention"""
+        promotion = PromotionFactory(start=date.today(), available=50)
+        promotion.create()
+        promotion_id = promotion.id
+
+        def hammer(_):
+            redeemed = 0
+            with Promotion.app.app_context():
+                for _ in range(10):
+                    try:
+                        Promotion.redeem(promotion_id)
+                        redeemed += 1
+                    except PromotionNotApplicableError:
+                        pass
+                db.session.remove()
+            return redeemed
+
+        with ThreadPoolExecutor(max_workers=12) as executor:
+            redeemed = sum(executor.map(hammer, range(12)))
+
+        self.assertEqual(redeemed, 50)
+        db.session.expire_all()
+        self.assertEqual(Promotion.find(promotion_id).available, 0)
+
+    def test_redeem_all(self):
+        """It should consume one use of each promotion given by id or code"""
+        plain = PromotionFactory(start=date.today(), available=5, counter_shards=0)
+        plain.create()
+        sharded = PromotionFactory(start=date.today(), available=4, counter_shards=2)
+        sharded.create()
+        version = plain.version
+        applied, results = Promotion.redeem_all([sharded.id], [plain.code])
+        self.assertTrue(applied)
+        self.assertEqual(
+            results,
+            [
+                {"id": sharded.id, "code": sharded.code, "available": 3},
+                {"id": plain.id, "code": plain.code, "available": 4},
+            ],
+        )
+        db.session.expire_all()
+        self.assertEqual(Promotion.find(plain.id).version, version + 1)
+        self.assertEqual(Promotion.find(sharded.id).current_available(), 3)
+
+    def test_redeem_all_or_nothing(self):
+        """It should apply nothing when any promotion cannot be applied"""
+        good = PromotionFactory(start=date.today(), available=5, counter_shards=0)
+        good.create()
+        used_up = PromotionFactory(start=date.today(), available=0, counter_shards=0)
+        used_up.create()
+        applied, results = Promotion.redeem_all([good.id, used_up.id, 0], [good.code])
+        self.assertFalse(applied)
+        self.assertNotIn("error", results[0])
+        self.assertIn("unavailable", results[1]["error"])
+        self.assertEqual((results[2]["id"], results[2]["error"]), (None, "Promotion 0 was not found."))
+        self.assertIn("once", results[3]["error"])
+        db.session.expire_all()
+        self.assertEqual(Promotion.find(good.id).available, 5)
+
+    def test_redeem_all_concurrently_without_deadlocks(self):
+        """It should apply batches sharing promotions in any order without deadlocking"""
+        promotions = PromotionFactory.create_batch(3, start=date.today(), available=40, counter_shards=0)
+        for promotion in promotions:
+            promotion.create()
+        ids = [promotion.id for promotion in promotions]
+
+        def hammer(worker):
+            applied = 0
+            with Promotion.app.app_context():
+                for _ in range(5):
+                    applied += Promotion.redeem_all(ids if worker % 2 else ids[::-1])[0]
+                db.session.remove()
+            return applied
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            applied = sum(executor.map(hammer, range(8)))
+
+        self.assertEqual(applied, 40)
+        db.session.expire_all()
+        self.assertEqual([Promotion.find(promotion_id).available for promotion_id in ids], [0, 0, 0])
+
+    def test_create_all(self):
+        """It should create the valid promotions of a batch and report the others"""
+        PromotionFactory(code="TAKEN").create()
+        promotions = [
+            PromotionFactory(code="FIRST", counter_shards=0),
+            PromotionFactory(code="SHARDED", available=10, counter_shards=3),
+            PromotionFactory(code="TAKEN"),
+            PromotionFactory(code="FIRST"),
+            PromotionFactory(code="NONAME", name=""),
+            PromotionFactory(code=""),
+        ]
+        results = Promotion.create_all(promotions)
+        self.assertEqual([result["code"] for result in results], ["FIRST", "SHARDED", "TAKEN", "FIRST", "NONAME", ""])
+        self.assertEqual(
+            [result.get("error") for result in results],
+            [None, None, "code already exist", "code already exist", "name attribute is not set",
+             "code attribute is not set"],
+        )
+        first = Promotion.find(results[0]["id"])
+        self.assertEqual((first.code, first.version, first.counter_shards), ("FIRST", 1, 0))
+        sharded = Promotion.find(results[1]["id"])
+        self.assertEqual(sharded.current_available(), 10)
+        self.assertEqual(PromotionCounter.query.filter_by(promotion_id=sharded.id).count(), 3)
+        self.assertEqual(len(Promotion.all()), 3)
+
+    def test_create_all_out_of_columns(self):
+        """It should report the promotions of a batch that do not fit their columns"""
+        promotions = [
+            PromotionFactory(code="X" * 40),
+            PromotionFactory(code="HUGE", available=2**40),
+            PromotionFactory(code="DUP", name=""),
+            PromotionFactory(code="DUP"),
+        ]
+        results = Promotion.create_all(promotions)
+        self.assertEqual(
+            [result.get("error") for result in results],
+            ["code attribute is too long", "available attribute is out of range", "name attribute is not set", None],
+        )
+        self.assertEqual([promotion.code for promotion in Promotion.all()], ["DUP"])
+
+    def test_create_all_invalid(self):
+        """It should create nothing when no promotion of a batch is valid"""
+        self.assertEqual(Promotion.create_all([]), [])
+        results = Promotion.create_all([PromotionFactory(promo_type=None)])
+        self.assertEqual(results, [{"code": results[0]["code"], "error": "promo_type attribute is not set"}])
+        self.assertEqual(Promotion.all(), [])
+
+    def test_create_sharded_promotion(self):
+        """It should spread the available uses over the counter shards"""
+        promotion = PromotionFactory(available=10, counter_shards=4)
+        promotion.create()
+        shards = PromotionCounter.query.filter_by(promotion_id=promotion.id).all()
+        self.assertEqual(len(shards), 4)
+        self.assertEqual(sorted(shard.available for shard in shards), [2, 2, 3, 3])
+        self.assertEqual(promotion.serialize()["available"], 10)
+        self.assertEqual(promotion.serialize()["counter_shards"], 4)
+
+    def test_create_promotion_with_negative_shards(self):
+        """It should not create a promotion with a negative number of shards"""
+        promotion = PromotionFactory(counter_shards=-1)
+        self.assertRaises(DataValidationError, promotion.create)
+
+    def test_create_promotion_with_too_many_shards(self):
+        """It should not create a promotion with more shards than the maximum"""
+        promotion = PromotionFactory(counter_shards=Promotion.MAX_COUNTER_SHARDS + 1)
+        self.assertRaises(DataValidationError, promotion.create)
+        self.assertEqual(PromotionCounter.query.count(), 0)
+
+    def test_redeem_sharded_promotion(self):
+        """It should redeem from the shards until all of them are used up"""
+        promotion = PromotionFactory(start=date.today(), available=5, counter_shards=3)
+        promotion.create()
+        remaining = [Promotion.redeem(promotion.id) for _ in range(5)]
+        self.assertEqual(remaining, [4, 3, 2, 1, 0])
+        with self.assertRaises(PromotionNotApplicableError):
+            Promotion.redeem(promotion.id)
+        # the column itself is left alone while the promotion is sharded
+        self.assertEqual(Promotion.find(promotion.id).available, 5)
+        self.assertFalse(Promotion.find(promotion.id).is_valid())
+
+    def test_update_promotion_shards(self):
+        """It should keep the uses left when the number of shards changes"""
+        promotion = PromotionFactory(start=date.today(), available=6, counter_shards=2)
+        promotion.create()
+        Promotion.redeem(promotion.id)
+        promotion = Promotion.find(promotion.id)
+        promotion.counter_shards = 3
+        promotion.update()
+        self.assertEqual(promotion.current_available(), 5)
+        promotion.counter_shards = 0
+        promotion.update()
+        self.assertEqual(promotion.available, 5)
+        self.assertEqual(
+            PromotionCounter.query.filter_by(promotion_id=promotion.id).count(), 0
+        )
+        promotion.available = 8
+        promotion.counter_shards = 2
+        promotion.update()
+        self.assertEqual(promotion.current_available(), 8)
+
+    def test_invalidate_sharded_promotion(self):
+        """It should empty every shard when a promotion is cancelled"""
+        promotion = PromotionFactory(available=9, counter_shards=3)
+        promotion.create()
+        promotion.invalidate()
+        self.assertEqual(promotion.current_available(), 0)
+
+    def test_redeem_sharded_concurrently_never_oversells(self):
+        """It should hand out exactly `available` uses over all shards under contention"""
+        promotion = PromotionFactory(start=date.today(), available=40, counter_shards=4)
+        promotion.create()
+        promotion_id = promotion.id
+
+        def hammer(_):
+            redeemed = 0
+            with Promotion.app.app_context():
+                for _ in range(10):
+                    try:
+                        Promotion.redeem(promotion_id)
+                        redeemed += 1
+                    except PromotionNotApplicableError:
+                        pass
+                db.session.remove()
+            return redeemed
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            redeemed = sum(executor.map(hammer, range(8)))
+
+        self.assertEqual(redeemed, 40)
+        self.assertEqual(Promotion.find(promotion_id).current_available(), 0)
+
+    def test_create_with_many_products(self):
+        """It should bind thousands of products with a constant number of statements"""
+        Product(id=2).create()
+        Product(id=4).create()
+        product_ids = list(range(1, 5001)) + [1, 2]
+        statements = []
+
+        def count(*_):
+            statements.append(1)
+
+        event.listen(db.engine, "before_cursor_execute", count)
+        try:
+            promotion = PromotionFactory()
+            promotion.create(product_ids)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count)
+
+        self.assertLessEqual(len(statements), 6)
+        self.assertEqual(promotion.products.count(), 5000)
+        self.assertEqual(len(Product.all()), 5000)
+
+    def test_create_with_bad_product_id(self):
+        """It should not create a promotion with a product id that is not a number"""
+        promotion = PromotionFactory()
+        self.assertRaises(DataValidationError, promotion.create, ["not-a-number"])
+
+    def test_bind_product_existing_product(self):
+        """It should bind an existing product without creating it again"""
+        product = ProductFactory()
+        product.create()
+        promotion = PromotionFactory()
+        promotion.create()
+        promotion.bind_product(product.id)
+        self.assertEqual([p.id for p in promotion.products], [product.id])
+        self.assertEqual(len(Product.all()), 1)
+
+    def test_has_product(self):
+        """It should check a single binding without loading the collection"""
+        promotion = PromotionFactory()
+        promotion.create([1, 2])
+        product = Product.find(1)
+        self.assertTrue(promotion.has_product(1))
+        self.assertFalse(promotion.has_product(3))
+        self.assertTrue(product.has_promotion(promotion.id))
+        self.assertEqual(promotion.bound_product_ids(), [1, 2])
+        self.assertEqual(promotion.product_ids(), ["1", "2"])
+        self.assertFalse(promotion.bind_product(2))
+        self.assertTrue(promotion.bind_product(3))
+        self.assertEqual(promotion.products.count(), 3)
+
+    def test_unbind_product_not_in_promotion(self):
+        """It should not unbind an existing product that is not in the promotion"""
+        ProductFactory(id=5).create()
+        promotion = PromotionFactory()
+        promotion.create()
+        with self.assertRaises(DataValidationError) as error:
+            promotion.unbind_product(5)
+        self.assertIn("is not in the promotion", str(error.exception))
+
+    def test_duplicate_binding_rejected(self):
+        """It should not store the same binding twice"""
+        promotion = PromotionFactory()
+        promotion.create([1])
+        with self.assertRaises(IntegrityError):
+            db.session.execute(
+                promotion_product.insert().values(promotion_id=promotion.id, product_id=1)
+            )
+        db.session.rollback()
+
+    def test_delete_promotion_keeps_products(self):
+        """It should delete the bindings of a promotion without loading them"""
+        promotion = PromotionFactory()
+        promotion.create([1, 2, 3])
+        statements = []
+
+        def record(_conn, _cursor, statement, *_):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            promotion.delete()
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record)
+
+        self.assertFalse(any("promotion_product" in statement for statement in statements))
+        self.assertEqual(db.session.query(promotion_product).count(), 0)
+        self.assertEqual(len(Product.all()), 3)
+
+    def test_delete_product_removes_bindings(self):
+        """It should remove the bindings of a deleted product"""
+        promotion = PromotionFactory()
+        promotion.create([1, 2])
+        Product.find(1).delete()
+        self.assertEqual(promotion.bound_product_ids(), [2])
+
+    def test_lookup_promotion_from_cache(self):
+        """It should look up a promotion once and serve the copies from the cache"""
+        promotion = PromotionFactory()
+        promotion.create()
+        first = Promotion.lookup(promotion.id)
+        second = Promotion.lookup(promotion.id)
+        self.assertEqual(first.serialize(), promotion.serialize())
+        self.assertIsNot(first, second)
+        self.assertEqual(Promotion.lookup_by_code(promotion.code).id, promotion.id)
+        stats = snapshots.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 2)
+
+    def test_lookup_missing_promotion_cached(self):
+        """It should cache the miss of an unknown promotion until it is created"""
+        self.assertIsNone(Promotion.lookup_by_code("NEWCODE"))
+        self.assertIsNone(Promotion.lookup_by_code("NEWCODE"))
+        self.assertEqual(snapshots.stats()["negative_hits"], 1)
+        promotion = PromotionFactory(code="NEWCODE")
+        promotion.create()
+        self.assertEqual(Promotion.lookup_by_code("NEWCODE").id, promotion.id)
+
+    def test_lookup_invalidated_by_writes(self):
+        """It should drop the cached promotion when it is changed, bound or applied"""
+        promotion = PromotionFactory(start=date.today(), available=5)
+        promotion.create()
+        old_code = promotion.code
+        Promotion.lookup_by_code(old_code)
+        Promotion.lookup(promotion.id)
+
+        promotion.code = "RENAMED"
+        promotion.update()
+        self.assertIsNone(Promotion.lookup_by_code(old_code))
+        self.assertEqual(Promotion.lookup(promotion.id).code, "RENAMED")
+
+        promotion.bind_product(1)
+        self.assertEqual(Promotion.lookup(promotion.id).version, promotion.version)
+        Promotion.redeem(promotion.id)
+        self.assertEqual(Promotion.lookup(promotion.id).available, 4)
+
+        promotion.delete()
+        self.assertIsNone(Promotion.lookup(promotion.id))
+
+    def test_lookup_product(self):
+        """It should cache products and forget them when they are deleted"""
+        self.assertIsNone(Product.lookup(7))
+        Product(id=7).create()
+        self.assertEqual(Product.lookup(7).id, 7)
+        Product.find(7).delete()
+        self.assertIsNone(Product.lookup(7))
+
+    def test_created_product_miss_dropped_after_commit(self):
+        """It should drop the cached miss of a product created by a binding once it is committed"""
+        promotion = PromotionFactory()
+        promotion.create()
+
+        def lookup_elsewhere():
+            with Promotion.app.app_context():
+                found = Product.lookup(9)
+                db.session.remove()
+            return found
+
+        def lookup_then_commit(**kwargs):
+            # another request of this process, which cannot see the product yet
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                self.assertIsNone(executor.submit(lookup_elsewhere).result())
+            commit(**kwargs)
+
+        with patch("service.models.commit_changes", side_effect=lookup_then_commit):
+            promotion.bind_product(9)
+        self.assertEqual(Product.lookup(9).id, 9)
+
+    def test_bound_promotion_forgotten_after_commit(self):
+        """It should drop the snapshot of a promotion bound to a product once the binding is committed"""
+        promotion = PromotionFactory()
+        promotion.create()
+        product = Product(id=9)
+        product.create()
+
+        def lookup_elsewhere():
+            with Promotion.app.app_context():
+                found = Promotion.lookup(promotion.id)
+                db.session.remove()
+            return found
+
+        for change in (product.bind_promotion, product.unbind_promotion):
+            version = Promotion.lookup(promotion.id).version
+
+            def lookup_then_commit(old=version, **kwargs):
+                # another request of this process, which still sees the old version
+                with ThreadPoolExecutor(max_workers=1) as executor:
+                    self.assertEqual(executor.submit(lookup_elsewhere).result().version, old)
+                commit(**kwargs)
+
+            with patch("service.models.commit_changes", side_effect=lookup_then_commit):
+                change(promotion.id)
+            self.assertEqual(Promotion.lookup(promotion.id).version, version + 1)
+
+    def test_search_cached_per_generation(self):
+        """It should serve a page of a finder from the cache until a promotion changes"""
+        for _ in range(3):
+            PromotionFactory(promo_type=2).create()
+        PromotionFactory(promo_type=1).create()
+        generation = Promotion.generation()
+        first = Promotion.search(generation, promo_type=2)
+        second = Promotion.search(generation, None, 100, promo_type=2, code=None)
+        self.assertEqual([promotion.id for promotion in second], [promotion.id for promotion in first])
+        self.assertEqual(len(first), 3)
+        self.assertEqual(queries.stats()["find_by_promo_type"]["hits"], 1)
+
+        first[0].name = "changed in memory only"
+        self.assertNotEqual(Promotion.search(generation, promo_type=2)[0].name, first[0].name)
+
+        promotion = Promotion.find(first[0].id)
+        promotion.promo_type = 1
+        promotion.update()
+        self.assertEqual(len(Promotion.search(Promotion.generation(), promo_type=2)), 2)
+        self.assertEqual(queries.stats()["find_by_promo_type"]["misses"], 2)
+
+    def test_search_first_filter_wins(self):
+        """It should apply only the first filter given, like the list endpoint"""
+        promotion = PromotionFactory(name="Spring", promo_type=3)
+        promotion.create()
+        PromotionFactory(name="Autumn", promo_type=3).create()
+        generation = Promotion.generation()
+        found = Promotion.search(generation, name="Spring", promo_type=3)
+        self.assertEqual([row.id for row in found], [promotion.id])
+        self.assertEqual(len(Promotion.search(generation)), 2)
+        self.assertEqual(len(Promotion.search(generation, limit=1)), 1)
+        stats = queries.stats()
+        self.assertEqual(stats["find_by_name"]["misses"], 1)
+        self.assertEqual(stats["all"]["misses"], 2)
+        self.assertEqual(stats["find_by_promo_type"]["misses"], 0)
+
+
+######################################################################
+#  S N A P S H O T   C A C H E   T E S T   C A S E S
+######################################################################
+class TestSnapshotCache(unittest.TestCase):
+    """Test Cases for the SnapshotCache"""
+
+    def test_least_recently_used_evicted(self):
+        """It should evict the least recently used entry when full"""
+        cache = SnapshotCache(size=2, ttl=60)
+        cache.get("a", lambda: 1)
+        cache.get("b", lambda: 2)
+        cache.get("a", lambda: 0)
+        cache.get("c", lambda: 3)
+        self.assertEqual(cache.get("a", lambda: 0), 1)
+        self.assertEqual(cache.get("b", lambda: 0), 0)
+        self.assertEqual(cache.stats()["evictions"], 2)
+        self.assertEqual(cache.stats()["entries"], 2)
+
+    def test_entries_expire(self):
+        """It should load an entry again once its time to live is over"""
+        cache = SnapshotCache(size=10, ttl=5)
+        with patch("service.models.time.monotonic", return_value=100.0):
+            cache.get("a", lambda: 1)
+        with patch("service.models.time.monotonic", return_value=104.0):
+            self.assertEqual(cache.get("a", lambda: 2), 1)
+        with patch("service.models.time.monotonic", return_value=106.0):
+            self.assertEqual(cache.get("a", lambda: 2), 2)
+        self.assertEqual(cache.stats()["expirations"], 1)
+
+    def test_invalidation_during_load(self):
+        """It should not store a value loaded while its key was invalidated"""
+        cache = SnapshotCache(size=10, ttl=60)
+
+        def load():
+            cache.invalidate("a")
+            return "stale"
+
+        self.assertEqual(cache.get("a", load), "stale")
+        self.assertEqual(cache.get("a", lambda: "fresh"), "fresh")
+
+    def test_disabled_cache(self):
+        """It should always load when disabled"""
+        cache = SnapshotCache(enabled=False)
+        cache.get("a", lambda: 1)
+        self.assertEqual(cache.get("a", lambda: 2), 2)
+        stats = cache.stats()
+        self.assertEqual(stats["misses"], 0)
+        self.assertEqual(stats["entries"], 0)
@@ -0,0 +1,85 @@
+"""
+Test cases for the connection pool telemetry
+
+"""
+import sqlite3
+import threading
+import unittest
+
+from flask import Flask
+from sqlalchemy import exc
+
+from service.pool import MonitoredQueuePool, PoolMonitor, WAIT_BUCKETS_MS
+
+
+######################################################################
+#  M O N I T O R E D   P O O L   T E S T   C A S E S
+######################################################################
+class TestMonitoredQueuePool(unittest.TestCase):
+    """Test Cases for MonitoredQueuePool"""
+
+    @staticmethod
+    def pool(**kwargs):
+        """Returns a monitored pool of in-memory SQLite connections"""
+        return MonitoredQueuePool(lambda: sqlite3.connect(":memory:", check_same_thread=False), **kwargs)
+
+    def test_checkouts(self):
+        """It should count and time every checkout"""
+        pool = self.pool(pool_size=2, max_overflow=0)
+        for _ in range(3):
+            pool.connect().close()
+        stats = pool.telemetry()
+        self.assertEqual(stats["checkouts"], 3)
+        self.assertEqual((stats["saturated"], stats["timeouts"], stats["overflow_checkouts"]), (0, 0, 0))
+        self.assertEqual(stats["max_checked_out"], 1)
+        self.assertEqual((stats["pool_size"], stats["checked_out"], stats["checked_in"]), (2, 0, 1))
+        waits = stats["wait_ms"]
+        self.assertEqual(waits["count"], 3)
+        self.assertEqual(list(waits["buckets"]), [str(bound) for bound in WAIT_BUCKETS_MS] + ["+Inf"])
+        self.assertEqual(waits["buckets"]["+Inf"], 3)
+        self.assertEqual(list(waits["buckets"].values()), sorted(waits["buckets"].values()))
+
+        pool.clear_telemetry()
+        self.assertEqual(pool.telemetry()["checkouts"], 0)
+
+    def test_overflow(self):
+        """It should count the checkouts served beyond the pool size"""
+        pool = self.pool(pool_size=1, max_overflow=1)
+        first, second = pool.connect(), pool.connect()
+        stats = pool.telemetry()
+        self.assertEqual(stats["overflow_checkouts"], 1)
+        self.assertEqual(stats["max_checked_out"], 2)
+        first.close()
+        second.close()
+
+    def test_saturated(self):
+        """It should count the checkouts that wait for a full pool, and the ones that time out"""
+        pool = self.pool(pool_size=1, max_overflow=0, timeout=0.2)
+        held = pool.connect()
+        self.assertRaises(exc.TimeoutError, pool.connect)
+
+        threading.Timer(0.05, held.close).start()
+        pool.connect().close()
+        stats = pool.telemetry()
+        self.assertEqual((stats["checkouts"], stats["saturated"], stats["timeouts"]), (3, 2, 1))
+        self.assertEqual(stats["saturation_ratio"], round(2 / 3, 4))
+        self.assertGreaterEqual(stats["wait_ms"]["max"], 40)
+        self.assertEqual(stats["wait_ms"]["buckets"]["10"], 1)
+
+    def test_recreate(self):
+        """It should stay monitored when the engine recreates its pool"""
+        pool = self.pool(pool_size=1)
+        pool.connect().close()
+        recreated = pool.recreate()
+        self.assertIsInstance(recreated, MonitoredQueuePool)
+        self.assertEqual(recreated.telemetry()["checkouts"], 0)
+
+    def test_init_app(self):
+        """It should install the monitored pool without dropping the other engine options"""
+        app = Flask(__name__)
+        options = app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {"pool_size": 3}
+        PoolMonitor().init_app(app)
+        self.assertEqual(
+            app.config["SQLALCHEMY_ENGINE_OPTIONS"], {"pool_size": 3, "poolclass": MonitoredQueuePool}
+        )
+        self.assertEqual(options, {"pool_size": 3})
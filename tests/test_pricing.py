@@ -0,0 +1,244 @@
+"""
+Test cases for the cart pricing rules
+
+"""
+import logging
+import os
+import unittest
+from datetime import date, timedelta
+
+import numpy as np
+from flask import Flask
+from tests.factories import PromotionFactory
+from service.models import db, init_db, Product, Promotion, promotion_product
+from service.pricing import (
+    BUY_ONE_GET_ONE_OFF,
+    BUY_X_GET_ONE_FREE,
+    FIXED_AMOUNT,
+    PERCENTAGE,
+    SAME_PRODUCT_SECOND_OFF,
+    Evaluator,
+    EvaluatorCache,
+    PercentageOff,
+    compile_evaluator,
+    evaluate,
+    line_discounts,
+)
+
+# in ascending unit price order, as line_discounts() takes them
+PRICES = np.array([1.0, 4.0, 10.0])
+QUANTITIES = np.array([1, 2, 3])
+
+
+def compile_all(*promotions):
+    """Returns the evaluators of (promo_type, value) pairs, numbered from 1"""
+    return [
+        compile_evaluator(number, f"P{number}", 1, kind, value)
+        for number, (kind, value) in enumerate(promotions, start=1)
+    ]
+
+
+######################################################################
+#  P R I C I N G   T E S T   C A S E S
+######################################################################
+class TestPricing(unittest.TestCase):
+    """Test Cases for the cart pricing rules"""
+
+    def discounts(self, kind, value, eligible=(True, True, True)):
+        """Returns the line discounts of one promotion on the test cart"""
+        return line_discounts([compile_evaluator(1, "A", 1, kind, value)], np.array([eligible]), PRICES, QUANTITIES)[0]
+
+    def test_percentage(self):
+        """It should take a percentage off every eligible unit"""
+        np.testing.assert_allclose(self.discounts(PERCENTAGE, 10, (True, False, True)), [0.1, 0.0, 3.0])
+        np.testing.assert_allclose(self.discounts(PERCENTAGE, 150), [1.0, 8.0, 30.0])
+
+    def test_fixed_amount(self):
+        """It should spread a fixed amount over the eligible lines, at most their subtotal"""
+        np.testing.assert_allclose(self.discounts(FIXED_AMOUNT, 19, (False, True, True)), [0.0, 4.0, 15.0])
+        np.testing.assert_allclose(self.discounts(FIXED_AMOUNT, 100), [1.0, 8.0, 30.0])
+        np.testing.assert_allclose(self.discounts(FIXED_AMOUNT, 5, (False, False, False)), [0.0, 0.0, 0.0])
+
+    def test_buy_x_get_one_free(self):
+        """It should give one unit for every value units of the same product"""
+        np.testing.assert_allclose(self.discounts(BUY_X_GET_ONE_FREE, 1), [0.0, 4.0, 10.0])
+        np.testing.assert_allclose(self.discounts(BUY_X_GET_ONE_FREE, 2), [0.0, 0.0, 10.0])
+
+    def test_buy_one_get_one_off(self):
+        """It should take a percentage off the cheaper half of the units across products"""
+        # six units: the 1.0 one, both 4.0 ones and none of the 10.0 ones
+        np.testing.assert_allclose(self.discounts(BUY_ONE_GET_ONE_OFF, 50), [0.5, 4.0, 0.0])
+        np.testing.assert_allclose(self.discounts(BUY_ONE_GET_ONE_OFF, 50, (True, False, True)), [0.5, 0.0, 5.0])
+
+    def test_same_product_second_off(self):
+        """It should take a percentage off every second unit of the same product"""
+        np.testing.assert_allclose(self.discounts(SAME_PRODUCT_SECOND_OFF, 50), [0.0, 2.0, 5.0])
+
+    def test_best_combination(self):
+        """It should pick the promotion saving the most, then the best on the lines left"""
+        promotions = compile_all((PERCENTAGE, 10), (BUY_X_GET_ONE_FREE, 1), (FIXED_AMOUNT, 50))
+        # the lines in any order: the 10.0 one first
+        eligible = np.array([
+            [True, True, True],
+            [True, False, False],
+            [False, False, False],
+        ])
+        picked, line_promotion, line_discount = evaluate(
+            promotions, eligible, PRICES[::-1].copy(), QUANTITIES[::-1].copy()
+        )
+        self.assertEqual([row for row, _ in picked], [1, 0])
+        self.assertEqual(list(line_promotion), [1, 0, 0])
+        np.testing.assert_allclose(line_discount, [10.0, 0.8, 0.1])
+        self.assertAlmostEqual(sum(saved for _, saved in picked), 10.9)
+
+    def test_best_promotion_of_each_line(self):
+        """It should give each line its best promotion rather than the one saving the most overall"""
+        promotions = compile_all((PERCENTAGE, 6), (PERCENTAGE, 10), (PERCENTAGE, 10))
+        eligible = np.array([[True, True], [True, False], [False, True]])
+        picked, line_promotion, line_discount = evaluate(
+            promotions, eligible, np.array([100.0, 100.0]), np.array([1, 1])
+        )
+        self.assertEqual(picked, [(1, 10.0), (2, 10.0)])
+        self.assertEqual(list(line_promotion), [1, 2])
+        np.testing.assert_allclose(line_discount, [10.0, 10.0])
+
+    def test_cart_wide_combination(self):
+        """It should search the cart wide promotions for the combination saving the most"""
+        # 30 off everything saves the most on its own, but less than 25 off
+        # the first two lines with the 30 off on the line they leave
+        promotions = compile_all((FIXED_AMOUNT, 30), (FIXED_AMOUNT, 25), (FIXED_AMOUNT, 25), (PERCENTAGE, 10))
+        eligible = np.array([
+            [True, True, True],
+            [True, True, False],
+            [False, False, True],
+            [True, True, True],
+        ])
+        prices, quantities = np.array([20.0, 20.0, 40.0]), np.array([1, 1, 1])
+        picked, line_promotion, _ = evaluate(promotions, eligible, prices, quantities)
+        self.assertEqual(picked, [(0, 30.0), (1, 25.0)])
+        self.assertEqual(list(line_promotion), [1, 1, 0])
+
+    def test_cart_wide_promotion_takes_its_lines(self):
+        """It should not apply another promotion to the lines a cart wide one counted"""
+        promotions = compile_all((BUY_ONE_GET_ONE_OFF, 100), (PERCENTAGE, 1))
+        eligible = np.array([[True, True, True], [True, True, True]])
+        picked, line_promotion, _ = evaluate(promotions, eligible, PRICES, QUANTITIES)
+        self.assertEqual([row for row, _ in picked], [0])
+        self.assertEqual(list(line_promotion), [0, 0, 0])
+
+    def test_nothing_to_apply(self):
+        """It should leave the cart alone without a promotion saving anything"""
+        picked, line_promotion, line_discount = evaluate([], np.zeros((0, 3), dtype=bool), PRICES, QUANTITIES)
+        self.assertEqual(picked, [])
+        self.assertEqual(list(line_promotion), [-1, -1, -1])
+        self.assertEqual(list(line_discount), [0.0, 0.0, 0.0])
+
+    def test_unknown_promo_type(self):
+        """It should never discount anything with an unknown promo type"""
+        np.testing.assert_allclose(self.discounts(99, 50), [0.0, 0.0, 0.0])
+
+
+######################################################################
+#  E V A L U A T O R   T E S T   C A S E S
+######################################################################
+class TestEvaluator(unittest.TestCase):
+    """Test Cases for the compiled promotions"""
+
+    def test_compile(self):
+        """It should pick the evaluator of the promo type and compile its value"""
+        evaluator = compile_evaluator(7, "SAVE10", 3, PERCENTAGE, 150.0)
+        self.assertIsInstance(evaluator, PercentageOff)
+        self.assertEqual(
+            (evaluator.promotion_id, evaluator.code, evaluator.revision, evaluator.param), (7, "SAVE10", 3, 1.0)
+        )
+        self.assertEqual(compile_evaluator(7, "B2G1", 3, BUY_X_GET_ONE_FREE, 2.0).param, 3)
+        self.assertEqual(type(compile_evaluator(7, "X", 3, 99, 2.0)), Evaluator)
+
+    def test_immutable(self):
+        """It should not be changed or given new attributes"""
+        evaluator = compile_evaluator(7, "SAVE10", 3, PERCENTAGE, 10.0)
+        with self.assertRaises(AttributeError):
+            evaluator.param = 0.5
+        with self.assertRaises(AttributeError):
+            evaluator.value = 10.0
+        self.assertFalse(hasattr(evaluator, "__dict__"))
+
+
+class TestEvaluatorCache(unittest.TestCase):
+    """Test Cases for the cache of compiled promotions"""
+
+    @classmethod
+    def setUpClass(cls):
+        """This runs once before the entire test suite"""
+        app = Flask(__name__)
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.logger.setLevel(logging.CRITICAL)
+        app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("DATABASE_URI")
+        init_db(app)
+
+    @classmethod
+    def tearDownClass(cls):
+        """This runs once after the entire test suite"""
+        db.session.close()
+
+    def setUp(self):
+        """This runs before each test"""
+        db.session.query(promotion_product).delete()
+        db.session.query(Product).delete()
+        db.session.query(Promotion).delete()
+        db.session.commit()
+        self.cache = EvaluatorCache(size=2)
+
+    def tearDown(self):
+        """This runs after each test"""
+        db.session.remove()
+
+    def test_compiled_once(self):
+        """It should compile a promotion once, and again after it changes"""
+        promotion = PromotionFactory(promo_type=PERCENTAGE, value=10)
+        promotion.create()
+        (first,) = self.cache.get({promotion.id})
+        self.assertEqual((first.promotion_id, first.param), (promotion.id, 0.1))
+        self.assertIs(self.cache.get({promotion.id})[0], first)
+
+        promotion.value = 20
+        promotion.update()
+        (second,) = self.cache.get({promotion.id})
+        self.assertEqual(second.param, 0.2)
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["compiles"], stats["entries"]), (1, 2, 1))
+
+    def test_kept_when_redeemed(self):
+        """It should keep the evaluator of a promotion whose uses are redeemed"""
+        today = date.today()
+        promotion = PromotionFactory(
+            promo_type=PERCENTAGE, value=10, available=5, start=today, expired=today + timedelta(days=1)
+        )
+        promotion.create()
+        (first,) = self.cache.get({promotion.id})
+        for _ in range(2):
+            self.assertIsNotNone(Promotion.redeem(promotion.id))
+            self.assertIs(self.cache.get({promotion.id})[0], first)
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["compiles"]), (2, 1))
+
+    def test_missing_and_evicted(self):
+        """It should skip deleted promotions and keep the most recently used ones"""
+        promotions = PromotionFactory.create_batch(3)
+        for promotion in promotions:
+            promotion.create()
+        ids = [promotion.id for promotion in promotions]
+        self.assertEqual([found.promotion_id for found in self.cache.get(set(ids) | {0})], ids)
+        self.assertEqual(self.cache.get(set()), [])
+        stats = self.cache.stats()
+        self.assertEqual((stats["entries"], stats["evictions"]), (2, 1))
+
+    def test_disabled(self):
+        """It should compile every promotion again when disabled"""
+        promotion = PromotionFactory()
+        promotion.create()
+        cache = EvaluatorCache(enabled=False)
+        cache.get({promotion.id})
+        cache.get({promotion.id})
+        self.assertEqual(cache.stats()["compiles"], 2)
@@ -5,15 +5,23 @@ Test cases can be run with the following:
   nosetests -v --with-spec --spec-color
   coverage report -m
 """
+# pylint: disable=too-many-lines
 import os
+import re
 import json
 import logging
 
 from unittest import TestCase
+from unittest.mock import patch
 from datetime import datetime, timedelta, date
 from urllib.parse import quote_plus
+from sqlalchemy import event
+from sqlalchemy.exc import DataError
 from service import app
-from service.models import db, Promotion, init_db, promotion_product, Product
+from service.models import db, Promotion, init_db, promotion_product, Product, payloads, queries, snapshots
+from service.leases import leases
+from service.pool import monitor
+from service.pricing import evaluators
 from service.common import status  # HTTP Status Codes
 from tests.factories import PromotionFactory, ProductFactory
 
@@ -50,6 +58,10 @@ class TestPromotionResourceModel(TestCase):
         db.session.query(Product).delete()
         db.session.query(Promotion).delete()
         db.session.commit()
+        snapshots.clear()
+        queries.clear()
+        payloads.reset_stats()
+        evaluators.clear()
 
     def tearDown(self):
         """This runs after each test"""
@@ -89,6 +101,12 @@ class TestPromotionResourceModel(TestCase):
             products.append(test_product)
         return products
 
+    @staticmethod
+    def _next_url(response):
+        """Returns the url of the next page from the Link header, or None"""
+        match = re.match(r'<([^>]+)>; rel="next"', response.headers.get("Link", ""))
+        return match.group(1) if match else None
+
     ######################################################################
     #  T E S T   C A S E S
     ######################################################################
@@ -142,6 +160,18 @@ class TestPromotionResourceModel(TestCase):
 
         self.assertEqual(response.status_code, 200)
 
+    def test_update_promotion_bad_shards(self):
+        """It should not update a Promotion with a number of shards out of range"""
+        promotion = PromotionFactory(counter_shards=0)
+        promotion.create()
+        url = f"{API_PROMOTION_URL}/{promotion.id}"
+        for shards in (Promotion.MAX_COUNTER_SHARDS + 36, -1):
+            response = self.client.put(url, json=dict(promotion.serialize(), counter_shards=shards))
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertIn("counter_shards", response.get_json()["message"])
+        db.session.expire_all()
+        self.assertEqual(self.client.get(url).get_json()["counter_shards"], 0)
+
     def test_promotion_not_found(self):
         """It should return a 404 error if a Promotion is not found by id"""
         invalid_promotion_id = 99999999
@@ -235,6 +265,100 @@ class TestPromotionResourceModel(TestCase):
         data = response.get_json()
         self.assertEqual(len(data), 5)
 
+    def test_get_promotion_list_pages(self):
+        """It should page through the promotions with the next link"""
+        promotions = self._create_promotions(5)
+        ids = sorted(promotion.id for promotion in promotions)
+        url, seen = f"{API_PROMOTION_URL}?limit=2", []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            data = response.get_json()
+            self.assertLessEqual(len(data), 2)
+            seen.extend(promotion["id"] for promotion in data)
+            url = self._next_url(response)
+        self.assertEqual(seen, ids)
+
+    def test_get_promotion_list_page_keeps_filters(self):
+        """It should keep the query filters in the next link"""
+        for _ in range(3):
+            PromotionFactory(promo_type=2).create()
+        PromotionFactory(promo_type=1).create()
+        response = self.client.get(API_PROMOTION_URL, query_string="promo_type=2&limit=2")
+        self.assertEqual(len(response.get_json()), 2)
+        self.assertIn("promo_type=2", self._next_url(response))
+        response = self.client.get(self._next_url(response))
+        data = response.get_json()
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]["promo_type"], 2)
+        self.assertNotIn("Link", response.headers)
+
+    def test_get_promotion_list_page_size_capped(self):
+        """It should never return more promotions than the page size cap"""
+        self._create_promotions(4)
+        app.config["PAGE_SIZE_MAX"] = 3
+        try:
+            response = self.client.get(API_PROMOTION_URL, query_string="limit=50")
+        finally:
+            app.config["PAGE_SIZE_MAX"] = 1000
+        self.assertEqual(len(response.get_json()), 3)
+        self.assertIn("limit=3", response.headers["Link"])
+
+    def test_get_promotion_list_bad_page(self):
+        """It should reject a bad limit or cursor"""
+        response = self.client.get(API_PROMOTION_URL, query_string="limit=0")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(API_PROMOTION_URL, query_string="cursor=not-a-cursor")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def _count_statements(self, url):
+        """Returns the number of SQL statements run to GET a url"""
+        statements = []
+
+        def count(*_):
+            statements.append(1)
+
+        event.listen(db.engine, "before_cursor_execute", count)
+        try:
+            response = self.client.get(url)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(statements)
+
+    def test_list_promotions_constant_queries(self):
+        """It should list promotions with the same number of queries whatever their number"""
+        for count in (2, 20):
+            for _ in range(count):
+                PromotionFactory().create([1, 2, 3])
+            PromotionFactory(counter_shards=2).create([4])
+        few = self._count_statements(f"{API_PROMOTION_URL}?limit=3")
+        many = self._count_statements(f"{API_PROMOTION_URL}?limit=25")
+        self.assertEqual(few, many)
+        export = self._count_statements(f"{API_PROMOTION_URL}/export")
+        self.assertLessEqual(export, many + 1)
+
+    def test_export_promotions(self):
+        """It should stream every promotion as one JSON document per line"""
+        promotions = self._create_promotions(5)
+        response = self.client.get(f"{API_PROMOTION_URL}/export")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        lines = response.get_data(as_text=True).splitlines()
+        data = [json.loads(line) for line in lines]
+        self.assertEqual([promotion["id"] for promotion in data], sorted(p.id for p in promotions))
+        self.assertEqual(data[0]["code"], Promotion.find(data[0]["id"]).code)
+
+    def test_export_promotions_filtered(self):
+        """It should stream only the promotions matching the filter"""
+        for _ in range(3):
+            PromotionFactory(promo_type=2).create()
+        PromotionFactory(promo_type=1).create()
+        response = self.client.get(f"{API_PROMOTION_URL}/export", query_string="promo_type=2")
+        data = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual(len(data), 3)
+        self.assertTrue(all(promotion["promo_type"] == 2 for promotion in data))
+
     def test_query_promotion_list_by_name(self):
         """It should Query Promotion by Name"""
         promotions = self._create_promotions(10)
@@ -302,6 +426,201 @@ class TestPromotionResourceModel(TestCase):
         data = response.get_json()
         self.assertEqual(data["name"], test_promotion.name)
 
+    def test_get_promotion_fields(self):
+        """It should only return the fields asked for, without reading the products"""
+        promotion = PromotionFactory()
+        promotion.create([1, 2])
+        statements = []
+
+        def record(_conn, _cursor, statement, *_):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            response = self.client.get(
+                f"{API_PROMOTION_URL}/{promotion.id}", query_string="fields=id,name"
+            )
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json(), {"id": promotion.id, "name": promotion.name})
+        self.assertFalse(any("promotion_product" in statement for statement in statements))
+
+        response = self.client.get(
+            f"{API_PROMOTION_URL}/{promotion.id}", query_string="fields=code&expand=products"
+        )
+        self.assertEqual(response.get_json(), {"code": promotion.code, "products": [1, 2]})
+
+    def test_get_promotion_product_count(self):
+        """It should return the number of products instead of their ids"""
+        promotion = PromotionFactory()
+        promotion.create([1, 2, 3])
+        response = self.client.get(f"{API_PROMOTION_URL}/{promotion.id}")
+        data = response.get_json()
+        self.assertEqual(data["product_count"], 3)
+        self.assertNotIn("products", data)
+        response = self.client.get(API_PROMOTION_URL)
+        self.assertEqual(response.get_json()[0]["product_count"], 3)
+
+    def test_created_and_updated_promotion_shape(self):
+        """It should answer POST and PUT with the same keys as GET"""
+        promotion = PromotionFactory()
+        response = self.client.post(API_PROMOTION_URL, json=promotion.serialize())
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        created = response.get_json()
+        self.assertNotIn("products", created)
+        url = f"{API_PROMOTION_URL}/{created['id']}"
+        response = self.client.put(url, json=dict(promotion.serialize(), name="Renamed"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        updated = response.get_json()
+        self.assertNotIn("products", updated)
+        self.assertEqual(updated.keys(), self.client.get(url).get_json().keys())
+
+    def test_list_promotion_products(self):
+        """It should page through the products of a promotion"""
+        promotion = PromotionFactory()
+        promotion.create([5, 1, 4, 2, 3])
+        PromotionFactory().create([6])
+        url, seen = f"{API_PROMOTION_URL}/{promotion.id}/products?limit=2", []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            data = response.get_json()
+            self.assertLessEqual(len(data), 2)
+            seen.extend(product["id"] for product in data)
+            url = self._next_url(response)
+        self.assertEqual(seen, [1, 2, 3, 4, 5])
+
+    def test_list_promotion_products_not_found(self):
+        """It should not list the products of a Promotion thats not found"""
+        response = self.client.get(f"{API_PROMOTION_URL}/0/products")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_next_link_keeps_fields(self):
+        """It should keep the projection in the next link"""
+        for _ in range(2):
+            PromotionFactory().create([1])
+        response = self.client.get(API_PROMOTION_URL, query_string="limit=1&fields=id&expand=products")
+        response = self.client.get(self._next_url(response))
+        self.assertEqual(set(response.get_json()[0]), {"id", "products"})
+
+    def test_list_promotions_fields(self):
+        """It should project every promotion of the list and of the export"""
+        PromotionFactory().create([1])
+        response = self.client.get(API_PROMOTION_URL, query_string="fields=id,products")
+        self.assertEqual(set(response.get_json()[0]), {"id", "products"})
+        response = self.client.get(f"{API_PROMOTION_URL}/export", query_string="fields=code")
+        self.assertEqual(set(json.loads(response.get_data(as_text=True))), {"code"})
+
+    def test_unknown_fields(self):
+        """It should reject fields and expansions that do not exist"""
+        promotion = PromotionFactory()
+        promotion.create()
+        response = self.client.get(f"{API_PROMOTION_URL}/{promotion.id}", query_string="fields=id,secret")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("secret", response.get_json()["message"])
+        response = self.client.get(API_PROMOTION_URL, query_string="expand=promotions")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(API_PRODUCT_URL, query_string="expand=products")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_list_products_expand_promotions(self):
+        """It should only embed the promotions of products when expanded"""
+        promotion = PromotionFactory()
+        promotion.create([7])
+        response = self.client.get(API_PRODUCT_URL)
+        self.assertNotIn("promotions", response.get_json()[0])
+        response = self.client.get(API_PRODUCT_URL, query_string="fields=id&expand=promotions")
+        data = response.get_json()
+        self.assertEqual(data[0]["id"], 7)
+        self.assertEqual([item["code"] for item in data[0]["promotions"]], [promotion.code])
+
+    def test_get_promotion_not_modified(self):
+        """It should answer 304 Not Modified until the promotion changes"""
+        promotion = PromotionFactory(start=date.today(), available=5)
+        promotion.create()
+        url = f"{API_PROMOTION_URL}/{promotion.id}"
+        response = self.client.get(url)
+        etag = response.headers["ETag"]
+        response = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.get_data(), b"")
+
+        # another representation has another tag
+        response = self.client.get(url, query_string="fields=id", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # applying changes the uses left, so the tag
+        self.client.post(f"{url}/apply")
+        response = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+    def test_get_sharded_promotion_not_modified(self):
+        """It should change the tag of a sharded promotion when a shard is redeemed"""
+        promotion = PromotionFactory(start=date.today(), available=5, counter_shards=2)
+        promotion.create()
+        url = f"{API_PROMOTION_URL}/{promotion.id}"
+        etag = self.client.get(url).headers["ETag"]
+        self.client.post(f"{url}/apply")
+        response = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_list_promotions_not_modified(self):
+        """It should answer 304 Not Modified until any promotion changes"""
+        self._create_promotions(2)
+        response = self.client.get(API_PROMOTION_URL)
+        etag = response.headers["ETag"]
+        self.assertTrue(etag.startswith("W/"))
+        response = self.client.get(API_PROMOTION_URL, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        response = self.client.get(API_PROMOTION_URL, query_string="limit=1", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self._create_promotions(1)
+        response = self.client.get(API_PROMOTION_URL, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.get_json()), 3)
+
+    def test_list_promotions_modified_in_new_database(self):
+        """It should not answer 304 Not Modified after the first promotion of a new database"""
+        db.session.execute(db.text("ALTER SEQUENCE promotion_generation RESTART"))
+        db.session.commit()
+        etag = self.client.get(API_PROMOTION_URL).headers["ETag"]
+        self._create_promotions(1)
+        response = self.client.get(API_PROMOTION_URL, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.get_json()), 1)
+        self.assertEqual(len(self.client.get(API_PROMOTION_URL).get_json()), 1)
+
+    def test_product_delete_changes_promotion_tag(self):
+        """It should change the tag of the promotions of a deleted product"""
+        promotion = PromotionFactory()
+        promotion.create([1])
+        url = f"{API_PROMOTION_URL}/{promotion.id}"
+        etag = self.client.get(url).headers["ETag"]
+        self.client.delete(f"{API_PRODUCT_URL}/1")
+        response = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json()["product_count"], 0)
+
+    def test_update_promotion_if_match(self):
+        """It should only update a promotion with the current ETag in If-Match"""
+        promotion = PromotionFactory()
+        promotion.create()
+        url = f"{API_PROMOTION_URL}/{promotion.id}"
+        etag = self.client.get(url).headers["ETag"]
+        data = promotion.serialize()
+        data["name"] = "first"
+        response = self.client.put(url, json=data, headers={"If-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+        data["name"] = "second"
+        response = self.client.put(url, json=data, headers={"If-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.assertEqual(self.client.get(url).get_json()["name"], "first")
+
     def test_get_promotion_not_found(self):
         """It should not Get a Promotion thats not found"""
         response = self.client.get(f"{API_PROMOTION_URL}/0")
@@ -402,7 +721,7 @@ class TestPromotionResourceModel(TestCase):
         # Bind the product to the promotion
         response = self.client.put(f"{API_PROMOTION_URL}/{promotion.id}/bind/0")
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(promotion.products), 1)
+        self.assertEqual(promotion.products.count(), 1)
 
     def test_bind_product_to_promotion_product_already_bound(self):
         """It should not bind a product to a promotion that already has it"""
@@ -504,6 +823,45 @@ class TestPromotionResourceModel(TestCase):
         response = self.client.delete(f"{API_PROMOTION_URL}/0/unbind/{product.id}")
         self.assertEqual(response.status_code, 404)
 
+    def test_change_promotion_products(self):
+        """It should replace, bind and unbind many products of a promotion"""
+        promotion = self._create_promotions(1)[0]
+        url = f"{API_PROMOTION_URL}/{promotion.id}/products"
+        self.client.get(f"{API_PROMOTION_URL}/{promotion.id}")
+
+        response = self.client.put(url, json={"product_ids": [1, 2, 3]})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.get_json(), {"id": promotion.id, "added": 3, "removed": 0, "product_count": 3}
+        )
+        response = self.client.post(url, json={"product_ids": [3, 4]})
+        self.assertEqual(response.get_json(), {"id": promotion.id, "added": 1, "removed": 0, "product_count": 4})
+        response = self.client.delete(url, json={"product_ids": [1, 9]})
+        self.assertEqual(response.get_json(), {"id": promotion.id, "added": 0, "removed": 1, "product_count": 3})
+        response = self.client.put(url, json={"product_ids": [4, 5]})
+        self.assertEqual(response.get_json(), {"id": promotion.id, "added": 1, "removed": 2, "product_count": 2})
+
+        # the cached payload of the promotion moved to the new version
+        data = self.client.get(f"{API_PROMOTION_URL}/{promotion.id}?expand=products").get_json()
+        self.assertEqual(data["products"], [4, 5])
+
+    def test_change_promotion_products_bad_request(self):
+        """It should not change the products of a missing promotion or with a bad body"""
+        promotion = self._create_promotions(1)[0]
+        url = f"{API_PROMOTION_URL}/{promotion.id}/products"
+        response = self.client.post(f"{API_PROMOTION_URL}/0/products", json={"product_ids": [1]})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        for body in ({}, {"product_ids": ["x"]}, {"product_ids": 1}, {"product_ids": [0]}):
+            response = self.client.put(url, json=body)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, body)
+        response = self.client.post(url, json={"product_ids": [1, 2**40]})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(promotion.bound_product_ids(), [])
+        # the worker still serves requests
+        response = self.client.post(url, json={"product_ids": [1, 2**31 - 1]})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(promotion.bound_product_ids(), [1, 2**31 - 1])
+
     def test_apply_promotion(self):
         """It should apply the promotion"""
         promotion = PromotionFactory()
@@ -514,6 +872,270 @@ class TestPromotionResourceModel(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(promotion.available, 0)
 
+    def test_apply_promotion_lean(self):
+        """It should apply the promotion and only return the uses left"""
+        promotion = PromotionFactory()
+        promotion.start = date.today()
+        promotion.available = 3
+        promotion.create()
+        response = self.client.post(
+            f"{API_PROMOTION_URL}/{promotion.id}/apply", query_string="lean=true"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json(), {"id": promotion.id, "available": 2})
+
+    def test_apply_promotion_lean_round_trips(self):
+        """It should apply a promotion with one statement and its commit, then advance the generation"""
+        promotion = PromotionFactory(start=date.today(), available=3)
+        promotion.create()
+        url, generation = f"{API_PROMOTION_URL}/{promotion.id}/apply", Promotion.generation()
+        db.session.remove()
+        calls = []
+
+        def record(name):
+            return lambda *_: calls.append(name)
+
+        def statement(_connection, _cursor, text, *_):
+            calls.append("nextval" if "nextval" in text else "statement")
+
+        listeners = [(db.engine, "before_cursor_execute", statement), (db.engine, "commit", record("commit")),
+                     (db.engine.pool, "checkout", record("checkout"))]
+        for target, name, listener in listeners:
+            event.listen(target, name, listener)
+        try:
+            response = self.client.post(url, query_string="lean=true")
+        finally:
+            for target, name, listener in listeners:
+                event.remove(target, name, listener)
+        self.assertEqual(response.status_code, 200)
+        # the generation moves on only once the change is committed
+        self.assertEqual(calls, ["checkout", "statement", "commit", "checkout", "nextval"])
+        self.assertGreater(Promotion.generation(), generation)
+
+    def test_apply_promotion_from_lease(self):
+        """It should apply the promotion from a worker lease"""
+        promotion = PromotionFactory()
+        promotion.start = date.today()
+        promotion.available = 20
+        promotion.create()
+        leases.size = 5
+        try:
+            for _ in range(3):
+                response = self.client.post(
+                    f"{API_PROMOTION_URL}/{promotion.id}/apply", query_string="lean=true"
+                )
+                self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.get_json()["available"], 2)
+            response = self.client.get("/admin/leases")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            data = response.get_json()
+            self.assertTrue(data["enabled"])
+            self.assertEqual(data["leased_uses"], 2)
+
+            response = self.client.post(f"{API_PROMOTION_URL}/{promotion.id}/cancel")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(leases.stats()["active_leases"], 0)
+        finally:
+            leases.release_all()
+            leases.size = 0
+
+    def test_pool_stats(self):
+        """It should report the checkouts of the database pool"""
+        monitor.clear()
+        self.client.get(API_PROMOTION_URL)
+        response = self.client.get("/admin/pool")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertTrue(data["enabled"])
+        self.assertGreaterEqual(data["checkouts"], 1)
+        self.assertEqual(data["wait_ms"]["buckets"]["+Inf"], data["checkouts"])
+        self.assertEqual(data["pool_size"], app.config["DATABASE_POOL_SIZE"])
+
+    def test_cache_stats(self):
+        """It should serve repeated reads from the caches"""
+        promotion = self._create_promotions(1)[0]
+        for _ in range(3):
+            response = self.client.get(f"{API_PROMOTION_URL}/{promotion.id}")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            response = self.client.get(f"{API_PROMOTION_URL}/{promotion.id}/products")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get("/admin/cache")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertTrue(data["enabled"])
+        self.assertEqual(data["hits"], 2)
+        self.assertEqual(data["entries"], 1)
+        self.assertTrue(data["payloads"]["enabled"])
+        self.assertEqual(data["payloads"]["hits"], 2)
+        self.assertEqual(data["payloads"]["stores"], 1)
+
+    def test_list_promotions_from_query_cache(self):
+        """It should list the promotions of a filter from the cache until one changes"""
+        promotions = self._create_promotions(3)
+        url = f"{API_PROMOTION_URL}?name={quote_plus(promotions[0].name)}&fields=id,name"
+        first = self.client.get(url).get_json()
+        # only the generation is read: the page comes from the cache
+        self.assertEqual(self._count_statements(url), 1)
+        self.assertEqual(self.client.get(url).get_json(), first)
+
+        response = self.client.delete(f"{API_PROMOTION_URL}/{promotions[0].id}")
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self.client.get(url).get_json(), [])
+
+        stats = self.client.get("/admin/cache").get_json()["queries"]["find_by_name"]
+        self.assertEqual((stats["hits"], stats["misses"]), (2, 2))
+        self.assertEqual(stats["hit_ratio"], 0.5)
+
+    def test_lookup_product_promotions(self):
+        """It should return the valid promotions of many products in one query"""
+        today = date.today()
+        promotion = PromotionFactory(start=today, whole_store=False)
+        promotion.create([1, 2])
+        everywhere = PromotionFactory(start=today, whole_store=True)
+        everywhere.create()
+        statements = []
+
+        def count(*_):
+            statements.append(1)
+
+        event.listen(db.engine, "before_cursor_execute", count)
+        try:
+            response = self.client.post(
+                f"{API_PRODUCT_URL}/promotions:lookup", json={"product_ids": [2, 7]}
+            )
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(
+            response.get_json(),
+            [
+                {"product_id": 2, "promotion_ids": sorted([promotion.id, everywhere.id])},
+                {"product_id": 7, "promotion_ids": [everywhere.id]},
+            ],
+        )
+
+    def test_lookup_product_promotions_bad_request(self):
+        """It should reject a lookup without a list of product ids, or with too many"""
+        url = f"{API_PRODUCT_URL}/promotions:lookup"
+        for body in ({}, {"product_ids": ["x"]}, {"product_ids": list(range(1001))}, {"product_ids": [2**40]},
+                     {"product_ids": [0]}):
+            response = self.client.post(url, json=body)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(API_PROMOTION_URL).status_code, status.HTTP_200_OK)
+
+    def test_session_rolled_back_after_error(self):
+        """It should roll back the session of a request that failed, for the next ones"""
+
+        def fail(*_args):
+            db.session.execute(db.text("SELECT 1 / 0"))
+
+        with patch("service.routes.Promotion.applicable_to", side_effect=fail):
+            with self.assertRaises(DataError):
+                self.client.post(f"{API_PRODUCT_URL}/promotions:lookup", json={"product_ids": [1]})
+        self.assertEqual(self.client.get(API_PROMOTION_URL).status_code, status.HTTP_200_OK)
+
+    def test_evaluate_cart(self):
+        """It should price a cart with the best of its valid promotions"""
+        today = date.today()
+        window = {"start": today, "expired": today + timedelta(days=1)}
+        everywhere = PromotionFactory(whole_store=True, promo_type=1, value=10, **window)
+        everywhere.create()
+        free = PromotionFactory(whole_store=False, promo_type=3, value=1, **window)
+        free.create([1])
+        # not running yet
+        PromotionFactory(whole_store=True, promo_type=2, value=1000, start=today + timedelta(days=1)).create()
+        cart = {"lines": [
+            {"product_id": 1, "quantity": 2, "unit_price": 10.0},
+            {"product_id": 2, "quantity": 1, "unit_price": 5.5},
+        ]}
+        response = self.client.post(f"{API_PROMOTION_URL}/evaluate", json=cart)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(
+            data["promotions"],
+            [
+                {"id": free.id, "code": free.code, "discount": 10.0},
+                {"id": everywhere.id, "code": everywhere.code, "discount": 0.55},
+            ],
+        )
+        self.assertEqual([line["promotion_id"] for line in data["lines"]], [free.id, everywhere.id])
+        self.assertEqual([line["total"] for line in data["lines"]], [10.0, 4.95])
+        self.assertEqual((data["subtotal"], data["discount"], data["total"]), (25.5, 10.55, 14.95))
+
+        # priced again from the promotions compiled the first time
+        self.assertEqual(self.client.post(f"{API_PROMOTION_URL}/evaluate", json=cart).get_json(), data)
+        stats = self.client.get("/admin/cache").get_json()["evaluators"]
+        self.assertEqual((stats["compiles"], stats["hits"]), (2, 2))
+
+    def test_evaluate_cart_without_promotions(self):
+        """It should return the cart at full price when no promotion applies"""
+        cart = {"lines": [{"product_id": 1, "quantity": 3, "unit_price": 2.5}]}
+        response = self.client.post(f"{API_PROMOTION_URL}/evaluate", json=cart)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(data["promotions"], [])
+        self.assertIsNone(data["lines"][0]["promotion_id"])
+        self.assertEqual(data["total"], 7.5)
+
+    def test_evaluate_bad_cart(self):
+        """It should reject an empty cart, a line without units or out of bounds values"""
+        url = f"{API_PROMOTION_URL}/evaluate"
+        for body in (
+            {"lines": []},
+            {"lines": [{"product_id": 1, "quantity": 0, "unit_price": 1.0}]},
+            {"lines": [{"product_id": 1, "quantity": 1, "unit_price": -1.0}]},
+            {"lines": [{"product_id": 1, "quantity": 1}]},
+            {"lines": [{"product_id": 1, "quantity": 10**20, "unit_price": 1.0}]},
+            {"lines": [{"product_id": 1, "quantity": 1, "unit_price": 1e308}]},
+            {"lines": [{"product_id": 2**40, "quantity": 1, "unit_price": 1.0}]},
+        ):
+            response = self.client.post(url, json=body)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_promotion_from_payload_cache(self):
+        """It should serve a cached promotion without the database or serializing it"""
+        promotion = self._create_promotions(1)[0]
+        url = f"{API_PROMOTION_URL}/{promotion.id}?expand=products"
+        first = self.client.get(url)
+        with patch.object(Promotion, "serialize", side_effect=AssertionError("serialized")):
+            self.assertEqual(self._count_statements(url), 0)
+            response = self.client.get(url)
+        self.assertEqual(response.get_data(), first.get_data())
+        self.assertEqual(response.headers["ETag"], first.headers["ETag"])
+
+        response = self.client.get(url, headers={"If-None-Match": first.headers["ETag"]})
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_payload_cache_invalidated_by_writes(self):
+        """It should return the new promotion after it is updated or bound"""
+        promotion = self._create_promotions(1)[0]
+        url = f"{API_PROMOTION_URL}/{promotion.id}"
+        self.client.get(url)
+
+        data = promotion.serialize()
+        data["name"] = "Renamed"
+        response = self.client.put(url, json=data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get(url).get_json()["name"], "Renamed")
+
+        response = self.client.put(f"{url}/bind/42")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get(url).get_json()["product_count"], 1)
+
+        self.client.delete(url)
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_sharded_promotion_not_cached(self):
+        """It should not cache sharded promotions, whose uses change without a new version"""
+        promotion = PromotionFactory(start=date.today(), available=10, counter_shards=2)
+        promotion.create()
+        url = f"{API_PROMOTION_URL}/{promotion.id}"
+        self.client.get(url)
+        self.client.post(f"{url}/apply")
+        self.assertEqual(self.client.get(url).get_json()["available"], 9)
+        self.assertEqual(payloads.stats()["stores"], 0)
+
     def test_apply_nonexistent_promotion(self):
         """It should not apply the promotion"""
         response = self.client.post(f"{API_PROMOTION_URL}/0/apply")
@@ -554,6 +1176,93 @@ class TestPromotionResourceModel(TestCase):
         response = self.client.post(f"{API_PROMOTION_URL}/{promotion.id}/apply")
         self.assertEqual(response.status_code, 405)
 
+    def test_create_promotions_in_batch(self):
+        """It should create every promotion of a batch"""
+        promotions = [promotion.serialize() for promotion in PromotionFactory.build_batch(3)]
+        response = self.client.post(f"{API_PROMOTION_URL}:batch", json=promotions)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        data = response.get_json()
+        self.assertEqual(data["created"], 3)
+        self.assertEqual([result["code"] for result in data["results"]], [item["code"] for item in promotions])
+        for result, item in zip(data["results"], promotions):
+            created = self.client.get(f"{API_PROMOTION_URL}/{result['id']}").get_json()
+            self.assertEqual((created["name"], created["value"]), (item["name"], item["value"]))
+
+    def test_create_promotions_in_batch_with_errors(self):
+        """It should create the valid promotions of a batch and report the others"""
+        valid, taken, malformed = [promotion.serialize() for promotion in PromotionFactory.build_batch(3)]
+        self.client.post(API_PROMOTION_URL, json=taken)
+        del malformed["start"]
+        response = self.client.post(f"{API_PROMOTION_URL}:batch", json=[valid, taken, malformed, "promotion"])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(data["created"], 1)
+        self.assertIn("id", data["results"][0])
+        self.assertEqual(data["results"][1], {"code": taken["code"], "error": "code already exist"})
+        self.assertEqual(data["results"][2]["error"], "Invalid PromotionModel: missing start")
+        self.assertNotIn("code", data["results"][3])
+
+        response = self.client.post(f"{API_PROMOTION_URL}:batch", json=[taken])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.get_json()["created"], 0)
+        too_long, huge = dict(valid, code="X" * 40), dict(valid, code="HUGE", available=2**40)
+        response = self.client.post(f"{API_PROMOTION_URL}:batch", json=[too_long, huge])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(
+            [result["error"] for result in response.get_json()["results"]],
+            ["code attribute is too long", "available attribute is out of range"],
+        )
+        for body in ([], valid, [valid] * 1001):
+            response = self.client.post(f"{API_PROMOTION_URL}:batch", json=body)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_apply_promotions_in_batch(self):
+        """It should apply several promotions by id and code at once"""
+        first, second = PromotionFactory.create_batch(2, start=date.today(), available=3, counter_shards=0)
+        first.create()
+        second.create()
+        response = self.client.post(
+            f"{API_PROMOTION_URL}/apply:batch", json={"ids": [first.id], "codes": [second.code]}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.get_json(),
+            {
+                "results": [
+                    {"id": first.id, "code": first.code, "available": 2},
+                    {"id": second.id, "code": second.code, "available": 2},
+                ]
+            },
+        )
+
+    def test_apply_promotions_in_batch_all_or_nothing(self):
+        """It should apply no promotion of a batch when one cannot be applied"""
+        good = PromotionFactory(start=date.today(), available=3, counter_shards=0)
+        good.create()
+        expired = PromotionFactory(expired=date.today() - timedelta(days=1))
+        expired.create()
+        url = f"{API_PROMOTION_URL}/apply:batch"
+
+        response = self.client.post(url, json={"ids": [good.id, expired.id]})
+        self.assertEqual(response.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+        data = response.get_json()
+        self.assertEqual(data["message"], "No promotion was applied.")
+        self.assertNotIn("error", data["results"][0])
+        self.assertIn("expired", data["results"][1]["error"])
+
+        response = self.client.post(url, json={"ids": [good.id], "codes": ["NOSUCHCODE"]})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.get(f"{API_PROMOTION_URL}/{good.id}").get_json()["available"], 3)
+
+    def test_apply_promotions_in_batch_bad_request(self):
+        """It should not apply an empty batch, one that is not lists or ids out of range"""
+        url = f"{API_PROMOTION_URL}/apply:batch"
+        for body in ({}, {"ids": [], "codes": []}, {"ids": "1"}, {"codes": [1]}, {"ids": [2**40]}, {"ids": [0]}):
+            response = self.client.post(url, json=body)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        # the worker still serves requests
+        self.assertEqual(self.client.get(API_PROMOTION_URL).status_code, status.HTTP_200_OK)
+
     def test_cancel_promotion(self):
         """It should cancel the promotion"""
         promotion = PromotionFactory()